@@ -0,0 +1,258 @@
+""" Sparse adjacency matrices of the synaptic connections between all
+skeletons of a project.
+
+The matrix of a project has a row and a column for every skeleton with
+treenodes, ordered by skeleton ID. An entry is the number of synapses of the
+row skeleton onto the column skeleton, i.e. the number of pairs of a
+presynaptic and a postsynaptic link of the two skeletons to the same
+connector. Matrices are kept in memory and are stored in the
+MEDIA_ADJACENCY_SUBDIRECTORY folder, so that they outlive the process.
+
+Along with the matrix, the partners_version of every skeleton summary is
+stored. A database trigger changes this version whenever a link to one of the
+connectors of a skeleton changes. To bring a matrix up to date, only the rows
+of skeletons with a new version are fetched again (from the partner cache of
+catmaid.control.partnercache), all other rows are kept.
+
+Building the first matrix of a project fills the partner cache of all of its
+skeletons, which is best done offline with the catmaid_update_adjacency
+management command. Questions about a few skeletons are answered by
+skeleton_edges and synapse_partners, which only read the partners of these.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from django.conf import settings
+from django.db import connection
+
+from catmaid.control.partnercache import partner_links
+
+
+# The path were adjacency matrices get stored in
+adjacency_output_path = os.path.join(settings.MEDIA_ROOT,
+    settings.MEDIA_ADJACENCY_SUBDIRECTORY)
+
+_matrices = {}
+
+
+class AdjacencyMatrix(object):
+    """ The synapse counts between all skeletons of a project. """
+
+    def __init__(self, project_id, skeleton_ids, versions, matrix):
+        self.project_id = project_id
+        self.skeleton_ids = skeleton_ids
+        self.versions = versions
+        self.matrix = matrix
+        self._transposed = None
+
+    def indices(self, skeleton_ids):
+        """ Returns an array of the rows of those of the passed in skeletons
+        that are part of the matrix. """
+        skeleton_ids = np.unique(np.asarray(list(skeleton_ids), dtype=np.int64))
+        rows = np.searchsorted(self.skeleton_ids, skeleton_ids)
+        rows = rows[rows < len(self.skeleton_ids)]
+        return rows[np.in1d(self.skeleton_ids[rows], skeleton_ids)]
+
+    def _partners(self, matrix, skeleton_id):
+        rows = self.indices([skeleton_id])
+        if not len(rows):
+            return {}
+        start, end = matrix.indptr[rows[0]], matrix.indptr[rows[0] + 1]
+        return dict(zip(self.skeleton_ids[matrix.indices[start:end]].tolist(),
+                        matrix.data[start:end].tolist()))
+
+    def downstream(self, skeleton_id):
+        """ Returns a dictionary of skeleton ID vs the number of synapses the
+        passed in skeleton makes onto it. """
+        return self._partners(self.matrix, skeleton_id)
+
+    def upstream(self, skeleton_id):
+        """ Returns a dictionary of skeleton ID vs the number of synapses it
+        makes onto the passed in skeleton. """
+        if self._transposed is None:
+            self._transposed = self.matrix.transpose().tocsr()
+        return self._partners(self._transposed, skeleton_id)
+
+    def edges(self, skeleton_ids=None):
+        """ Returns a list of (presynaptic skeleton ID, postsynaptic skeleton
+        ID, number of synapses) tuples, either of the whole project or only of
+        those between the passed in skeletons. """
+        matrix = self.matrix
+        ids = self.skeleton_ids
+        if skeleton_ids is not None:
+            rows = self.indices(skeleton_ids)
+            if not len(rows):
+                return []
+            matrix = matrix[rows, :][:, rows]
+            ids = ids[rows]
+        coo = matrix.tocoo()
+        return zip(ids[coo.row].tolist(), ids[coo.col].tolist(),
+                   coo.data.tolist())
+
+
+def _path(project_id):
+    return os.path.join(adjacency_output_path, 'project_%s.npz' % project_id)
+
+def _load(project_id):
+    """ Returns the stored matrix of a project or None if there is none. """
+    try:
+        f = np.load(_path(project_id))
+        try:
+            matrix = csr_matrix((f['data'], f['indices'], f['indptr']),
+                    shape=(len(f['skeleton_ids']),) * 2)
+            return AdjacencyMatrix(project_id, f['skeleton_ids'],
+                    f['versions'], matrix)
+        finally:
+            f.close()
+    except Exception:
+        # Missing or unreadable files are rebuilt
+        return None
+
+def _save(adjacency):
+    """ Stores a matrix atomically, so that concurrent readers never see a
+    partially written file. Matrices that can't be stored are only kept in
+    memory. """
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=adjacency_output_path)
+    except (IOError, OSError):
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, skeleton_ids=adjacency.skeleton_ids,
+                    versions=adjacency.versions, data=adjacency.matrix.data,
+                    indices=adjacency.matrix.indices,
+                    indptr=adjacency.matrix.indptr)
+        os.rename(tmp_path, _path(adjacency.project_id))
+    except (IOError, OSError):
+        os.remove(tmp_path)
+
+def _synapse_relations(cursor, project_id):
+    cursor.execute('''
+    SELECT relation_name, id
+    FROM relation
+    WHERE project_id = %s
+      AND (relation_name = 'presynaptic_to'
+           OR relation_name = 'postsynaptic_to')
+    ''', (project_id,))
+    return dict(cursor.fetchall())
+
+def _update(cursor, project_id, old, skeleton_ids, versions):
+    """ Returns a new matrix for the passed in skeletons and versions. Rows
+    of an old matrix are reused for all skeletons whose version didn't change.
+    """
+    n = len(skeleton_ids)
+    pre, post, counts = [], [], []
+    changed = skeleton_ids
+
+    if old is not None and len(old.skeleton_ids):
+        positions = np.searchsorted(old.skeleton_ids, skeleton_ids)
+        positions[positions == len(old.skeleton_ids)] = 0
+        unchanged = (old.skeleton_ids[positions] == skeleton_ids) & \
+                (old.versions[positions] == versions)
+        changed = skeleton_ids[~unchanged]
+
+        coo = old.matrix.tocoo()
+        old_pre = old.skeleton_ids[coo.row]
+        old_post = old.skeleton_ids[coo.col]
+        keep = np.in1d(old_pre, skeleton_ids[unchanged]) & \
+                np.in1d(old_post, skeleton_ids)
+        pre.append(old_pre[keep])
+        post.append(old_post[keep])
+        counts.append(coo.data[keep])
+
+    if len(changed):
+        relations = _synapse_relations(cursor, project_id)
+        if len(relations) == 2:
+            links = np.array(partner_links(changed.tolist(),
+                    relations['presynaptic_to'], relations['postsynaptic_to'],
+                    cursor), dtype=np.int64).reshape((-1, 3))
+            links = links[np.in1d(links[:, 1], skeleton_ids)]
+            pre.append(links[:, 0])
+            post.append(links[:, 1])
+            counts.append(links[:, 2])
+
+    if pre:
+        pre, post, counts = np.concatenate(pre), np.concatenate(post), \
+                np.concatenate(counts)
+    else:
+        pre = post = counts = np.empty(0, dtype=np.int64)
+    matrix = csr_matrix((counts.astype(np.int32),
+            (np.searchsorted(skeleton_ids, pre),
+             np.searchsorted(skeleton_ids, post))), shape=(n, n))
+    return AdjacencyMatrix(project_id, skeleton_ids, versions, matrix)
+
+def project_adjacency(project_id, cursor=None):
+    """ Returns an up to date AdjacencyMatrix of the passed in project. """
+    project_id = int(project_id)
+    cursor = cursor or connection.cursor()
+    cursor.execute('''
+    SELECT skeleton_id, partners_version
+    FROM skeleton_summary
+    WHERE project_id = %s
+    ORDER BY skeleton_id
+    ''', (project_id,))
+    rows = np.array(cursor.fetchall(), dtype=np.int64).reshape((-1, 2))
+    skeleton_ids, versions = rows[:, 0].copy(), rows[:, 1].copy()
+
+    adjacency = _matrices.get(project_id)
+    if adjacency is None:
+        adjacency = _load(project_id)
+    if adjacency is None or \
+            not np.array_equal(adjacency.skeleton_ids, skeleton_ids) or \
+            not np.array_equal(adjacency.versions, versions):
+        adjacency = _update(cursor, project_id, adjacency, skeleton_ids,
+                versions)
+        _save(adjacency)
+    _matrices[project_id] = adjacency
+    return adjacency
+
+def _project_skeletons(cursor, project_id, skeleton_ids):
+    """ Returns the set of those of the passed in skeletons that have
+    treenodes in the project. """
+    cursor.execute('''
+    SELECT skeleton_id
+    FROM skeleton_summary
+    WHERE project_id = %s
+      AND skeleton_id = ANY(%s::bigint[])
+    ''', (project_id, list(set(int(skid) for skid in skeleton_ids))))
+    return set(row[0] for row in cursor.fetchall())
+
+def skeleton_edges(project_id, skeleton_ids, cursor=None):
+    """ Returns a list of (presynaptic skeleton ID, postsynaptic skeleton ID,
+    number of synapses) tuples of the synapses between the passed in
+    skeletons, like AdjacencyMatrix.edges, without building the matrix of the
+    whole project. """
+    project_id = int(project_id)
+    cursor = cursor or connection.cursor()
+    skeleton_ids = _project_skeletons(cursor, project_id, skeleton_ids)
+    relations = _synapse_relations(cursor, project_id)
+    if not skeleton_ids or len(relations) != 2:
+        return []
+    return [(pre, post, count) for pre, post, count in partner_links(
+            skeleton_ids, relations['presynaptic_to'],
+            relations['postsynaptic_to'], cursor) if post in skeleton_ids]
+
+def synapse_partners(project_id, skeleton_ids, downstream=True, upstream=True,
+        cursor=None):
+    """ Returns the set of skeletons that the passed in skeletons make synapses
+    onto (downstream) and/or that make synapses onto them (upstream), without
+    building the matrix of the whole project. """
+    project_id = int(project_id)
+    cursor = cursor or connection.cursor()
+    skeleton_ids = _project_skeletons(cursor, project_id, skeleton_ids)
+    relations = _synapse_relations(cursor, project_id)
+    if not skeleton_ids or len(relations) != 2:
+        return set()
+    pre, post = relations['presynaptic_to'], relations['postsynaptic_to']
+    partners = set()
+    if downstream:
+        partners.update(row[1] for row in
+                partner_links(skeleton_ids, pre, post, cursor))
+    if upstream:
+        partners.update(row[1] for row in
+                partner_links(skeleton_ids, post, pre, cursor))
+    return partners
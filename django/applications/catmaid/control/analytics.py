@@ -1,21 +1,35 @@
 import json
 
-from collections import namedtuple, defaultdict
-from itertools import chain, islice
-from functools import partial
-from networkx import Graph, single_source_shortest_path
+from collections import defaultdict
+from itertools import chain
+from multiprocessing import Pool, cpu_count
+from threading import Lock
 
-from django.db import connection
+import numpy as np
+from scipy.sparse import csr_matrix, identity
+
+from django.db import connection, transaction
 from django.http import HttpResponse
 
+from catmaid.control.adjacency import synapse_partners
 from catmaid.control.authentication import requires_user_role
 from catmaid.models import UserRole
 
+# Skeleton lists of at least this length are analyzed in parallel
+PARALLEL_ANALYSIS_MIN_SKELETONS = 20
+
+# The number of processes of the analysis pool. Each web server process starts
+# at most one such pool, which is shared by all of its requests.
+ANALYSIS_PROCESSES = min(4, cpu_count())
+
+_pool = None
+_pool_lock = Lock()
+
+@transaction.non_atomic_requests
 @requires_user_role(UserRole.Browse)
 def analyze_skeletons(request, project_id=None):
     project_id = int(project_id)
     skids = [int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids[')]
-    s_skids = ",".join(map(str, skids))
     extra = int(request.POST.get('extra', 0))
     adjacents = int(request.POST.get('adjacents', 0))
 
@@ -24,36 +38,11 @@ def analyze_skeletons(request, project_id=None):
 
     cursor = connection.cursor()
 
-    query = '''
-        SELECT tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2,
-             relation r1,
-             relation r2
-        WHERE tc1.skeleton_id IN (%s)
-          AND tc1.relation_id = r1.id
-          AND %s
-          AND tc1.connector_id = tc2.connector_id
-          AND tc2.relation_id = r2.id
-          AND %s
-        GROUP BY tc2.skeleton_id'''
-
-    if 0 == extra:
-        # Just skids
-        pass
-    elif 1 == extra:
-        # Include downstream skeletons
-        cursor.execute(query % (s_skids, "r1.relation_name = 'presynaptic_to'", "r2.relation_name = 'postsynaptic_to'"))
-        skids.extend([s[0] for s in cursor.fetchall()])
-    elif 2 == extra:
-        # Include upstream skeletons
-        cursor.execute(query % (s_skids, "r1.relation_name = 'postsynaptic_to'", "r2.relation_name = 'presynaptic_to'"))
-        skids.extend([s[0] for s in cursor.fetchall()])
-    elif 3 == extra:
-        # Include both upstream and downstream skeletons
-        cursor.execute(query % (s_skids, "(r1.relation_name = 'presynaptic_to' OR r1.relation_name = 'postsynaptic_to')", "(r2.relation_name = 'presynaptic_to' OR r2.relation_name = 'postsynaptic_to')"))
-        skids.extend([s[0] for s in cursor.fetchall()])
-
+    if extra in (1, 2, 3):
+        # Include downstream (1), upstream (2) or both (3) skeletons
+        partners = synapse_partners(project_id, skids, extra & 1, extra & 2,
+                cursor)
+        skids.extend(sorted(partners.difference(skids)))
 
     # Obtain neuron names
     cursor.execute('''
@@ -66,9 +55,10 @@ def analyze_skeletons(request, project_id=None):
       AND cici.relation_id = r.id
       AND r.relation_name = 'model_of'
     ''' % ",".join(map(str, skids)))
+    names = dict(cursor.fetchall())
 
-    blob = {'issues': tuple((skid, _analyze_skeleton(project_id, skid, adjacents)) for skid in skids),
-            'names': dict(cursor.fetchall()),
+    blob = {'issues': tuple(_analyze_skeletons(project_id, skids, adjacents)),
+            'names': names,
             0: "Autapse",
             1: "Two or more times postsynaptic to the same connector",
             2: "Connector without postsynaptic targets",
@@ -80,73 +70,171 @@ def analyze_skeletons(request, project_id=None):
 
     return HttpResponse(json.dumps(blob))
 
-def _analyze_skeleton(project_id, skeleton_id, adjacents):
-    """ Takes a skeleton and returns a list of potentially problematic issues,
-    as a list of tuples of two values: issue type and treenode ID.
+def _analyze_skeletons(project_id, skeleton_ids, adjacents):
+    """ Takes a list of skeletons and returns a list of tuples of skeleton ID
+    and a list of potentially problematic issues, which are tuples of two
+    values: issue type and treenode ID. The data of all skeletons is fetched at
+    once, larger lists of skeletons are then analyzed in a process pool.
     adjacents: the number of nodes in the paths starting at a node when checking for duplicated connectors.
     """
     project_id = int(project_id)
-    skeleton_id = int(skeleton_id)
-    cursor = connection.cursor()
-
-    PRE = 'presynaptic_to'
-    POST = 'postsynaptic_to'
-
+    skeleton_ids = [int(skid) for skid in skeleton_ids]
+
+    # All data is read from one snapshot, so that links and treenodes match.
+    # The view doesn't run in a request transaction for this, and so that the
+    # analysis pool can be created.
+    in_transaction = connection.in_atomic_block
+    with transaction.atomic():
+        cursor = connection.cursor()
+        if not in_transaction:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        PRE, POST, skeleton_connectors, links, nodes = _fetch_skeletons(
+                cursor, project_id, skeleton_ids)
+
+    tasks = [(skid, PRE, POST,
+              dict((cid, links[cid]) for cid in skeleton_connectors[skid]),
+              nodes[skid], adjacents) for skid in skeleton_ids]
+
+    pool = _analysis_pool() \
+            if len(tasks) >= PARALLEL_ANALYSIS_MIN_SKELETONS else None
+    if pool:
+        issues = pool.map(_skeleton_issues, tasks)
+    else:
+        issues = map(_skeleton_issues, tasks)
+
+    return zip(skeleton_ids, issues)
+
+def _analysis_pool():
+    """ Returns the process pool for the analysis, which is created on first
+    use, or None if the analysis has to run in this process. Workers don't
+    access the database. The connection of this process is closed before they
+    are forked, so that they don't share it. This isn't possible within a
+    transaction. """
+    global _pool
+    if ANALYSIS_PROCESSES == 1:
+        return None
+    with _pool_lock:
+        if _pool is None and not connection.in_atomic_block:
+            connection.close()
+            _pool = Pool(ANALYSIS_PROCESSES)
+        return _pool
+
+def _fetch_skeletons(cursor, project_id, skeleton_ids):
+    """ Returns the presynaptic and postsynaptic relation IDs, a dictionary of
+    skeleton ID vs connector IDs, one of connector ID vs its (relation ID,
+    treenode ID, skeleton ID) links and one of skeleton ID vs (treenode ID,
+    parent ID, tag) rows. """
     # Retrieve relation IDs vs names
     cursor.execute('''
-    SELECT id, relation_name
+    SELECT relation_name, id
     FROM relation
     WHERE project_id = %s
-      AND (relation_name = '%s'
-           OR relation_name = '%s')
-    ''' % (project_id, PRE, POST))
-
-    relations = {} # both ways
+      AND (relation_name = 'presynaptic_to'
+           OR relation_name = 'postsynaptic_to')
+    ''', (project_id,))
+    relations = dict(cursor.fetchall())
+    PRE = relations['presynaptic_to']
+    POST = relations['postsynaptic_to']
+
+    # Retrieve all connectors of the skeletons and all of their pre- and
+    # postsynaptic links.
+    cursor.execute('''
+    SELECT DISTINCT skeleton_id, connector_id
+    FROM treenode_connector
+    WHERE skeleton_id = ANY(%s::bigint[])
+      AND relation_id = ANY(%s::bigint[])
+    ''', (skeleton_ids, [PRE, POST]))
+    skeleton_connectors = defaultdict(list)
     for row in cursor.fetchall():
-        relations[row[0]] = row[1]
-        relations[row[1]] = row[0]
+        skeleton_connectors[row[0]].append(row[1])
 
-    # Transform strings to integer IDs
-    PRE = relations[PRE]
-    POST = relations[POST]
+    cursor.execute('''
+    SELECT connector_id, relation_id, treenode_id, skeleton_id
+    FROM treenode_connector
+    WHERE connector_id = ANY(%s::bigint[])
+      AND relation_id = ANY(%s::bigint[])
+    ''', (list(set(chain.from_iterable(skeleton_connectors.itervalues()))),
+          [PRE, POST]))
+    links = defaultdict(list)
+    for row in cursor.fetchall():
+        links[row[0]].append(row[1:])
 
-    # Retrieve all connectors and their associated pre- or postsynaptic treenodes,
-    # plus the parent treenodes of these.
+    # Fetch data for type 4 and 5: all treenodes, with tags if any
     cursor.execute('''
-    SELECT tc1.connector_id,
-           tc1.relation_id,
-           t1.id,
-           t1.skeleton_id,
-           tc2.relation_id,
-           t2.id,
-           t2.skeleton_id
-    FROM treenode_connector tc1,
-         treenode_connector tc2,
-         treenode t1,
-         treenode t2
-    WHERE tc1.skeleton_id = %s
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.treenode_id = t1.id
-      AND tc2.treenode_id = t2.id
-      AND (tc1.relation_id = %s OR tc1.relation_id = %s)
-      AND (tc2.relation_id = %s OR tc2.relation_id = %s)
-    ''' % (skeleton_id,
-           str(PRE), str(POST),
-           str(PRE), str(POST)))
-
-    Treenode = namedtuple('Treenode', ['id', 'skeleton_id'])
-
-    # Map of connector_id vs {pre: {Treenode, ...}, post: {Treenode, ...}}
-    connectors = defaultdict(partial(defaultdict, set))
-
-    # Condense rows to connectors represented by a map with two entries (PRE and POST),
-    # each containing as value a set of Treenode:
+    SELECT treenode.skeleton_id,
+           treenode.id,
+           treenode.parent_id,
+           class_instance.name
+    FROM treenode
+             LEFT OUTER JOIN
+                 (treenode_class_instance INNER JOIN relation ON (treenode_class_instance.relation_id = relation.id AND relation.relation_name = 'labeled_as') INNER JOIN class_instance ON (treenode_class_instance.class_instance_id = class_instance.id))
+             ON (treenode_class_instance.treenode_id = treenode.id)
+    WHERE treenode.skeleton_id = ANY(%s::bigint[])
+    ''', (skeleton_ids,))
+    nodes = defaultdict(list)
     for row in cursor.fetchall():
-        s = connectors[row[0]]
-        s[row[1]].add(Treenode(row[2], row[3]))
-        # The 'other' could be null
-        if row[4]:
-            s[row[4]].add(Treenode(row[5], row[6]))
+        nodes[row[0]].append(row[1:])
+
+    return PRE, POST, skeleton_connectors, links, nodes
+
+def _neighborhoods(node_ids, parent_ids, rows, adjacents):
+    """ Returns a sparse matrix with a row for each of the passed in rows of
+    node_ids, which marks all nodes that are at most adjacents edges away from
+    the respective node. """
+    n = len(node_ids)
+    reach = csr_matrix((np.ones(len(rows), dtype=np.int32),
+            (np.arange(len(rows)), rows)), shape=(len(rows), n))
+    if adjacents > 0:
+        children = np.flatnonzero(parent_ids >= 0)
+        parents = np.searchsorted(node_ids, parent_ids[children])
+        edges = csr_matrix((np.ones(len(children), dtype=np.int32),
+                (children, parents)), shape=(n, n))
+        step = (edges + edges.transpose() + identity(n, dtype=np.int32)).tocsr()
+        for i in xrange(adjacents):
+            reach = reach * step
+            reach.data[:] = 1
+    return reach
+
+def _duplicated(node_ids, parent_ids, connectors, adjacents):
+    """ Takes a list of (treenode ID, partner skeleton IDs) tuples of
+    connectors and returns a list of pairs of indices into it, for all
+    connectors whose treenode neighborhoods overlap and which share a partner
+    skeleton. """
+    if len(connectors) < 2:
+        return []
+    rows = np.searchsorted(node_ids, [c[0] for c in connectors])
+    reach = _neighborhoods(node_ids, parent_ids, rows, adjacents)
+
+    partner_ids = sorted(set(chain.from_iterable(c[1] for c in connectors)))
+    columns = dict((skid, i) for i, skid in enumerate(partner_ids))
+    entries = [(i, columns[skid]) for i, c in enumerate(connectors)
+               for skid in c[1]]
+    partners = csr_matrix((np.ones(len(entries), dtype=np.int32),
+            (np.array([e[0] for e in entries], dtype=np.int64),
+             np.array([e[1] for e in entries], dtype=np.int64))),
+            shape=(len(connectors), max(len(partner_ids), 1)))
+
+    shared = (reach * reach.transpose()).multiply(
+            partners * partners.transpose()).tocoo()
+    return sorted((i, j) for i, j in zip(shared.row, shared.col) if i < j)
+
+def _skeleton_issues(task):
+    """ Takes a tuple of skeleton ID, presynaptic and postsynaptic relation
+    IDs, a dictionary of connector ID vs a list of (relation ID, treenode ID,
+    skeleton ID) links, a list of (treenode ID, parent ID, tag) rows and the
+    number of adjacent nodes and returns the list of issues of the skeleton.
+    This runs without a database connection, possibly in a separate process.
+    """
+    skeleton_id, PRE, POST, links, node_rows, adjacents = task
+
+    # Map of connector_id vs {pre: [(treenode ID, skeleton ID), ...], post: [...]},
+    # ordered by treenode ID
+    connectors = {}
+    for connector_id, connector_links in links.iteritems():
+        c = connectors[connector_id] = {PRE: set(), POST: set()}
+        for relation_id, treenode_id, skid in connector_links:
+            c[relation_id].add((treenode_id, skid))
+        c[PRE], c[POST] = sorted(c[PRE]), sorted(c[POST])
 
     issues = []
 
@@ -156,114 +244,67 @@ def _analyze_skeleton(project_id, skeleton_id, adjacents):
     for connector_id, connector in connectors.iteritems():
         pre = connector[PRE]
         post = connector[POST]
-        if pre and post:
-            for a in pre:
-                for b in post:
-                    if a.skeleton_id == b.skeleton_id:
-                        # Type 0: autapse
-                        issues.append((0, a.id if a.skeleton_id == skeleton_id else b.id))
+        for a in pre:
+            for b in post:
+                if a[1] == b[1]:
+                    # Type 0: autapse
+                    issues.append((0, a[0] if a[1] == skeleton_id else b[0]))
         if not post:
             # Type 2: presynaptic connector without postsynaptic treenodes
-            issues.append((2, iter(pre).next().id))
+            issues.append((2, pre[0][0]))
         if not pre:
             # Type 3: postsynaptic connector without presynaptic treenode
-            issues.append((3, iter(post).next().id))
+            issues.append((3, post[0][0]))
         else:
-            if iter(pre).next().skeleton_id != skeleton_id:
-                repeats = tuple(t.id for t in post if t.skeleton_id == skeleton_id)
+            if pre[0][1] != skeleton_id:
+                repeats = tuple(t[0] for t in post if t[1] == skeleton_id)
                 if len(repeats) > 1:
                     # Type 1: two or more times postsynaptic to the same connector
                     issues.append((1, repeats[0]))
             else:
                 pre_connector_ids.add(connector_id)
 
-    # Fetch data for type 4 and 5: all treenode, with tags if any
-    cursor.execute('''
-    SELECT treenode.id,
-           treenode.parent_id,
-           class_instance.name
-    FROM treenode
-             LEFT OUTER JOIN
-                 (treenode_class_instance INNER JOIN relation ON (treenode_class_instance.relation_id = relation.id AND relation.relation_name = 'labeled_as') INNER JOIN class_instance ON (treenode_class_instance.class_instance_id = class_instance.id))
-             ON (treenode_class_instance.treenode_id = treenode.id)
-    WHERE treenode.skeleton_id = %s
-    ''' % skeleton_id)
-
     # Collapse repeated rows into nodes with none or more tags
-    nodes = {}
-    parents = set()
-    root = None
-    for row in cursor.fetchall():
-        node = nodes.get(row[0])
-        if node:
-            # Append tag
-            node[1].append(row[2])
-        else:
-            nodes[row[0]] = (row[1], [row[2]])
-
-        if row[1]:
-            parents.add(row[1])
-        else:
-            root = row[0]
-
+    tags = defaultdict(set)
+    parents = {}
+    for node_id, parent_id, tag in node_rows:
+        parents[node_id] = parent_id
+        tags[node_id].add(tag)
+    node_ids = np.array(sorted(parents), dtype=np.int64)
+    parent_ids = np.array([parents[node_id] or -1 for node_id in node_ids],
+            dtype=np.int64)
 
     # Type 4: potentially duplicated synapses (or triplicated, etc):
     # Check if two or more connectors share pre treenodes and post skeletons,
     # or pre skeletons and post treenodes,
-    # considering the treenode and its parent as a group.
-    if adjacents > 0:
-        graph = Graph()
-        for node_id, props in nodes.iteritems():
-            if props[0]:
-                # Nodes are added automatically
-                graph.add_edge(props[0], node_id)
-    else:
-        graph = None
-
-    Connector = namedtuple("Connector", ['id', 'treenode_id', 'treenodes', 'skeletons'])
-
-    # Check if there are any duplicated presynaptic connectors
+    # considering the treenode and its neighbors within adjacents as a group.
     pre_connectors = []
-    for connector_id in pre_connector_ids:
-        c = connectors[connector_id]
-        treenode_id = iter(c[PRE]).next().id
-        pre_treenodes = set(chain.from_iterable(single_source_shortest_path(graph, treenode_id, adjacents).values()))
-        post_skeletons = set(t.skeleton_id for t in c[POST])
-        pre_connectors.append(Connector(connector_id, treenode_id, pre_treenodes, post_skeletons))
-
-    def issue4s(cs):
-        for i, c1 in enumerate(cs):
-            for c2 in islice(cs, i+1, None):
-                if (c1.treenodes & c2.treenodes) and (c1.skeletons & c2.skeletons):
-                    # Type 4: potentially duplicated connector
-                    issues.append((4, c1.treenode_id))
-                    if c1.treenode_id != c2.treenode_id:
-                        issues.append((4, c2.treenode_id))
-
-    issue4s(pre_connectors)
-
-    # Check if there are any duplicated postsynaptic connectors
     post_connectors = []
-    for connector_id, c in connectors.iteritems():
+    for connector_id, c in sorted(connectors.iteritems()):
         if connector_id in pre_connector_ids:
-            continue
-        treenode_id = (t.id for t in c[POST] if t.skeleton_id == skeleton_id).next()
-        pre_skeletons = set(t.skeleton_id for t in c[PRE])
-        post_treenodes = set(chain.from_iterable(single_source_shortest_path(graph, treenode_id, adjacents).values()))
-        post_connectors.append(Connector(connector_id, treenode_id, post_treenodes, pre_skeletons))
-
-    issue4s(post_connectors)
+            pre_connectors.append((c[PRE][0][0], set(t[1] for t in c[POST])))
+        else:
+            own = [t[0] for t in c[POST] if t[1] == skeleton_id]
+            if own:
+                post_connectors.append((own[0], set(t[1] for t in c[PRE])))
 
+    for cs in (pre_connectors, post_connectors):
+        for i, j in _duplicated(node_ids, parent_ids, cs, adjacents):
+            # Type 4: potentially duplicated connector
+            issues.append((4, cs[i][0]))
+            if cs[i][0] != cs[j][0]:
+                issues.append((4, cs[j][0]))
 
     # Type 5: end node without a tag
     # Type 6: node with a TODO tag
     # Type 7: root, slab or branch node with a tag like 'ends', 'not a branch', 'uncertain end', or 'uncertain continuation'
     end_labels = set(['ends', 'not a branch', 'uncertain end', 'uncertain continuation', 'soma', 'nerve out'])
-    if root in parents:
-        parents.remove(root) # Consider the root as a leaf node
-    for node_id, props in nodes.iteritems():
-        labels = set(props[1])
-        if node_id not in parents:
+    # The root is considered as a leaf node
+    leaves = node_ids[~np.in1d(node_ids, parent_ids) | (parent_ids == -1)]
+    leaves = set(leaves.tolist())
+    for node_id in node_ids.tolist():
+        labels = tags[node_id]
+        if node_id in leaves:
             if not (labels & end_labels):
                 # Type 5: node is a leaf without an end-node label
                 issues.append((5, node_id))
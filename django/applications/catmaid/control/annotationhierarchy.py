@@ -0,0 +1,88 @@
+""" The hierarchy of the annotations of a project, i.e. which annotations are
+annotated with which other annotations.
+
+The annotated_with links between annotations are loaded once per process and
+project. The sub-annotations of an annotation (all annotations that are
+annotated with it, directly or through other annotations) are kept once they
+have been looked up. A database trigger gives a project a new
+AnnotationHierarchyVersion whenever such a link is created, changed or
+removed (e.g. by _annotate_entities and remove_annotation of
+catmaid.control.neuron_annotations), which makes the cached hierarchy of the
+project be rebuilt on its next use.
+"""
+
+from collections import defaultdict
+
+from django.db import connection
+
+
+_hierarchies = {}
+
+
+class AnnotationHierarchy(object):
+    """ The annotated_with links between the annotations of a project. """
+
+    def __init__(self, project_id, version, links):
+        """ links: a sequence of (annotation ID, sub-annotation ID) tuples,
+        with each sub-annotation being annotated with the annotation. """
+        self.project_id = project_id
+        self.version = version
+        self.children = defaultdict(set)
+        for annotation_id, sub_annotation_id in links:
+            self.children[annotation_id].add(sub_annotation_id)
+        self._closures = {}
+
+    def sub_annotation_ids(self, annotation_id):
+        """ Returns a frozenset with the IDs of all annotations that are
+        annotated with the passed in annotation, directly or transitively.
+        The annotation itself is only part of it if the hierarchy has a cycle
+        through it. """
+        closure = self._closures.get(annotation_id)
+        if closure is None:
+            found = set()
+            working_set = [annotation_id]
+            while working_set:
+                for child_id in self.children.get(working_set.pop(), ()):
+                    if child_id in found:
+                        continue
+                    found.add(child_id)
+                    # Reuse the sub-annotations of children looked up before
+                    known = self._closures.get(child_id)
+                    if known is None:
+                        working_set.append(child_id)
+                    else:
+                        found.update(known)
+            closure = self._closures[annotation_id] = frozenset(found)
+        return closure
+
+
+def project_hierarchy(project_id, cursor=None):
+    """ Returns an up to date AnnotationHierarchy of the passed in project. """
+    project_id = int(project_id)
+    cursor = cursor or connection.cursor()
+    cursor.execute('''
+    SELECT version
+    FROM annotation_hierarchy_version
+    WHERE project_id = %s
+    ''', (project_id,))
+    row = cursor.fetchone()
+    version = row[0] if row else None
+
+    hierarchy = _hierarchies.get(project_id)
+    if hierarchy is None or hierarchy.version != version:
+        cursor.execute('''
+        SELECT cici.class_instance_b, cici.class_instance_a
+        FROM class_instance_class_instance cici
+        JOIN relation r ON r.id = cici.relation_id
+        JOIN class_instance a ON a.id = cici.class_instance_a
+        JOIN class_instance b ON b.id = cici.class_instance_b
+        JOIN class ca ON ca.id = a.class_id
+        JOIN class cb ON cb.id = b.class_id
+        WHERE cici.project_id = %s
+          AND r.relation_name = 'annotated_with'
+          AND ca.class_name = 'annotation'
+          AND cb.class_name = 'annotation'
+        ''', (project_id,))
+        hierarchy = AnnotationHierarchy(project_id, version, cursor.fetchall())
+        _hierarchies[project_id] = hierarchy
+    return hierarchy
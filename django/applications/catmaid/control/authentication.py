@@ -1,5 +1,6 @@
 import re
 import json
+import time
 
 from functools import wraps
 from itertools import groupby
@@ -15,6 +16,8 @@ from django.contrib.auth import authenticate, logout, login
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.forms import UserCreationForm
 from django.db import connection
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.http import HttpResponse, HttpResponseRedirect
 from django.core.exceptions import ObjectDoesNotExist
 from django.shortcuts import _get_queryset, render
@@ -318,29 +321,69 @@ def can_edit_all_or_fail(user, ob_ids, table_name):
 
 def user_can_edit(cursor, user_id, other_user_id):
     """ Determine whether the user with id 'user_'id' can edit the work of the user with id 'other_user_id'. This will be the case when the user_id belongs to a group whose name is identical to ther username of other_user_id.
-    This function is equivalent to 'other_user_id in user_domain(cursor, user_id), but consumes less resources."""
+    This function is equivalent to 'other_user_id in user_domain(cursor, user_id)', whose result is cached for further checks."""
     # The group with identical name to the username is implicit, doesn't have to exist. Therefore, check this edge case before querying:
     if user_id == other_user_id:
         return True
-    # Retrieve a value larger than zero when the user_id belongs to a group with name equal to that associated with other_user_id
-    cursor.execute("""
-    SELECT count(*)
-    FROM auth_user u,
-         auth_group g,
-         auth_user_groups ug
-    WHERE u.id = %s
-      AND u.username = g.name
-      AND g.id = ug.group_id
-      AND ug.user_id = %s
-    """ % (other_user_id, user_id))
-    rows = cursor.fetchall()
-    return rows and rows[0][0] > 0
+    return other_user_id in user_domain(cursor, user_id)
+
+
+# An in-process cache of user domains, mapping a user ID to a tuple of
+# expiration time and domain. Entries are removed when group memberships,
+# groups or user names change (in this process), other processes pick up these
+# changes after USER_DOMAIN_CACHE_TIMEOUT seconds.
+_user_domain_cache = {}
+
+def _cached_user_domain(user_id):
+    """ Returns the cached domain of a user or None if it isn't available. """
+    entry = _user_domain_cache.get(user_id)
+    if entry and entry[0] > time.time():
+        return entry[1]
+    return None
+
+def invalidate_user_domains(user_ids=None):
+    """ Removes the cached domains of the given users or of all users if no
+    user IDs are passed in. """
+    if user_ids is None:
+        _user_domain_cache.clear()
+    else:
+        for user_id in user_ids:
+            _user_domain_cache.pop(user_id, None)
+
+@receiver(m2m_changed, sender=User.groups.through)
+def _group_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_user_domains([instance.id])
+    elif pk_set is not None:
+        invalidate_user_domains(pk_set)
+    else:
+        invalidate_user_domains()
 
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=User)
+def _groups_changed(sender, **kwargs):
+    # Domains are based on names, which can change with every update.
+    invalidate_user_domains()
+
+@receiver(post_save, sender=User)
+def _user_changed(sender, update_fields=None, **kwargs):
+    # Ignore updates that can't change the user name, like logins.
+    if not update_fields or 'username' in update_fields:
+        invalidate_user_domains()
 
 def user_domain(cursor, user_id):
     """ This function returns the set of all other user_id, including the self, that the user has edit rights on via group membership.
     A user can edit nodes of other user(s) when the user belongs to a group named like that other user(s). Belonging to the self group is implicit, and therefore the self group--a group named like the user--doesn't have to exist; the user_id is added to the set in all cases.
-    If a user can only edit its own nodes, then the returned set contains only its own user_id. """
+    If a user can only edit its own nodes, then the returned set contains only its own user_id.
+    Domains are cached for USER_DOMAIN_CACHE_TIMEOUT seconds, the returned set
+    must therefore not be modified. """
+    domain = _cached_user_domain(user_id)
+    if domain is not None:
+        return domain
+
     cursor.execute("""
     SELECT u2.id
     FROM auth_user u1,
@@ -354,6 +397,12 @@ def user_domain(cursor, user_id):
     """ % int(user_id))
     domain = set(row[0] for row in cursor.fetchall())
     domain.add(user_id)
+    domain = frozenset(domain)
+
+    if settings.USER_DOMAIN_CACHE_TIMEOUT:
+        _user_domain_cache[user_id] = (
+                time.time() + settings.USER_DOMAIN_CACHE_TIMEOUT, domain)
+
     return domain
 
 @requires_user_role([UserRole.Annotate])
@@ -1,32 +1,27 @@
 import json
-import networkx as nx
-
-from itertools import combinations
-from collections import defaultdict
-from functools import partial
+import time
 
 from django.db import connection
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 
 from catmaid.models import UserRole
+from catmaid.control.adjacency import project_adjacency
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.graphsearch import skeleton_graph
 from catmaid.control.skeleton import _neuronnames
 
-def _next_circle(skeleton_set, cursor):
-    """ Return a dictionary of skeleton IDs in the skeleton_set vs a dictionary of connected skeletons vs how many connections."""
-    cursor.execute('''
-    SELECT tc1.skeleton_id, tc1.relation_id, tc2.skeleton_id
-    FROM treenode_connector tc1,
-         treenode_connector tc2
-    WHERE tc1.skeleton_id in (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.skeleton_id != tc2.skeleton_id
-      AND tc1.relation_id != tc2.relation_id
-    ''' % ','.join(map(str, skeleton_set)))
-    connections = defaultdict(partial(defaultdict, partial(defaultdict, int)))
-    for row in cursor.fetchall():
-        connections[row[0]][row[1]][row[2]] += 1
-    return connections
+# The maximum number of paths returned by find_directed_paths, unless the
+# request asks for a different number
+MAX_PATHS = 10000
+
+# The number of seconds after which find_directed_paths stops searching
+PATH_SEARCH_TIME_BUDGET = 20
+
+def _skeleton_graph(project_id, cursor, mins, relations):
+    """ Return the SkeletonGraph of the project for the minimum numbers of
+    synapses of _clean_mins."""
+    return skeleton_graph(project_adjacency(project_id, cursor),
+            mins[relations['presynaptic_to']], mins[relations['postsynaptic_to']])
 
 def _clean_mins(request, cursor, project_id):
     min_pre  = int(request.POST.get('min_pre',  -1))
@@ -62,67 +57,37 @@ def circles_of_hell(request, project_id=None):
         raise Exception("No skeletons were provided.")
 
     cursor = connection.cursor()
-    mins, _ = _clean_mins(request, cursor, int(project_id))
-
-    current_circle = first_circle
-    all_circles = first_circle
-
-    while n_circles > 0 and current_circle:
-        n_circles -= 1
-        connections = _next_circle(current_circle, cursor)
-        next_circle = set(skID for c in connections.itervalues() for relationID, cs in c.iteritems() for skID, count in cs.iteritems() if count >= mins[relationID])
-        current_circle = next_circle - all_circles
-        all_circles = all_circles.union(next_circle)
+    mins, relations = _clean_mins(request, cursor, int(project_id))
+    graph = _skeleton_graph(project_id, cursor, mins, relations)
 
-    skeleton_ids = tuple(all_circles - first_circle)
+    skeleton_ids = tuple(graph.circles(first_circle, n_circles))
     return HttpResponse(json.dumps([skeleton_ids, _neuronnames(skeleton_ids, project_id)]))
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def find_directed_paths(request, project_id=None):
-    """ Given a set of two or more skeleton IDs, find directed paths of connected neurons between them, for a maximum inner path length as given (i.e. origin and destination not counted). A directed path means that all edges are of the same kind, e.g. presynaptic_to. """
+    """ Given a set of two or more skeleton IDs, find directed paths of connected neurons between them, for a maximum inner path length as given (i.e. origin and destination not counted). A directed path means that all edges are of the same kind, e.g. presynaptic_to.
+    Returns an object with the list of 'paths' and a 'truncated' flag, which is true if not all paths were searched. """
 
     sources = set(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     if len(sources) < 2:
         raise Exception('Need at least 2 skeleton IDs to find directed paths!')
 
     path_length = int(request.POST.get('n_circles', 1))
+    max_paths = int(request.POST.get('max_paths', MAX_PATHS))
     cursor = connection.cursor()
     mins, relations = _clean_mins(request, cursor, int(project_id))
-    presynaptic_to = relations['presynaptic_to']
-    graph = nx.DiGraph()
-    next_sources = sources
-    all_sources = sources
-    length = path_length
-
-    def rev_args(fn):
-        def f(arg1, arg2):
-            fn(arg2, arg1)
-        return f
-
-    # Create a graph by growing the sources
-    while length > 0 and next_sources:
-        length -= 1
-        next_circles = _next_circle(next_sources, cursor)
-        next_sources = set()
-        for skid1, c in next_circles.iteritems():
-            for relationID, targets in c.iteritems():
-                threshold = mins[relationID]
-                add_edge = graph.add_edge if relationID == presynaptic_to else rev_args(graph.add_edge)
-                for skid2, count in targets.iteritems():
-                    if count < threshold:
-                        continue
-                    add_edge(skid1, skid2)
-                    next_sources.add(skid2)
-        next_sources = next_sources - all_sources
-        all_sources = all_sources.union(next_sources)
-
-    # Find all directed paths between all pairs of inputs
-    all_paths = []
-    for start, end in combinations(sources, 2):
-        for paths in [nx.all_simple_paths(graph, start, end, path_length + 1),
-                      nx.all_simple_paths(graph, end, start, path_length + 1)]:
-            for path in paths:
-                all_paths.append(path)
-
-    return HttpResponse(json.dumps(all_paths))
+    graph = _skeleton_graph(project_id, cursor, mins, relations)
+
+    # Paths are streamed as a JSON list while they are found. It is followed
+    # by whether the search was cut short by max_paths or its time budget.
+    status = {'truncated': False}
+    paths = graph.directed_paths(sources, path_length + 1, max_paths,
+            time.time() + PATH_SEARCH_TIME_BUDGET, status)
+
+    def stream():
+        yield '{"paths": ['
+        for i, path in enumerate(paths):
+            yield (',' if i else '') + json.dumps(path)
+        yield '], "truncated": %s}' % json.dumps(status['truncated'])
 
+    return StreamingHttpResponse(stream(), content_type='text/json')
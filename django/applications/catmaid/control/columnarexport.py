@@ -0,0 +1,189 @@
+""" Columnar exports of the tracing data of a project into HDF5 files.
+
+Each exported table is a group of the file with one one-dimensional dataset
+per column, all of the same length. Datasets are chunked and compressed, and
+columns have fixed numeric types, which makes loading a whole table a single
+read per column. Missing parents of root nodes are stored as -1, times as
+microseconds since the epoch (UTC). The file's attributes hold the project ID,
+the format version and a JSON mapping of the project's relation names to IDs.
+
+Files are written by the catmaid_export_columnar management command and read
+with load_columnar.
+"""
+
+import json
+
+from contextlib import closing
+
+import h5py
+import numpy as np
+
+from django.db import connection, transaction
+
+from catmaid.control.tree_util import Arbor
+
+
+COLUMNAR_FORMAT_VERSION = 1
+
+# The number of rows per chunk of the datasets, which is also the number of
+# rows fetched from the database at once
+COLUMNAR_CHUNK_SIZE = 65536
+
+def _epoch(column):
+    return "(extract(epoch FROM %s) * 1000000)::bigint" % column
+
+# The exported tables, in order, as tuples of name, the (name, type,
+# expression) of each column and the rest of the query
+TABLES = (
+    ('treenode', (
+        ('id', np.int64, 't.id'),
+        ('parent_id', np.int64, 'coalesce(t.parent_id, -1)'),
+        ('skeleton_id', np.int64, 't.skeleton_id'),
+        ('location_x', np.float64, 't.location_x'),
+        ('location_y', np.float64, 't.location_y'),
+        ('location_z', np.float64, 't.location_z'),
+        ('radius', np.float32, 't.radius'),
+        ('confidence', np.int16, 't.confidence'),
+        ('user_id', np.int32, 't.user_id'),
+        ('editor_id', np.int32, 't.editor_id'),
+        ('creation_time', np.int64, _epoch('t.creation_time')),
+        ('edition_time', np.int64, _epoch('t.edition_time')),
+     ), 'FROM treenode t WHERE t.project_id = %s ORDER BY t.id'),
+    ('connector', (
+        ('id', np.int64, 'c.id'),
+        ('location_x', np.float64, 'c.location_x'),
+        ('location_y', np.float64, 'c.location_y'),
+        ('location_z', np.float64, 'c.location_z'),
+        ('confidence', np.int16, 'c.confidence'),
+        ('user_id', np.int32, 'c.user_id'),
+        ('editor_id', np.int32, 'c.editor_id'),
+        ('creation_time', np.int64, _epoch('c.creation_time')),
+        ('edition_time', np.int64, _epoch('c.edition_time')),
+     ), 'FROM connector c WHERE c.project_id = %s ORDER BY c.id'),
+    ('treenode_connector', (
+        ('id', np.int64, 'tc.id'),
+        ('treenode_id', np.int64, 'tc.treenode_id'),
+        ('connector_id', np.int64, 'tc.connector_id'),
+        ('skeleton_id', np.int64, 'tc.skeleton_id'),
+        ('relation_id', np.int64, 'tc.relation_id'),
+        ('confidence', np.int16, 'tc.confidence'),
+        ('user_id', np.int32, 'tc.user_id'),
+        ('creation_time', np.int64, _epoch('tc.creation_time')),
+        ('edition_time', np.int64, _epoch('tc.edition_time')),
+     ), 'FROM treenode_connector tc WHERE tc.project_id = %s ORDER BY tc.id'),
+    ('review', (
+        ('id', np.int64, 'r.id'),
+        ('treenode_id', np.int64, 'r.treenode_id'),
+        ('skeleton_id', np.int64, 'r.skeleton_id'),
+        ('reviewer_id', np.int32, 'r.reviewer_id'),
+        ('review_time', np.int64, _epoch('r.review_time')),
+     ), 'FROM review r WHERE r.project_id = %s ORDER BY r.id'),
+    ('tag', (
+        ('id', np.int64, 'tci.id'),
+        ('treenode_id', np.int64, 'tci.treenode_id'),
+        ('label_id', np.int64, 'tci.class_instance_id'),
+        ('user_id', np.int32, 'tci.user_id'),
+        ('creation_time', np.int64, _epoch('tci.creation_time')),
+     ), '''FROM treenode_class_instance tci
+           JOIN relation r ON r.id = tci.relation_id
+           WHERE tci.project_id = %s AND r.relation_name = 'labeled_as'
+           ORDER BY tci.id'''),
+    ('label', (
+        ('id', np.int64, 'ci.id'),
+        ('name', unicode, 'ci.name'),
+     ), '''FROM class_instance ci
+           JOIN class c ON c.id = ci.class_id
+           WHERE ci.project_id = %s AND c.class_name = 'label'
+           ORDER BY ci.id'''),
+)
+
+TABLE_NAMES = tuple(name for name, _, _ in TABLES)
+
+
+def _write_table(group, query, project_id, columns, chunk_size):
+    """ Streams the rows of a query through a server-side cursor into one
+    resizable dataset per column. """
+    datasets = [group.create_dataset(name, shape=(0,), maxshape=(None,),
+            chunks=(chunk_size,), compression='gzip', shuffle=True,
+            dtype=h5py.special_dtype(vlen=unicode) if t is unicode else t)
+            for name, t, _ in columns]
+    dtype = [(str(name), object if t is unicode else t)
+            for name, t, _ in columns]
+
+    cursor = connection.connection.cursor('columnar_export')
+    try:
+        cursor.execute(query, (project_id,))
+        n = 0
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            values = np.array(rows, dtype=dtype)
+            for dataset, (name, _, _) in zip(datasets, columns):
+                dataset.resize((n + len(rows),))
+                dataset[n:] = values[name]
+            n += len(rows)
+    finally:
+        cursor.close()
+    return n
+
+def export_columnar(project_id, path, tables=TABLE_NAMES,
+        chunk_size=COLUMNAR_CHUNK_SIZE):
+    """ Writes the passed in tables of a project to a new HDF5 file and
+    returns a dictionary of table name vs number of rows. All tables are read
+    in one read-only transaction (or the one already open), so that they are
+    consistent with each other. """
+    project_id = int(project_id)
+    unknown = set(tables) - set(TABLE_NAMES)
+    if unknown:
+        raise ValueError("Unknown tables: %s" % ", ".join(sorted(unknown)))
+
+    counts = {}
+    in_transaction = connection.in_atomic_block
+    with transaction.atomic(), closing(h5py.File(path, 'w')) as hfile:
+        cursor = connection.cursor()
+        if not in_transaction:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        cursor.execute('''
+        SELECT relation_name, id FROM relation WHERE project_id = %s
+        ''', (project_id,))
+        hfile.attrs['project_id'] = project_id
+        hfile.attrs['format_version'] = COLUMNAR_FORMAT_VERSION
+        hfile.attrs['relations'] = json.dumps(dict(cursor.fetchall()))
+
+        for name, columns, rest in TABLES:
+            if name not in tables:
+                continue
+            query = 'SELECT %s %s' % (', '.join(c[2] for c in columns), rest)
+            counts[name] = _write_table(hfile.create_group(name), query,
+                    project_id, columns, chunk_size)
+            hfile[name].attrs['rows'] = counts[name]
+    return counts
+
+def load_columnar(path, tables=None):
+    """ Reads an HDF5 file written by export_columnar. Returns a dictionary
+    with a 'project_id' and 'relations' entry and, for each of the passed in
+    tables that are part of the file (or all of them), a dictionary of column
+    name vs numpy array. """
+    with closing(h5py.File(path, 'r')) as hfile:
+        version = hfile.attrs['format_version']
+        if version != COLUMNAR_FORMAT_VERSION:
+            raise ValueError("Unsupported columnar export version: %s" % version)
+        data = {
+            'project_id': int(hfile.attrs['project_id']),
+            'relations': json.loads(hfile.attrs['relations']),
+        }
+        for name in (TABLE_NAMES if tables is None else tables):
+            if name in hfile:
+                data[name] = {column: dataset[...]
+                        for column, dataset in hfile[name].iteritems()}
+    return data
+
+def treenode_arbor(data):
+    """ Returns an Arbor of all treenodes loaded with load_columnar, with their
+    locations and skeleton IDs as 'skeleton_id' property. """
+    treenodes = data['treenode']
+    return Arbor(treenodes['id'], treenodes['parent_id'],
+            np.column_stack((treenodes['location_x'], treenodes['location_y'],
+                treenodes['location_z'])),
+            {'skeleton_id': treenodes['skeleton_id']})
@@ -0,0 +1,272 @@
+""" Exports of the treenodes and synapses of all skeletons of a project.
+
+All skeletons with more than one treenode are exported. They are split into a
+fixed number of shards by skeleton ID, and each shard is written by a worker
+process into its own gzip compressed fragment file, in a short transaction of
+its own. Treenodes and synapses (which belong to the shard of their
+presynaptic skeleton) are streamed from the database, with COPY for CSV and a
+server-side cursor for GraphML. The final files are the concatenation of a
+header, all fragments and a footer, which is a valid gzip file again.
+
+Fragments are kept in a directory next to the exported files, together with a
+manifest that records the version of each exported skeleton: its
+edit_version and partners_version, which database triggers set to new values
+of sequences whenever its treenodes or its connector links change (see
+catmaid.control.nodeindex and catmaid.control.adjacency). A later export of
+the same project only rewrites the fragments of shards in which a skeleton was
+added, removed or changed.
+"""
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from multiprocessing import Pool
+
+from django.db import connection, transaction
+
+
+# The number of shards skeletons are split into
+EXPORT_SHARDS = 16
+
+# The number of rows fetched at once from server-side cursors
+EXPORT_FETCH_SIZE = 10000
+
+GRAPHML_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns"
+         xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+         xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">
+<key id="skid" for="node" attr.name="skeleton id" attr.type="long"/>
+<key id="x" for="node" attr.name="x" attr.type="float"/>
+<key id="y" for="node" attr.name="y" attr.type="float"/>
+<key id="z" for="node" attr.name="z" attr.type="float"/>
+<key id="pre_skid" for="edge" attr.name="presynaptic skeleton id" attr.type="long"/>
+<key id="post_skid" for="edge" attr.name="postsynaptic skeleton id" attr.type="long"/>
+<graph id="CNS">
+'''
+
+GRAPHML_FOOTER = '</graph>\n</graphml>'
+
+SKELETONS_CSV_HEADER = '"skeleton ID", "treenode ID", "parent treenode ID", "x", "y", "z"\n'
+
+SYNAPSES_CSV_HEADER = '"synapse ID", "presynaptic treenode ID", "presynaptic skeleton ID", "postsynaptic treenode ID", "postsynaptic skeleton ID"\n'
+
+# The parts each format consists of, as tuples of the name of the fragments,
+# the output file name pattern and the header and footer of the output file
+FORMATS = {
+    'csv': (('skeletons', '%(filename)s.%(project_id)s.skeletons.csv.gz',
+                SKELETONS_CSV_HEADER, ''),
+            ('synapses', '%(filename)s.%(project_id)s.synapses.csv.gz',
+                SYNAPSES_CSV_HEADER, '')),
+    'graphml': (('graph', '%(filename)s.gz', GRAPHML_HEADER, GRAPHML_FOOTER),),
+}
+
+
+def _shard_condition(project_id, n_shards, shard):
+    """ Returns an SQL condition on the skeleton summary 's' that selects the
+    exported skeletons of a shard. """
+    return 's.project_id = %d AND s.num_nodes > 1 AND s.skeleton_id %% %d = %d' % (
+            project_id, n_shards, shard)
+
+def _skeleton_versions(cursor, condition):
+    cursor.execute('''
+    SELECT s.skeleton_id, s.edit_version, s.partners_version
+    FROM skeleton_summary s
+    WHERE %s
+    ''' % condition)
+    return {str(row[0]): list(row[1:]) for row in cursor.fetchall()}
+
+def _copy(cursor, query, path):
+    """ Writes the result of a query as gzip compressed CSV to a file. """
+    with gzip.open(path, 'wb') as f:
+        cursor.copy_expert('COPY (%s) TO STDOUT WITH CSV' % query, f)
+
+def _stream(query, path, template, fields):
+    """ Writes the rows of a query to a gzip compressed file, each formatted
+    with the template after picking the passed in fields from it. The rows are
+    fetched in batches with a server-side cursor. """
+    cursor = connection.connection.cursor('connectome_export')
+    try:
+        cursor.execute(query)
+        with gzip.open(path, 'wb') as f:
+            while True:
+                rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                if not rows:
+                    break
+                f.write(''.join(template % tuple(row[i] for i in fields)
+                        for row in rows))
+    finally:
+        cursor.close()
+
+def _treenodes_query(condition):
+    return '''
+    SELECT t.skeleton_id, t.id, t.parent_id,
+           t.location_x, t.location_y, t.location_z
+    FROM treenode t
+    JOIN skeleton_summary s ON s.skeleton_id = t.skeleton_id
+    WHERE %s
+    ORDER BY t.skeleton_id, t.id''' % condition
+
+def _synapses_query(condition, relations):
+    return '''
+    SELECT tc2.id, tc1.treenode_id, tc1.skeleton_id,
+           tc2.treenode_id, tc2.skeleton_id
+    FROM treenode_connector tc1
+    JOIN treenode_connector tc2 ON tc2.connector_id = tc1.connector_id
+    JOIN skeleton_summary s ON s.skeleton_id = tc1.skeleton_id
+    WHERE %s
+      AND tc1.relation_id = %d
+      AND tc2.relation_id = %d
+    ORDER BY tc1.skeleton_id, tc2.id''' % (condition,
+            relations['presynaptic_to'], relations['postsynaptic_to'])
+
+def _export_shard(task):
+    """ Writes the fragments of one shard and returns the versions of the
+    skeletons written. All of it is read in a single read-only transaction
+    (or the one already open), so that the versions match the exported
+    data. """
+    project_id, relations, export_format, paths, n_shards, shard = task
+    condition = _shard_condition(project_id, n_shards, shard)
+    in_transaction = connection.in_atomic_block
+    with transaction.atomic():
+        cursor = connection.cursor()
+        if not in_transaction:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        versions = _skeleton_versions(cursor, condition)
+        if export_format == 'csv':
+            _copy(cursor, _treenodes_query(condition), paths['skeletons'])
+            _copy(cursor, _synapses_query(condition, relations),
+                    paths['synapses'])
+        else:
+            _stream(_treenodes_query(condition), paths['graph'] + '.nodes',
+                    '<node id="n%s">\n<data key="skid">%s</data>\n'
+                    '<data key="x">%s</data>\n<data key="y">%s</data>\n'
+                    '<data key="z">%s</data>\n</node>\n', (1, 0, 3, 4, 5))
+            _stream(_treenodes_query(condition + ' AND t.parent_id IS NOT NULL'),
+                    paths['graph'] + '.edges',
+                    '<edge id="e%s" directed="false" source="n%s" target="n%s" />\n',
+                    (1, 1, 2))
+            _stream(_synapses_query(condition, relations),
+                    paths['graph'] + '.synapses',
+                    '<edge id="e%s" directed="true" source="n%s" target="n%s">\n'
+                    '<data key="pre_skid">%s</data>\n'
+                    '<data key="post_skid">%s</data>\n</edge>\n',
+                    (0, 1, 3, 2, 4))
+            _concatenate(paths['graph'], [paths['graph'] + suffix
+                    for suffix in ('.nodes', '.edges', '.synapses')], True)
+    return shard, versions
+
+def _concatenate(path, fragment_paths, remove=False):
+    """ Concatenates gzip files into a new one, which replaces the file at path
+    once it is complete. """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for fragment_path in fragment_paths:
+                with open(fragment_path, 'rb') as fragment:
+                    shutil.copyfileobj(fragment, f)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    if remove:
+        for fragment_path in fragment_paths:
+            os.remove(fragment_path)
+
+def _write_gzip(path, text):
+    with gzip.open(path, 'wb') as f:
+        f.write(text)
+
+def _load_manifest(path, project_id, export_format, n_shards):
+    """ Returns the skeleton versions of a previous export with the same
+    parameters as a list with a dictionary for each shard. Missing or
+    incompatible manifests return None. """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if manifest.get('project_id') != project_id or \
+            manifest.get('format') != export_format or \
+            manifest.get('shards') != n_shards:
+        return None
+    return manifest['skeletons']
+
+def export(project_id, filename, export_format='csv', n_shards=EXPORT_SHARDS,
+        processes=None, incremental=True):
+    """ Exports all skeletons of a project with more than one treenode, either
+    as CSV files of treenodes and synapses or as one GraphML file, named as
+    in FORMATS. Unless incremental is false,
+    only shards that changed since the previous export are written again.
+    processes is the number of worker processes, None means one per CPU.
+    Returns the list of shards that were written. Each shard is read in a
+    transaction of its own, unless this is called within one, in which case
+    all shards are written by this process. """
+    project_id = int(project_id)
+    parts = FORMATS[export_format]
+    shard_dir = '%s.%s.%s-shards' % (filename, project_id, export_format)
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    manifest_path = os.path.join(shard_dir, 'manifest.json')
+
+    def fragment_paths(shard):
+        return {name: os.path.join(shard_dir, '%s.%s.gz' % (name, shard))
+                for name, _, _, _ in parts}
+
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT relation_name, id FROM relation WHERE project_id = %s
+    ''', (project_id,))
+    relations = dict(cursor.fetchall())
+
+    # Find the shards that changed since the last export
+    exported = _load_manifest(manifest_path, project_id, export_format,
+            n_shards) if incremental else None
+    if exported is None:
+        exported = [{} for shard in xrange(n_shards)]
+    current = [{} for shard in xrange(n_shards)]
+    for skeleton_id, version in _skeleton_versions(cursor,
+            's.project_id = %d AND s.num_nodes > 1' % project_id).iteritems():
+        current[int(skeleton_id) % n_shards][skeleton_id] = version
+    changed = [shard for shard in xrange(n_shards)
+            if current[shard] != exported[shard] or not all(os.path.exists(p)
+                for p in fragment_paths(shard).itervalues())]
+
+    tasks = [(project_id, relations, export_format, fragment_paths(shard),
+            n_shards, shard) for shard in changed]
+    if len(tasks) > 1 and processes != 1 and not connection.in_atomic_block:
+        # Workers open database connections of their own, which they mustn't
+        # share with this process. Closing it isn't possible within a
+        # transaction.
+        connection.close()
+        pool = Pool(processes)
+        try:
+            results = pool.map(_export_shard, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_export_shard(task) for task in tasks]
+    for shard, versions in results:
+        exported[shard] = versions
+
+    # Assemble the output files from a header, all fragments and a footer
+    for name, output, header, footer in parts:
+        header_path = os.path.join(shard_dir, '%s.header.gz' % name)
+        footer_path = os.path.join(shard_dir, '%s.footer.gz' % name)
+        _write_gzip(header_path, header)
+        _write_gzip(footer_path, footer)
+        _concatenate(output % {'filename': filename, 'project_id': project_id},
+                [header_path] + [fragment_paths(shard)[name]
+                    for shard in xrange(n_shards)] + [footer_path])
+
+    # Store the manifest only once the output is complete
+    fd, tmp_path = tempfile.mkstemp(dir=shard_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'project_id': project_id, 'format': export_format,
+                'shards': n_shards, 'skeletons': exported}, f)
+    os.rename(tmp_path, manifest_path)
+
+    return changed
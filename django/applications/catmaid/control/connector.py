@@ -15,6 +15,7 @@ from catmaid.models import Project, Stack, ProjectStack, Connector, \
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
 from catmaid.control.common import cursor_fetch_dictionary, \
         get_relation_to_id_map
+from catmaid.control import nodecache
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def graphedge_list(request, project_id=None):
@@ -467,6 +468,7 @@ def create_connector(request, project_id=None):
         location_z=float(query_parameters['z']),
         confidence=parsed_confidence)
     new_connector.save()
+    nodecache.invalidate_cells(project_id, connector_ids=[new_connector.id])
 
     return HttpResponse(json.dumps({'connector_id': new_connector.id}))
 
@@ -475,6 +477,7 @@ def create_connector(request, project_id=None):
 def delete_connector(request, project_id=None):
     connector_id = int(request.POST.get("connector_id", 0))
     can_edit_or_fail(request.user, connector_id, 'connector')
+    nodecache.invalidate_cells(project_id, connector_ids=[connector_id])
     Connector.objects.filter(id=connector_id).delete()
     return HttpResponse(json.dumps({
         'message': 'Removed connector and class_instances',
@@ -7,6 +7,7 @@ from collections import defaultdict
 from itertools import chain, ifilter
 from functools import partial
 from synapseclustering import  tree_max_density
+import numpy as np
 from numpy import subtract
 from numpy.linalg import norm
 from math import sqrt
@@ -17,8 +18,7 @@ from django.http import HttpResponse
 from catmaid.models import Relation, UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.review import get_treenodes_to_reviews
-from catmaid.control.tree_util import simplify, find_root, reroot, partition, \
-        spanning_tree, cable_length
+from catmaid.control.tree_util import Arbor, to_arbor
 
 def split_by_confidence_and_add_edges(confidence_threshold, digraphs, rows):
     """ dipgrahs is a dictionary of skeleton IDs as keys and DiGraph instances as values,
@@ -90,10 +90,12 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                 g.add_nodes_from(domain.node_ids) # bogus graph, containing treenodes that point to connectors
                 subdomains.append(g)
                 anchors[domain.local_max] = g
-            # Define edges between domains: create a simplified graph
-            mini = simplify(graph, anchors.keys())
+            # Define edges between domains: create a simplified arbor
+            arbor = to_arbor(graph)
+            mini = arbor.simplify(arbor.indices(anchors.keys()))
             # Replace each node by the corresponding graph, or a graph of a single node
-            for node in mini.nodes_iter():
+            gs = {}
+            for node in mini.ids.tolist():
                 g = anchors.get(node)
                 if not g:
                     # A branch node that was not an anchor, i.e. did not represent a synapse group
@@ -102,10 +104,10 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                     subdomains.append(g)
                 # Associate the Graph with treenodes that have connectors
                 # with the node in the minified tree
-                mini.node[node]['g'] = g
-            # Put the mini into a map of skeleton_id and list of minis,
+                gs[node] = g
+            # Put the mini and its graphs into a map of skeleton_id and list of minis,
             # to be used later for defining intra-neuron edges in the circuit graph
-            minis[skeleton_id].append(mini)
+            minis[skeleton_id].append((mini, gs))
 
     return arbors2, minis
 
@@ -247,7 +249,7 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
                     tc[treenodeID].inputs += 1
 
                 # Update the nPossibleIOPaths field in the Counts instance of each treenode
-                _node_centrality_by_synapse(arbor, tc, totalOutputs, totalInputs)
+                _node_centrality_by_synapse(to_arbor(arbor), tc, totalOutputs, totalInputs)
 
                 arbor.treenode_synapse_counts = tc
 
@@ -258,6 +260,9 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
         # as a function of the number of synapses and their location within the arbor.
         # Algorithm by Casey Schneider-Mizell
         # Implemented by Albert Cardona
+        # Arbors with locations of the DiGraphs of postsynaptic arbors
+        post_arbors = {}
+
         for pre_arbor, post_arbor, edge_props in circuit.edges_iter(data=True):
             if pre_arbor == post_arbor:
                 # Signal autapse
@@ -265,17 +270,20 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
                 continue
 
             try:
-                spanning = spanning_tree(post_arbor, edge_props['post_treenodes'])
+                arbor = post_arbors.get(post_arbor)
+                if arbor is None:
+                    arbor = post_arbors[post_arbor] = to_arbor(post_arbor, locations)
+                spanning = arbor.spanning_tree(arbor.indices(edge_props['post_treenodes']))
                 #for arbor in whole_arbors[circuit[post_arbor]['skeleton_id']]:
                 #    if post_arbor == arbor:
                 #        tc = arbor.treenode_synapse_counts
                 tc = post_arbor.treenode_synapse_counts
-                count = spanning.number_of_nodes()
+                count = len(spanning)
                 if count < 3:
-                    median_synapse_centrality = sum(tc[treenodeID].synapse_centrality for treenodeID in spanning.nodes_iter()) / count
+                    median_synapse_centrality = sum(tc[treenodeID].synapse_centrality for treenodeID in spanning.ids.tolist()) / count
                 else:
-                    median_synapse_centrality = sorted(tc[treenodeID].synapse_centrality for treenodeID in spanning.nodes_iter())[count / 2]
-                cable = cable_length(spanning, locations)
+                    median_synapse_centrality = sorted(tc[treenodeID].synapse_centrality for treenodeID in spanning.ids.tolist())[count / 2]
+                cable = spanning.cable_length()
                 if -1 == median_synapse_centrality:
                     # Signal not computable
                     edge_props['risk'] = -1
@@ -290,9 +298,8 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
     if expand and bandwidth > 0:
         # Add edges between circuit nodes that represent different domains of the same neuron
         for skeleton_id, list_mini in minis.iteritems():
-            for mini in list_mini:
-                for node in mini.nodes_iter():
-                    g = mini.node[node]['g']
+            for mini, gs in list_mini:
+                for node, g in gs.iteritems():
                     if 1 == len(g) and g.nodes_iter(data=True).next()[1].get('branch'):
                         # A branch node that was preserved in the minified arbor
                         circuit.add_node(g, {'id': '%s-%s' % (skeleton_id, node),
@@ -300,9 +307,9 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth, e
                                              'label': "", # "%s [%s]" % (names[skeleton_id], node),
                                              'node_count': 1,
                                              'branch': True})
-                for node1, node2 in mini.edges_iter():
-                    g1 = mini.node[node1]['g']
-                    g2 = mini.node[node2]['g']
+                for i in np.flatnonzero(mini.parents != -1):
+                    g1 = gs[mini.ids[i]]
+                    g2 = gs[mini.ids[mini.parents[i]]]
                     circuit.add_edge(g1, g2, {'c': 10, 'arrow': 'none', 'directed': False})
 
     return circuit
@@ -360,8 +367,7 @@ def _node_centrality_by_synapse_db(skeleton_id):
     ''' % skeleton_id)
 
     nodes = {} # node ID vs Counts
-    tree = nx.DiGraph()
-    root = None
+    parents = {} # node ID vs parent ID
     totalInputs = 0
     totalOutputs = 0
 
@@ -377,17 +383,15 @@ def _node_centrality_by_synapse_db(skeleton_id):
             elif 'postsynaptic_to' == row[2]:
                 counts.inputs += 1
                 totalInputs += 1
-        if row[1]:
-            tree.add_edge(row[0], row[1])
-        else:
-            root = row[0]
+        parents[row[0]] = row[1]
 
-    _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs)
+    arbor = Arbor(parents.keys(), parents.values())
+    _node_centrality_by_synapse(arbor, nodes, totalOutputs, totalInputs)
 
     return nodes
 
-def _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs):
-    """ tree: a DiGraph
+def _node_centrality_by_synapse(arbor, nodes, totalOutputs, totalInputs):
+    """ arbor: an Arbor, which is rerooted in place if necessary
         nodes: a dictionary of treenode ID vs Counts instance
         totalOutputs: the total number of output synapses of the tree
         totalInputs: the total number of input synapses of the tree
@@ -400,14 +404,12 @@ def _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs):
             counts.synapse_centrality = -1
         return
 
-    if len(tree.successors(find_root(tree))) > 1:
+    if arbor.child_count(arbor.roots()[0]) > 1:
         # Reroot at the first end node found
-        tree = tree.copy()
-        endNode = (nodeID for nodeID in nodes.iterkeys() if not tree.successors(nodeID)).next()
-        reroot(tree, endNode)
+        arbor.reroot(arbor.ends()[0])
 
-    # 2. Partition into sequences, sorted from small to large
-    sequences = sorted(partition(tree), key=len)
+    # 2. Partition into sequences of node IDs, sorted from small to large
+    sequences = sorted((arbor.ids[seq].tolist() for seq in arbor.partition()), key=len)
 
     # 3. Traverse all partitions counting synapses seen
     for seq in sequences:
@@ -12,6 +12,7 @@ from django.db import connection
 from django.http import HttpResponse
 
 from catmaid.models import UserRole
+from catmaid.control.adjacency import skeleton_edges
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.tree_util import simplify
 
@@ -19,60 +20,10 @@ def basic_graph(project_id, skeleton_ids):
     if not skeleton_ids:
         raise ValueError("No skeleton IDs provided")
 
-    cursor = connection.cursor()
-
-    cursor.execute('''
-    SELECT relation_name, id
-    FROM relation
-    WHERE project_id = %s
-      AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')
-    ''' % int(project_id))
-    relations = dict(cursor.fetchall())
-    preID, postID = relations['presynaptic_to'], relations['postsynaptic_to']
+    # Synapse counts between the skeletons, from the partner cache
+    edges = skeleton_edges(project_id, skeleton_ids)
 
-    cursor.execute('''
-    SELECT tc.connector_id, tc.relation_id, tc.skeleton_id
-    FROM treenode_connector tc
-    WHERE tc.project_id = %s
-      AND tc.skeleton_id IN (%s)
-    ''' % (int(project_id), ",".join(str(int(skid)) for skid in skeleton_ids)))
-
-    # stores entire query set in memory, linking pre and post
-    connectors = defaultdict(partial(defaultdict, list))
-    for row in cursor.fetchall():
-        connectors[row[0]][row[1]].append(row[2])
-
-    # Safe to placeholder, half-complete connectors:
-    # only adds the edge if both pre and post exist
-    edges = defaultdict(partial(defaultdict, int))
-    for c in connectors.itervalues():
-        for pre in c[preID]: # should be one or none
-            for post in c[postID]:
-                edges[pre][post] += 1
-
-    return {'edges': tuple((pre, post, count) for pre, edge in edges.iteritems() for post, count in edge.iteritems())}
-
-    '''
-    return {'edges': [{'source': pre,
-                       'target': post,
-                       'weight': count} for pre, edge in edges.iteritems() for post, count in edge.iteritems()]}
-    '''
-
-    """ Can't get the variable to be set with all the skeleton IDs
-    cursor.execute('''
-    WITH skeletons as (VALUES (%s) UNION ALL)
-    SELECT tc1.skeleton_id, tc2.skeleton_id, count(*)
-    FROM treenode_connector tc1,
-         treenode_connector tc2
-    WHERE tc1.project_id = %s
-      AND tc1.project_id = tc2.project_id
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.relation_id = %s
-      AND tc2.relation_id = %s
-      AND tc1.skeleton_id IN skeletons
-      AND tc2.skeleton_id IN skeletons
-    ''' % (",".join(str(int(skid)) for skid in skeleton_ids), int(project_id), preID, postID))
-    """
+    return {'edges': tuple(edges)}
 
 
 def confidence_split_graph(project_id, skeleton_ids, confidence_threshold):
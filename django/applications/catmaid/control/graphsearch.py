@@ -0,0 +1,173 @@
+""" Searches in the synaptic connectivity graph of a project.
+
+A SkeletonGraph is built from the adjacency matrix of a project (see
+catmaid.control.adjacency) and keeps only those connections that have at
+least a minimum number of synapses, separately for downstream and upstream
+partners. Its edges are stored as CSR arrays, so that the neighbors of a whole
+set of skeletons can be found with a few array operations. Graphs are cached
+in the process for as long as the adjacency matrix they were built from is up
+to date.
+"""
+
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+# The maximum number of skeleton graphs kept in memory
+MAX_CACHED_GRAPHS = 10
+
+_graphs = OrderedDict()
+
+
+def _thresholded(matrix, threshold):
+    """ Returns a CSR matrix of ones for all entries of at least threshold. """
+    coo = matrix.tocoo()
+    keep = coo.data >= threshold
+    return csr_matrix((np.ones(keep.sum(), dtype=np.int8),
+            (coo.row[keep], coo.col[keep])), shape=matrix.shape)
+
+def _neighbors(matrix, rows):
+    """ Returns an array of the columns of all entries in the passed in rows.
+    """
+    if not len(rows):
+        return np.empty(0, dtype=np.int64)
+    return np.unique(matrix[rows, :].indices)
+
+
+class SkeletonGraph(object):
+    """ The synaptic connections between all skeletons of a project. Each
+    skeleton is connected to the downstream partners it makes at least
+    min_downstream synapses onto and to the upstream partners that make at
+    least min_upstream synapses onto it. A threshold of infinity leaves out
+    the respective partners.
+    """
+
+    def __init__(self, adjacency, min_downstream, min_upstream):
+        self.adjacency = adjacency
+        self.skeleton_ids = adjacency.skeleton_ids
+        empty = csr_matrix(adjacency.matrix.shape, dtype=np.int8)
+        # Edges to downstream partners
+        self.downstream = empty if min_downstream == float('inf') else \
+                _thresholded(adjacency.matrix, min_downstream)
+        # Edges to upstream partners
+        self.upstream = empty if min_upstream == float('inf') else \
+                _thresholded(adjacency.matrix.transpose().tocsr(), min_upstream)
+        # The directed graph of synapses of either kind, in both directions
+        self.outgoing = (self.downstream + self.upstream.transpose()).tocsr()
+        self.incoming = self.outgoing.transpose().tocsr()
+
+    def rows(self, skeleton_ids):
+        """ Returns an array of the rows of the passed in skeletons, which
+        are part of the graph. """
+        return self.adjacency.indices(skeleton_ids)
+
+    def circles(self, skeleton_ids, n_circles):
+        """ Returns the IDs of all skeletons that are at most n_circles
+        connections away from the passed in skeletons, excluding these. Every
+        circle is found by expanding the previous one with all of its up- and
+        downstream partners at once. """
+        visited = np.zeros(len(self.skeleton_ids), dtype=np.bool_)
+        start = self.rows(skeleton_ids)
+        visited[start] = True
+        frontier = start
+        while n_circles > 0 and len(frontier):
+            n_circles -= 1
+            partners = np.union1d(_neighbors(self.downstream, frontier),
+                                  _neighbors(self.upstream, frontier))
+            frontier = partners[~visited[partners]]
+            visited[frontier] = True
+        visited[start] = False
+        return self.skeleton_ids[visited].tolist()
+
+    def distances_to(self, row, max_distance):
+        """ Returns an array of the number of directed connections needed to
+        reach the passed in row from every other row, as found by a backwards
+        breadth-first search. Rows further away than max_distance are marked
+        with max_distance + 1. """
+        distances = np.empty(len(self.skeleton_ids), dtype=np.int64)
+        distances.fill(max_distance + 1)
+        distances[row] = 0
+        frontier = np.array([row])
+        for distance in xrange(1, max_distance + 1):
+            partners = _neighbors(self.incoming, frontier)
+            frontier = partners[distances[partners] > distance]
+            if not len(frontier):
+                break
+            distances[frontier] = distance
+        return distances
+
+    def directed_paths(self, skeleton_ids, max_length, max_paths=None,
+            deadline=None, status=None):
+        """ Generates all simple directed paths with at most max_length
+        connections between all pairs of the passed in skeletons, as lists of
+        skeleton IDs. Before the paths between a pair are enumerated, the
+        distances to the target are computed, which lets the depth-first
+        search skip every partner the target can't be reached from in time.
+        The search ends when more than max_paths paths are found or at the
+        deadline (as returned by time.time()), whichever comes first. If it
+        ends early, 'truncated' is set to True in the optional status
+        dictionary. """
+        rows = [r[0] for r in (self.rows([skid]) for skid in skeleton_ids)
+                if len(r)]
+        indptr, indices = self.outgoing.indptr, self.outgoing.indices
+        distances = {}
+        n_paths = 0
+
+        for target in rows:
+            distances[target] = self.distances_to(target, max_length)
+
+        for source in rows:
+            for target in rows:
+                if source == target:
+                    continue
+                distance = distances[target]
+                if distance[source] > max_length:
+                    continue
+                # Iterative depth-first search. Each stack entry holds a path
+                # row and the partners that are yet to be followed from it.
+                path = [source]
+                on_path = set(path)
+                stack = [iter(indices[indptr[source]:indptr[source + 1]])]
+                while stack:
+                    if deadline is not None and time.time() > deadline:
+                        if status is not None:
+                            status['truncated'] = True
+                        return
+                    remaining = max_length - len(path)
+                    for partner in stack[-1]:
+                        if partner == target:
+                            if max_paths is not None and n_paths >= max_paths:
+                                # There are more paths than requested
+                                if status is not None:
+                                    status['truncated'] = True
+                                return
+                            yield self.skeleton_ids[path + [target]].tolist()
+                            n_paths += 1
+                        elif partner not in on_path and \
+                                distance[partner] <= remaining:
+                            path.append(partner)
+                            on_path.add(partner)
+                            stack.append(iter(indices[
+                                    indptr[partner]:indptr[partner + 1]]))
+                            break
+                    else:
+                        stack.pop()
+                        on_path.discard(path.pop())
+
+
+def skeleton_graph(adjacency, min_downstream, min_upstream):
+    """ Returns a SkeletonGraph of the passed in adjacency matrix, which is
+    reused as long as the matrix doesn't change. """
+    key = (adjacency.project_id, min_downstream, min_upstream)
+    graph = _graphs.pop(key, None)
+    if graph is None or graph.adjacency is not adjacency:
+        graph = SkeletonGraph(adjacency, min_downstream, min_upstream)
+    # Move the graph to the end to discard the least recently used first
+    _graphs[key] = graph
+    while len(_graphs) > MAX_CACHED_GRAPHS:
+        _graphs.popitem(last=False)
+    return graph
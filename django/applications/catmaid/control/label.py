@@ -10,6 +10,7 @@ from catmaid.models import Project, Class, ClassInstance, Relation, Connector, \
         ConnectorClassInstance, UserRole, Treenode, TreenodeClassInstance, \
         ChangeRequest
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
+from catmaid.control import nodecache
 from catmaid.fields import Double3D
 
 def get_link_model(node_type):
@@ -241,6 +242,10 @@ def label_update(request, project_id=None, location_id=None, ntype=None):
                 }
                 ChangeRequest(**change_request_params).save()
 
+    if 'treenode' == ntype:
+        nodecache.invalidate_cells(project_id, treenode_ids=[node.id])
+    else:
+        nodecache.invalidate_cells(project_id, connector_ids=[node.id])
 
     return HttpResponse(json.dumps({'message': 'success'}), content_type='text/json')
 
@@ -290,6 +295,12 @@ def remove_label(label_id, node_type):
         label_link = table.objects.get(pk=label_id)
         label = label_link.class_instance
         label_link.delete()
+        if 'treenode' == node_type:
+            nodecache.invalidate_cells(label_link.project_id,
+                    treenode_ids=[label_link.treenode_id])
+        else:
+            nodecache.invalidate_cells(label_link.project_id,
+                    connector_ids=[label_link.connector_id])
         # Remove class instance for the deleted label if it is no longer linked
         # to any nodes.
         if 0 == label.treenodeclassinstance_set.count() + label.connectorclassinstance_set.count():
@@ -6,6 +6,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from catmaid.models import UserRole, Project, Relation, Treenode, Connector, \
         TreenodeConnector, ClassInstance
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
+from catmaid.control import nodecache
 
 @requires_user_role(UserRole.Annotate)
 def create_link(request, project_id=None):
@@ -52,6 +53,7 @@ def create_link(request, project_id=None):
         skeleton=from_treenode.skeleton,  # treenode.skeleton_id where treenode.id = from_id
         connector=to_connector  # connector_id = to_id
     ).save()
+    nodecache.invalidate_cells(project_id, [from_id], [to_id])
 
     return HttpResponse(json.dumps({'message': 'success'}), content_type='text/json')
 
@@ -73,6 +75,7 @@ def delete_link(request, project_id=None):
     # and the user_id not matching or not being superuser.
     can_edit_or_fail(request.user, links[0].id, 'treenode_connector')
 
+    nodecache.invalidate_cells(project_id, [treenode_id], [connector_id])
     links[0].delete()
     return HttpResponse(json.dumps({'result': 'Removed treenode to connector link'}))
 
@@ -1,14 +1,18 @@
+import hashlib
 import json
 import re
 from string import upper
 from itertools import izip
 
+from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.db import connection
 
 from catmaid.models import UserRole, Project, Class, ClassInstance, \
         ClassInstanceClassInstance, Relation
+from catmaid.control.annotationhierarchy import project_hierarchy
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
 from catmaid.control.common import defaultdict
 
@@ -58,8 +62,8 @@ def create_basic_annotated_entity_query(project, params, relations, classes,
         filters['cici_via_a__creation_time__lte'] = end_date
 
     # Get map of annotations to expand and their sub-annotations
-    sub_annotation_ids = get_sub_annotation_ids(project, annotations_to_expand,
-            relations, classes)
+    sub_annotation_ids = get_sub_annotation_ids(project.id,
+            annotations_to_expand)
 
     # Collect all annotations and their sub-annotation IDs (if requested) in a
     # set each. For the actual query each set is connected with AND while
@@ -94,63 +98,27 @@ def create_basic_annotated_entity_query(project, params, relations, classes,
     # all instances of the given set of allowed classes.
     return entities
 
-def get_sub_annotation_ids(project_id, annotation_set, relations, classes):
+def get_sub_annotation_ids(project_id, annotation_set):
     """ Sub-annotations are annotations that are annotated with an annotation
     from the annotation_set passed. Additionally, transivitely annotated
-    annotations are returned as well.
+    annotations are returned as well. They are looked up in the cached
+    annotation hierarchy of the project.
     """
     if not annotation_set:
         return {}
 
-    aaa_tuples = ClassInstanceClassInstance.objects.filter(
-            project_id=project_id,
-            class_instance_a__class_column=classes['annotation'],
-            class_instance_b__class_column=classes['annotation'],
-            relation_id = relations['annotated_with']).values_list(
-                    'class_instance_b', 'class_instance_a')
-
-    # A set wrapper to keep a set in a dictionary
-    class set_wrapper:
-        def __init__(self):
-            self.data = set()
-
-    # Create a dictionary of all annotations annotating a set of annotations
-    aaa = {}
-    for aa in aaa_tuples:
-        sa_set = aaa.get(aa[0])
-        if sa_set is None:
-            sa_set = set_wrapper()
-            aaa[aa[0]] = sa_set
-        sa_set.data.add(aa[1])
-
-    # Collect all sub-annotations by following the annotation hierarchy for
-    # every annotation in the annotation set passed.
-    sa_ids = {}
-    for a in annotation_set:
-        # Start with an empty result set for each requested annotation
-        ls = set()
-        working_set = set([a])
-        while working_set:
-            parent_id = working_set.pop()
-            # Try to get the sub-annotations for this parent
-            child_ids = aaa.get(parent_id) or set_wrapper()
-            for child_id in child_ids.data:
-                if child_id not in sa_ids:
-                    # Add all children as sub annotations
-                    ls.add(child_id)
-                    working_set.add(child_id)
-        # Store the result list for this ID
-        sa_ids[a] = list(ls)
-
-    return sa_ids
+    hierarchy = project_hierarchy(project_id)
+    return {a: list(hierarchy.sub_annotation_ids(a)) for a in annotation_set}
 
 def create_annotated_entity_list(project, entities_qs, relations, annotations=True):
     """ Executes the expected class instance queryset in <entities> and expands
-    it to aquire more information.
+    it to aquire more information. Only the entities of the queryset are
+    looked at, so it should be limited to the page that is displayed.
     """
-    # Cache class name
-    entities = entities_qs.select_related('class_column')
-    entity_ids = [e.id for e in entities]
+    # Retrieve the entities along with their class name
+    entities = list(entities_qs.values_list('id', 'name',
+            'class_column__class_name'))
+    entity_ids = [e[0] for e in entities]
 
     # Make second query to retrieve annotations and skeletons
     annotations = ClassInstanceClassInstance.objects.filter(
@@ -180,27 +148,61 @@ def create_annotated_entity_list(project, entities_qs, relations, annotations=Tr
         skeleton_dict[s[1]].append(s[0])
 
     annotated_entities = [];
-    for e in entities:
-        class_name = e.class_column.class_name
-        annotations = annotation_dict[e.id] if e.id in annotation_dict else []
+    for entity_id, name, class_name in entities:
+        annotations = annotation_dict[entity_id] \
+                if entity_id in annotation_dict else []
         entity_info = {
-            'id': e.id,
-            'name': e.name,
+            'id': entity_id,
+            'name': name,
             'annotations': annotations,
             'type': class_name,
         }
 
         # Depending on the type of entity, some extra information is added.
         if class_name == 'neuron':
-            entity_info['skeleton_ids'] = skeleton_dict[e.id] \
-                    if e.id in skeleton_dict else []
+            entity_info['skeleton_ids'] = skeleton_dict[entity_id] \
+                    if entity_id in skeleton_dict else []
 
         annotated_entities.append(entity_info)
 
     return annotated_entities
 
+# Request parameters that select a page of search results rather than the
+# results themselves
+_PAGING_PARAMETERS = frozenset(('display_start', 'display_length',
+        'display_after', 'iDisplayStart', 'iDisplayLength', 'sEcho',
+        'display_after_name', 'display_after_id'))
+
+def _count_results(project_id, params, query, display_start, display_length,
+        page_length):
+    """ Returns the number of results of a search. If the displayed page
+    isn't full, it is the last one and the number is known without counting.
+    Otherwise, the results are counted only once for all pages of a search
+    and the count is kept in the cache for NEURON_SEARCH_COUNT_CACHE_TIMEOUT
+    seconds.
+    """
+    if page_length < display_length:
+        return display_start + page_length
+    timeout = settings.NEURON_SEARCH_COUNT_CACHE_TIMEOUT
+    if not timeout:
+        return query.count()
+    search = sorted((k, v) for k, v in params.iteritems()
+            if k not in _PAGING_PARAMETERS)
+    key = 'catmaid.neuron-search-count-%s-%s' % (project_id,
+            hashlib.md5(repr(search)).hexdigest())
+    count = cache.get(key)
+    if count is None:
+        count = query.count()
+        cache.set(key, count, timeout)
+    return count
+
 @requires_user_role([UserRole.Browse])
 def query_neurons_by_annotations(request, project_id = None):
+    """ Returns a page of the entities matching the search constraints,
+    ordered by ID. A page is selected either by its offset display_start or,
+    which doesn't need to skip all earlier results, by display_after, the ID
+    of the last entity of the previous page.
+    """
     p = get_object_or_404(Project, pk = project_id)
 
     classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
@@ -210,18 +212,23 @@ def query_neurons_by_annotations(request, project_id = None):
     display_length = int(request.POST.get('display_length', -1))
     if display_length < 0:
         display_length = 2000  # Default number of result rows
+    display_after = request.POST.get('display_after')
 
     query = create_basic_annotated_entity_query(p, request.POST, relations,
             classes)
     query = query.order_by('id').distinct()
 
-    # Get total number of results
-    num_records = query.count()
+    # Limit result to display range
+    if display_after is None:
+        page = query[display_start:display_start + display_length]
+    else:
+        page = query.filter(id__gt=int(display_after))[:display_length]
 
-    # Limit and offset result to display range
-    query = query[display_start:display_start + display_length]
+    dump = create_annotated_entity_list(p, page, relations)
 
-    dump = create_annotated_entity_list(p, query, relations)
+    # Get total number of results
+    num_records = _count_results(p.id, request.POST, query, display_start,
+            display_length, len(dump))
 
     return HttpResponse(json.dumps({
       'entities': dump,
@@ -230,6 +237,12 @@ def query_neurons_by_annotations(request, project_id = None):
 
 @requires_user_role([UserRole.Browse])
 def query_neurons_by_annotations_datatable(request, project_id=None):
+    """ Returns a page of the neurons matching the search constraints for a
+    DataTables table, ordered by name and ID. Besides by its offset
+    iDisplayStart, a page can be selected by the name and ID of the last neuron
+    of the previous page (display_after_name and display_after_id), which
+    doesn't need to skip all earlier results.
+    """
     p = get_object_or_404(Project, pk = project_id)
 
     classes = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
@@ -247,31 +260,35 @@ def query_neurons_by_annotations_datatable(request, project_id=None):
     if len(search_term) > 0:
         neuron_query = neuron_query.filter(name__regex=search_term)
 
-    should_sort = request.POST.get('iSortCol_0', False)
-    if should_sort:
-        column_count = int(request.POST.get('iSortingCols', 0))
-        sorting_directions = [request.POST.get('sSortDir_%d' % d, 'DESC')
-                for d in range(column_count)]
-        sorting_directions = map(lambda d: '-' if upper(d) == 'DESC' else '',
-                sorting_directions)
-
-        fields = ['name', 'first_name', 'last_name']
-        sorting_index = [int(request.POST.get('iSortCol_%d' % d))
-                for d in range(column_count)]
-        sorting_cols = map(lambda i: fields[i], sorting_index)
-
-        neuron_query = neuron_query.extra(order_by=[di + col for (di, col) in zip(
-                sorting_directions, sorting_cols)])
-
     # Make sure we get a distinct result (which otherwise might not be the case
     # due to the JOINS that are made).
     neuron_query = neuron_query.distinct()
 
-    # Since it is very likely that there are many neurons, it is more efficient
-    # to do two queries: 1. Get total number of neurons 2. Get limited set. The
-    # alternative would be to get all neurons for counting and limiting on the
-    # Python side. This, however, is too expensive when there are many neurons.
-    num_records = neuron_query.count()
+    # Neurons can only be sorted by name. The ID breaks ties, which gives a
+    # stable order to page through.
+    descending = False
+    if request.POST.get('iSortCol_0', False):
+        descending = upper(request.POST.get('sSortDir_0', 'DESC')) == 'DESC'
+    direction = '-' if descending else ''
+    neuron_query = neuron_query.order_by(direction + 'name', direction + 'id')
+
+    # Limit result to display range
+    after_id = request.POST.get('display_after_id')
+    if after_id is None:
+        page = neuron_query[display_start:display_start + display_length]
+    else:
+        page = neuron_query.extra(where=[
+                '(class_instance.name, class_instance.id) %s (%%s, %%s)' % \
+                ('<' if descending else '>')],
+                params=[request.POST.get('display_after_name', ''),
+                        int(after_id)])[:display_length]
+
+    entities = create_annotated_entity_list(p, page, relations)
+
+    # Since it is very likely that there are many neurons, counting them
+    # is expensive. The count is therefore only done once for all pages.
+    num_records = _count_results(p.id, request.POST, neuron_query,
+            display_start, display_length, len(entities))
 
     response = {
         'iTotalRecords': num_records,
@@ -279,8 +296,6 @@ def query_neurons_by_annotations_datatable(request, project_id=None):
         'aaData': []
     }
 
-    entities = create_annotated_entity_list(p,
-            neuron_query[display_start:display_start + display_length], relations)
     for entity in entities:
         if entity['type'] == 'neuron':
             response['aaData'] += [[
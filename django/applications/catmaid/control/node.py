@@ -1,11 +1,13 @@
 import json
 import re
+import numpy as np
 
 from collections import defaultdict
 from datetime import datetime
 import itertools as itertools
 
-from django.db import connection
+from django.conf import settings
+from django.db import connection, transaction
 from django.http import HttpResponse
 from django.contrib.auth.models import User
 
@@ -14,12 +16,345 @@ from catmaid.models import UserRole, Treenode, TreenodeConnector, Connector, \
 from catmaid.control.authentication import requires_user_role, \
         can_edit_all_or_fail, user_domain
 from catmaid.control.common import get_relation_to_id_map, insert_into_log
+from catmaid.control import nodecache, nodeindex
 from catmaid.control.treenode import can_edit_treenode_or_fail
 
-try:
-    import networkx as nx
-except:
-    pass
+
+def _fetch_treenode_pairs_join(cursor, params):
+    ''' Fetch the treenodes in the bounding box together with their parents and
+    children with a single self-join of the treenode table.
+    '''
+    # Fetch treenodes which are in the bounding box,
+    # which in z it includes the full thickess of the prior section
+    # and of the next section (therefore the '<' and not '<=' for zhigh)
+    cursor.execute('''
+    SELECT
+        t1.id,
+        t1.parent_id,
+        t1.location_x,
+        t1.location_y,
+        t1.location_z,
+        t1.confidence,
+        t1.radius,
+        t1.skeleton_id,
+        t1.user_id,
+        t2.id,
+        t2.parent_id,
+        t2.location_x,
+        t2.location_y,
+        t2.location_z,
+        t2.confidence,
+        t2.radius,
+        t2.skeleton_id,
+        t2.user_id
+    FROM treenode t1
+         INNER JOIN treenode t2 ON
+           (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
+            OR (t1.parent_id IS NULL AND t1.id = t2.id))
+    WHERE
+        t1.location_z = %%(z)s
+        AND t1.location_x %s %%(left)s
+        AND t1.location_x < %%(right)s
+        AND t1.location_y %s %%(top)s
+        AND t1.location_y < %%(bottom)s
+        AND t1.project_id = %%(project_id)s
+    LIMIT %%(limit)s
+    ''' % (params['lower'], params['lower']), params)
+
+    # Above, notice that the join is done for:
+    # 1. A parent-child or child-parent pair (where the first one is in section z)
+    # 2. A node with itself when the parent is null
+    # This is by far the fastest way to retrieve all parents and children nodes
+    # of the nodes in section z within the specified 2d bounds.
+    return cursor.fetchall()
+
+
+def _fetch_treenode_pairs_twophase(cursor, params):
+    ''' Fetch the treenodes in the bounding box together with their parents and
+    children in two queries: the first one selects only the treenodes of the
+    section within the bounding box, the second one looks up their parents and
+    children by ID. Unlike the OR-join above, both of them can be answered with
+    plain index scans, which scales much better with the size of the treenode
+    table. The result is built to be identical to the one of the join engine.
+    '''
+    cursor.execute('''
+    SELECT id, parent_id, location_x, location_y, location_z, confidence,
+        radius, skeleton_id, user_id
+    FROM treenode
+    WHERE location_z = %%(z)s
+      AND location_x %s %%(left)s
+      AND location_x < %%(right)s
+      AND location_y %s %%(top)s
+      AND location_y < %%(bottom)s
+      AND project_id = %%(project_id)s
+    LIMIT %%(limit)s
+    ''' % (params['lower'], params['lower']), params)
+    inbox = cursor.fetchall()
+    if not inbox:
+        return []
+
+    inbox_ids = [row[0] for row in inbox]
+    parent_ids = [row[1] for row in inbox if row[1] is not None]
+    cursor.execute('''
+    SELECT id, parent_id, location_x, location_y, location_z, confidence,
+        radius, skeleton_id, user_id
+    FROM treenode
+    WHERE id = ANY(%(parent_ids)s::bigint[])
+    UNION
+    SELECT id, parent_id, location_x, location_y, location_z, confidence,
+        radius, skeleton_id, user_id
+    FROM treenode
+    WHERE parent_id = ANY(%(inbox_ids)s::bigint[])
+    ''', {'parent_ids': parent_ids, 'inbox_ids': inbox_ids})
+
+    nodes = {}
+    children = defaultdict(list)
+    for row in cursor.fetchall():
+        nodes[row[0]] = row
+        if row[1] is not None:
+            children[row[1]].append(row)
+
+    # Pair every treenode with its parent (or itself if it is a root node) and
+    # each of its children.
+    pairs = []
+    for row in inbox:
+        if row[1] is None:
+            pairs.append(row + row)
+        elif row[1] in nodes:
+            pairs.append(row + nodes[row[1]])
+        for child in children[row[0]]:
+            pairs.append(row + child)
+        if len(pairs) >= params['limit']:
+            break
+
+    return pairs[:params['limit']]
+
+
+# The available strategies to fetch treenodes and their neighbors for a
+# bounding box, selectable with the NODE_LIST_ENGINE setting.
+NODE_LIST_ENGINES = {
+    'join': _fetch_treenode_pairs_join,
+    'twophase': _fetch_treenode_pairs_twophase,
+}
+
+
+def _fetch_node_rows(cursor, params, relation_map, half_open=False):
+    ''' Fetch the user independent data needed to answer a node list request
+    for the bounding box defined by params. Returns a dictionary with the
+    following entries:
+    'pairs': rows combining the columns of a treenode in the bounding box with
+    the ones of its parent, a child or itself (if it is a root node).
+    'attached': connector rows for connectors linked to any treenode in 'pairs'.
+    'inbox': connector rows for connectors in the bounding box.
+    'limit_reached': whether the treenode query was truncated by the limit.
+    If half_open is true, the left and top border of the bounding box are
+    included, which allows to tile a section without gaps. The pairs are
+    retrieved with the engine configured in NODE_LIST_ENGINE.
+    '''
+    params = dict(params, lower='>=' if half_open else '>')
+
+    fetch_pairs = NODE_LIST_ENGINES[settings.NODE_LIST_ENGINE]
+    pairs = fetch_pairs(cursor, params)
+
+    # Find connectors related to treenodes in the field of view
+    # Connectors found attached to treenodes
+    attached = []
+    treenode_ids = set(row[0] for row in pairs) | set(row[9] for row in pairs)
+    if treenode_ids:
+        cursor.execute('''
+        SELECT connector.id,
+            connector.location_x,
+            connector.location_y,
+            connector.location_z,
+            connector.confidence,
+            treenode_connector.relation_id,
+            treenode_connector.treenode_id,
+            treenode_connector.confidence,
+            connector.user_id
+        FROM treenode_connector,
+             connector
+        WHERE treenode_connector.treenode_id IN (%s)
+          AND treenode_connector.connector_id = connector.id
+        ''' % ','.join(map(str, treenode_ids)))
+
+        attached = cursor.fetchall()
+
+    # Obtain connectors within the field of view that were not captured above.
+    # Uses a LEFT OUTER JOIN to include disconnected connectors,
+    # that is, connectors that aren't referenced from treenode_connector.
+
+    cursor.execute('''
+    SELECT connector.id,
+        connector.location_x,
+        connector.location_y,
+        connector.location_z,
+        connector.confidence,
+        treenode_connector.relation_id,
+        treenode_connector.treenode_id,
+        treenode_connector.confidence,
+        connector.user_id
+    FROM connector LEFT OUTER JOIN treenode_connector
+                   ON connector.id = treenode_connector.connector_id
+    WHERE connector.project_id = %%(project_id)s
+      AND connector.location_z = %%(z)s
+      AND connector.location_x %s %%(left)s
+      AND connector.location_x < %%(right)s
+      AND connector.location_y %s %%(top)s
+      AND connector.location_y < %%(bottom)s
+    ''' % (params['lower'], params['lower']), params)
+
+    inbox = cursor.fetchall()
+
+    return {
+        'pairs': pairs,
+        'attached': attached,
+        'inbox': inbox,
+        'limit_reached': len(pairs) == params['limit'],
+    }
+
+
+def _fetch_treenode_rows(cursor, treenode_ids):
+    ''' Fetch treenode rows by ID, returned as a dictionary of ID vs row. '''
+    cursor.execute('''
+    SELECT id,
+        parent_id,
+        location_x,
+        location_y,
+        location_z,
+        confidence,
+        radius,
+        skeleton_id,
+        user_id
+    FROM treenode
+    WHERE id IN %(missing)s''', {'missing': tuple(treenode_ids)})
+    return {row[0]: row for row in cursor.fetchall()}
+
+
+def _fetch_label_rows(cursor, relation_map, treenode_ids, connector_ids):
+    ''' Fetch the labels of the given treenodes and connectors, returned as a
+    dictionary of node ID vs a list of label names. '''
+    labels = defaultdict(list)
+    if treenode_ids:
+        cursor.execute('''
+        SELECT treenode.id, class_instance.name
+        FROM treenode, class_instance, treenode_class_instance
+        WHERE treenode_class_instance.relation_id = %s
+          AND treenode.id IN (%s)
+          AND treenode_class_instance.treenode_id = treenode.id
+          AND class_instance.id = treenode_class_instance.class_instance_id
+        ''' % (relation_map['labeled_as'], ','.join(map(str, treenode_ids))))
+        for row in cursor.fetchall():
+            labels[row[0]].append(row[1])
+
+    if connector_ids:
+        cursor.execute('''
+        SELECT connector.id, class_instance.name
+        FROM connector, class_instance, connector_class_instance
+        WHERE connector_class_instance.relation_id = %s
+          AND connector.id IN (%s)
+          AND connector_class_instance.connector_id = connector.id
+          AND class_instance.id = connector_class_instance.class_instance_id
+        ''' % (relation_map['labeled_as'], ','.join(map(str, connector_ids))))
+        for row in cursor.fetchall():
+            labels[row[0]].append(row[1])
+
+    return labels
+
+
+def _fetch_node_cell(cursor, params, relation_map):
+    ''' Fetch everything needed to answer node list requests from a cell of
+    the node list cache (the bounding box in params). Besides the data returned
+    by _fetch_node_rows, this includes the treenodes linked to connectors of
+    the cell ('partners') and the labels ('labels') of all nodes in the
+    section. The IDs of all nodes for which labels were looked up are stored
+    in 'labeled'.
+    '''
+    cell = _fetch_node_rows(cursor, params, relation_map, half_open=True)
+
+    treenode_ids = set(row[0] for row in cell['pairs']) | \
+            set(row[9] for row in cell['pairs'])
+    partner_ids = set(row[6] for row in
+            itertools.chain(cell['attached'], cell['inbox'])
+            if row[6] is not None) - treenode_ids
+    cell['partners'] = _fetch_treenode_rows(cursor, partner_ids) \
+            if partner_ids else {}
+
+    z0 = params['z']
+    visible_treenodes = set(row[0] for row in cell['pairs'] if row[4] == z0) | \
+            set(row[9] for row in cell['pairs'] if row[13] == z0) | \
+            set(tid for tid, row in cell['partners'].iteritems() if row[4] == z0)
+    visible_connectors = set(row[0] for row in
+            itertools.chain(cell['attached'], cell['inbox']) if row[3] == z0)
+    cell['labels'] = dict(_fetch_label_rows(cursor, relation_map,
+            visible_treenodes, visible_connectors))
+    cell['labeled'] = visible_treenodes | visible_connectors
+
+    return cell
+
+
+def _pack_node_list(treenodes, connectors, labels, limit_reached):
+    ''' Encode the result of node_list_tuples as typed little-endian arrays,
+    which can be read by a client without parsing (e.g. with JavaScript typed
+    arrays). The format starts with a header of six uint32 values:
+    number of treenodes (N), number of connectors (M), number of presynaptic
+    links (P), number of postsynaptic links (Q), byte length of the labels
+    (L) and flags (bit 0: node limit reached). It is followed by these arrays,
+    each one padded to a multiple of eight bytes:
+    treenodes: id (float64), parent id (float64, -1 for root nodes),
+      x, y, z (float32), confidence (uint8), radius (float32),
+      skeleton id (float64), can edit (uint8)
+    connectors: id (float64), x, y, z (float32), confidence (uint8),
+      can edit (uint8), presynaptic offsets (uint32, M + 1 entries),
+      presynaptic treenode ids (float64, P), presynaptic confidences (uint8, P),
+      postsynaptic offsets (uint32, M + 1), postsynaptic treenode ids
+      (float64, Q), postsynaptic confidences (uint8, Q)
+    The links of connector i are the entries offsets[i] to offsets[i + 1].
+    Finally, the labels are appended as UTF-8 encoded JSON object.
+    IDs are stored as float64 to be exactly representable in JavaScript.
+    '''
+    def column(values, dtype):
+        data = np.array(values, dtype=dtype).tostring()
+        return data + '\0' * (-len(data) % 8)
+
+    def links(index):
+        offsets = [0]
+        treenode_ids = []
+        confidences = []
+        for c in connectors:
+            for tnid, confidence in c[index]:
+                treenode_ids.append(tnid)
+                confidences.append(confidence)
+            offsets.append(len(treenode_ids))
+        return [column(offsets, '<u4'), column(treenode_ids, '<f8'),
+                column(confidences, '<u1')], len(treenode_ids)
+
+    pre, n_pre = links(5)
+    post, n_post = links(6)
+    label_data = json.dumps(labels, separators=(',', ':')).encode('utf-8')
+
+    parts = [column([len(treenodes), len(connectors), n_pre, n_post,
+            len(label_data), 1 if limit_reached else 0], '<u4')]
+    parts.extend((
+        column([t[0] for t in treenodes], '<f8'),
+        column([-1 if t[1] is None else t[1] for t in treenodes], '<f8'),
+        column([t[2] for t in treenodes], '<f4'),
+        column([t[3] for t in treenodes], '<f4'),
+        column([t[4] for t in treenodes], '<f4'),
+        column([t[5] for t in treenodes], '<u1'),
+        column([t[6] for t in treenodes], '<f4'),
+        column([t[7] for t in treenodes], '<f8'),
+        column([bool(t[8]) for t in treenodes], '<u1'),
+        column([c[0] for c in connectors], '<f8'),
+        column([c[1] for c in connectors], '<f4'),
+        column([c[2] for c in connectors], '<f4'),
+        column([c[3] for c in connectors], '<f4'),
+        column([c[4] for c in connectors], '<u1'),
+        column([bool(c[7]) for c in connectors], '<u1')))
+    parts.extend(pre)
+    parts.extend(post)
+    parts.append(label_data)
+
+    return ''.join(parts)
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -36,6 +371,10 @@ def node_list_tuples(request, project_id=None):
     so care must be taken never to alter the order of the variables in the SQL
     statements without modifying the accesses to said data both in this function
     and in the client that consumes it.
+    If the node list cache is enabled (NODE_LIST_CACHE_ENABLED), the field of
+    view is answered by merging cached grid cells.
+    If the 'format' parameter is 'binary', the same data is returned in the
+    packed binary format described in _pack_node_list.
     '''
     project_id = int(project_id) # sanitize
     params = {}
@@ -69,50 +408,25 @@ def node_list_tuples(request, project_id=None):
         # For a superuser, the domain is all users, and implicit.
         domain = None if is_superuser else user_domain(cursor, user_id)
 
-        # Fetch treenodes which are in the bounding box,
-        # which in z it includes the full thickess of the prior section
-        # and of the next section (therefore the '<' and not '<=' for zhigh)
         params['bottom'] = params['top'] + params['height']
         params['right'] = params['left'] + params['width']
-        cursor.execute('''
-        SELECT
-            t1.id,
-            t1.parent_id,
-            t1.location_x,
-            t1.location_y,
-            t1.location_z,
-            t1.confidence,
-            t1.radius,
-            t1.skeleton_id,
-            t1.user_id,
-            t2.id,
-            t2.parent_id,
-            t2.location_x,
-            t2.location_y,
-            t2.location_z,
-            t2.confidence,
-            t2.radius,
-            t2.skeleton_id,
-            t2.user_id
-        FROM treenode t1
-             INNER JOIN treenode t2 ON
-               (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
-                OR (t1.parent_id IS NULL AND t1.id = t2.id))
-        WHERE
-            t1.location_z = %(z)s
-            AND t1.location_x > %(left)s
-            AND t1.location_x < %(right)s
-            AND t1.location_y > %(top)s
-            AND t1.location_y < %(bottom)s
-            AND t1.project_id = %(project_id)s
-        LIMIT %(limit)s
-        ''', params)
-
-        # Above, notice that the join is done for:
-        # 1. A parent-child or child-parent pair (where the first one is in section z)
-        # 2. A node with itself when the parent is null
-        # This is by far the fastest way to retrieve all parents and children nodes
-        # of the nodes in section z within the specified 2d bounds.
+        left, top = params['left'], params['top']
+        right, bottom = params['right'], params['bottom']
+
+        cells = nodecache.cells_for_box(left, top, right, bottom) \
+                if nodecache.cache_enabled() else None
+        if cells and len(cells) <= settings.NODE_LIST_CACHE_MAX_CELLS:
+            def fetch_cell(cell_left, cell_top, cell_right, cell_bottom):
+                return _fetch_node_cell(cursor, dict(params, left=cell_left,
+                        top=cell_top, right=cell_right, bottom=cell_bottom),
+                        relation_map)
+            parts = nodecache.get_cells(project_id, params['z'], cells,
+                    fetch_cell)
+        else:
+            parts = [_fetch_node_rows(cursor, params, relation_map)]
+
+        def in_view(x, y):
+            return left < x < right and top < y < bottom
 
         # A list of tuples, each tuple containing the selected columns for each treenode
         # The id is the first element of each tuple
@@ -121,7 +435,11 @@ def node_list_tuples(request, project_id=None):
         treenode_ids = set()
 
         n_retrieved_nodes = 0 # at one per row, only those within the section
-        for row in cursor.fetchall():
+        for row in itertools.chain.from_iterable(p['pairs'] for p in parts):
+            if n_retrieved_nodes == params['limit']:
+                break
+            if not in_view(row[2], row[3]):
+                continue
             n_retrieved_nodes += 1
             t1id = row[0]
             if t1id not in treenode_ids:
@@ -131,57 +449,16 @@ def node_list_tuples(request, project_id=None):
             if t2id not in treenode_ids:
                 treenode_ids.add(t2id)
                 treenodes.append(row[9:17] + (is_superuser or row[17] == user_id or row[17] in domain,))
+        limit_reached = n_retrieved_nodes == params['limit'] or \
+                any(p['limit_reached'] for p in parts)
 
-
-        # Find connectors related to treenodes in the field of view
-        # Connectors found attached to treenodes
-        crows = []
-
-        if treenode_ids:
-            response_on_error = 'Failed to query connector locations.'
-            cursor.execute('''
-            SELECT connector.id,
-                connector.location_x,
-                connector.location_y,
-                connector.location_z,
-                connector.confidence,
-                treenode_connector.relation_id,
-                treenode_connector.treenode_id,
-                treenode_connector.confidence,
-                connector.user_id
-            FROM treenode_connector,
-                 connector
-            WHERE treenode_connector.treenode_id IN (%s)
-              AND treenode_connector.connector_id = connector.id
-            ''' % ','.join(map(str, treenode_ids)))
-
-            crows = list(cursor.fetchall())
-
-        # Obtain connectors within the field of view that were not captured above.
-        # Uses a LEFT OUTER JOIN to include disconnected connectors,
-        # that is, connectors that aren't referenced from treenode_connector.
-
-        cursor.execute('''
-        SELECT connector.id,
-            connector.location_x,
-            connector.location_y,
-            connector.location_z,
-            connector.confidence,
-            treenode_connector.relation_id,
-            treenode_connector.treenode_id,
-            treenode_connector.confidence,
-            connector.user_id
-        FROM connector LEFT OUTER JOIN treenode_connector
-                       ON connector.id = treenode_connector.connector_id
-        WHERE connector.project_id = %(project_id)s
-          AND connector.location_z = %(z)s
-          AND connector.location_x > %(left)s
-          AND connector.location_x < %(right)s
-          AND connector.location_y > %(top)s
-          AND connector.location_y < %(bottom)s
-        ''', params)
-
-        crows.extend(cursor.fetchall())
+        # Connectors found attached to treenodes, followed by connectors within
+        # the field of view.
+        response_on_error = 'Failed to query connector locations.'
+        crows = [row for p in parts for row in p['attached']
+                 if row[6] in treenode_ids]
+        crows.extend(row for p in parts for row in p['inbox']
+                     if in_view(row[1], row[2]))
 
         connectors = []
         # A set of missing treenode IDs
@@ -239,60 +516,48 @@ def node_list_tuples(request, project_id=None):
         # but not in the bounding box of the field of view.
         # This is so that we can draw arrows from any displayed connector
         # to all of its connected treenodes, even if one is several slices
-        # below.
+        # below. Cached cells provide them already.
 
         if missing_treenode_ids:
-            params['missing'] = tuple(missing_treenode_ids)
             response_on_error = 'Failed to query treenodes from connectors'
-            cursor.execute('''
-            SELECT id,
-                parent_id,
-                location_x,
-                location_y,
-                location_z,
-                confidence,
-                radius,
-                skeleton_id,
-                user_id
-            FROM treenode
-            WHERE id IN %(missing)s''', params)
-
-            for row in cursor.fetchall():
-                treenodes.append(row)
-                treenode_ids.add(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
+            missing = {}
+            for p in parts:
+                partners = p.get('partners', {})
+                missing.update((tid, partners[tid]) for tid in
+                        missing_treenode_ids if tid in partners)
+            unknown_ids = missing_treenode_ids.difference(missing)
+            if unknown_ids:
+                missing.update(_fetch_treenode_rows(cursor, unknown_ids))
+
+            for row in missing.itervalues():
+                treenodes.append(row[0:8] + (is_superuser or row[8] == user_id or row[8] in domain,))
+                treenode_ids.add(row[0])
 
         labels = defaultdict(list)
         if 'true' == request.POST.get('labels', None):
             z0 = params['z']
-            # Collect treenodes visible in the current section
-            visible = ','.join(str(row[0]) for row in treenodes if row[4] == z0)
-            if visible:
-                cursor.execute('''
-                SELECT treenode.id, class_instance.name
-                FROM treenode, class_instance, treenode_class_instance
-                WHERE treenode_class_instance.relation_id = %s
-                  AND treenode.id IN (%s)
-                  AND treenode_class_instance.treenode_id = treenode.id
-                  AND class_instance.id = treenode_class_instance.class_instance_id
-                ''' % (relation_map['labeled_as'], visible))
-                for row in cursor.fetchall():
-                    labels[row[0]].append(row[1])
-
-            # Collect connectors visible in the current section
-            visible = ','.join(str(row[0]) for row in connectors if row[3] == z0)
-            if visible:
-                cursor.execute('''
-                SELECT connector.id, class_instance.name
-                FROM connector, class_instance, connector_class_instance
-                WHERE connector_class_instance.relation_id = %s
-                  AND connector.id IN (%s)
-                  AND connector_class_instance.connector_id = connector.id
-                  AND class_instance.id = connector_class_instance.class_instance_id
-                ''' % (relation_map['labeled_as'], visible))
-                for row in cursor.fetchall():
-                    labels[row[0]].append(row[1])
-
-        return HttpResponse(json.dumps((treenodes, connectors, labels, n_retrieved_nodes == params['limit']), separators=(',', ':'))) # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
+            # Collect treenodes and connectors visible in the current section
+            visible_treenodes = set(row[0] for row in treenodes if row[4] == z0)
+            visible_connectors = set(row[0] for row in connectors if row[3] == z0)
+            # Use labels of cached cells where available
+            for p in parts:
+                for node_id in p.get('labeled', ()):
+                    if node_id in visible_treenodes:
+                        visible_treenodes.remove(node_id)
+                    elif node_id in visible_connectors:
+                        visible_connectors.remove(node_id)
+                    else:
+                        continue
+                    if node_id in p['labels']:
+                        labels[node_id] = p['labels'][node_id]
+            labels.update(_fetch_label_rows(cursor, relation_map,
+                    visible_treenodes, visible_connectors))
+
+        if 'binary' == request.POST.get('format', 'json'):
+            return HttpResponse(_pack_node_list(treenodes, connectors, labels,
+                    limit_reached), content_type='application/octet-stream')
+
+        return HttpResponse(json.dumps((treenodes, connectors, labels, limit_reached), separators=(',', ':'))) # default separators have spaces in them like (', ', ': '). Must provide two: for list and for dictionary. The point of this: less space, more compact json
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
@@ -336,6 +601,7 @@ def update_confidence(request, project_id=None, node_id=0):
         rows_affected = Treenode.objects.filter(id=tnid).update(confidence=new_confidence,editor=request.user)
 
     if rows_affected > 0:
+        nodecache.invalidate_cells(project_id, [tnid])
         location = Location.objects.filter(id=tnid).values_list('location_x',
                 'location_y', 'location_z')[0]
         insert_into_log(project_id, request.user.id, "change_confidence", location, "Changed to %s" % new_confidence)
@@ -377,33 +643,53 @@ def most_recent_treenode(request, project_id=None):
     }))
 
 
-def _update(Kind, table, nodes, now, user):
+def _update(table, nodes, now, user):
+    """ Moves all passed in nodes of a table (treenode or connector) with a
+    single UPDATE statement. Each node is a sequence of ID, X, Y and Z. """
     if not nodes:
         return
     # 0: id
     # 1: X
     # 2: Y
     # 3: Z
-    can_edit_all_or_fail(user, (node[0] for node in nodes.itervalues()), table)
-    for node in nodes.itervalues():
-        Kind.objects.filter(id=int(node[0])).update(
-            editor=user,
-            edition_time=now,
-            location_x=float(node[1]),
-            location_y=float(node[2]),
-            location_z=float(node[3]))
-
-
-@requires_user_role(UserRole.Annotate)
-def node_update(request, project_id=None):
-    N = len(request.POST)
+    can_edit_all_or_fail(user, (node[0] for node in nodes), table)
+    values = []
+    for node in nodes:
+        values.extend((int(node[0]), float(node[1]), float(node[2]), float(node[3])))
+    cursor = connection.cursor()
+    cursor.execute('''
+        UPDATE %s SET
+            editor_id = %%s,
+            edition_time = %%s,
+            location_x = v.x,
+            location_y = v.y,
+            location_z = v.z
+        FROM (VALUES %s) AS v(id, x, y, z)
+        WHERE %s.id = v.id
+    ''' % (table, ','.join(['(%s,%s,%s,%s)'] * len(nodes)), table),
+        [user.id, now] + values)
+
+
+def _parse_node_update(data):
+    """ Returns the treenodes and connectors to move as two lists of [ID, X, Y,
+    Z] lists. These are expected either as JSON arrays of such lists in the
+    fields 't' and 'c' or in the form encoding t[i][j] and c[i][j], with j
+    being 0 for the ID and 1 to 3 for X, Y and Z. """
+    if 't' in data or 'c' in data:
+        nodes = [json.loads(data.get(kind, '[]')) for kind in ('t', 'c')]
+        for node in itertools.chain(*nodes):
+            if 4 != len(node):
+                raise Exception("Incorrect number of values for a node in node_update.")
+        return nodes
+
+    N = len(data)
     if 0 != N % 4:
         raise Exception("Incorrect number of posted items for node_update.")
 
     pattern = re.compile('^[tc]\[(\d+)\]\[(\d+)\]$')
 
     nodes = {'t': {}, 'c': {}}
-    for key, value in request.POST.iteritems():
+    for key, value in data.iteritems():
         i, j = pattern.match(key).groups()
         i = int(i)
         j = int(j)
@@ -412,14 +698,59 @@ def node_update(request, project_id=None):
             nodes[key[0]][i] = node = {}
         node[j] = value
 
+    return [[[node[j] for j in xrange(4)] for node in nodes[kind].itervalues()]
+            for kind in ('t', 'c')]
+
+
+@requires_user_role(UserRole.Annotate)
+def node_update(request, project_id=None):
+    treenodes, connectors = _parse_node_update(request.POST)
+
+    treenode_ids = [node[0] for node in treenodes]
+    connector_ids = [node[0] for node in connectors]
+    # Invalidate cached cells at both the old and the new locations
+    nodecache.invalidate_cells(project_id, treenode_ids, connector_ids)
+
     now = datetime.now()
-    _update(Treenode, 'treenode', nodes['t'], now, request.user)
-    _update(Connector, 'connector', nodes['c'], now, request.user)
+    with transaction.atomic():
+        _update('treenode', treenodes, now, request.user)
+        _update('connector', connectors, now, request.user)
+
+    nodecache.invalidate_cells(project_id, treenode_ids, connector_ids)
 
-    num_updated_nodes = len(nodes['t'].keys()) + len(nodes['c'].keys())
+    num_updated_nodes = len(treenodes) + len(connectors)
     return HttpResponse(json.dumps({'updated': num_updated_nodes}))
 
 
+def _skeletons_for_nearest(project_id, skeleton_id, neuron_id):
+    ''' Returns the list of skeletons to search for a nearest node: the
+    skeleton, if a positive skeleton_id is given, and all skeletons modeling
+    the neuron, if a positive neuron_id is given. '''
+    relation_map = get_relation_to_id_map(project_id)
+
+    if skeleton_id < 0 and neuron_id < 0:
+        raise Exception('You must specify either a skeleton or a neuron')
+
+    for rel in ['part_of', 'model_of']:
+        if rel not in relation_map:
+            raise Exception('Could not find required relation %s for project %s.' % (rel, project_id))
+
+    skeletons = []
+    if skeleton_id > 0:
+        skeletons.append(skeleton_id)
+
+    if neuron_id > 0:  # Add skeletons related to specified neuron
+        # Assumes that a cici 'model_of' relationship always involves a
+        # skeleton as ci_a and a neuron as ci_b.
+        neuron_skeletons = ClassInstanceClassInstance.objects.filter(
+            class_instance_b=neuron_id,
+            relation=relation_map['model_of'])
+        for neur_skel_relation in neuron_skeletons:
+            skeletons.append(neur_skel_relation.class_instance_a_id)
+
+    return skeletons
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def node_nearest(request, project_id=None):
     params = {}
@@ -434,84 +765,61 @@ def node_nearest(request, project_id=None):
         params[p] = float(request.POST.get(p, param_float_defaults[p]))
     for p in param_int_defaults.keys():
         params[p] = int(request.POST.get(p, param_int_defaults[p]))
-    relation_map = get_relation_to_id_map(project_id)
-
-    if params['skeleton_id'] < 0 and params['neuron_id'] < 0:
-        raise Exception('You must specify either a skeleton or a neuron')
 
-    for rel in ['part_of', 'model_of']:
-        if rel not in relation_map:
-            raise Exception('Could not find required relation %s for project %s.' % (rel, project_id))
-
-    skeletons = []
-    if params['skeleton_id'] > 0:
-        skeletons.append(params['skeleton_id'])
+    skeletons = _skeletons_for_nearest(project_id, params['skeleton_id'],
+            params['neuron_id'])
 
     response_on_error = ''
     try:
-        if params['neuron_id'] > 0:  # Add skeletons related to specified neuron
-            # Assumes that a cici 'model_of' relationship always involves a
-            # skeleton as ci_a and a neuron as ci_b.
-            response_on_error = 'Finding the skeletons failed.'
-            neuron_skeletons = ClassInstanceClassInstance.objects.filter(
-                class_instance_b=params['neuron_id'],
-                relation=relation_map['model_of'])
-            for neur_skel_relation in neuron_skeletons:
-                skeletons.append(neur_skel_relation.class_instance_a_id)
-
-        # Get all treenodes connected to skeletons
+        # Look up the nearest treenode in the spatial index of the skeletons
         response_on_error = 'Finding the treenodes failed.'
-        treenodes = Treenode.objects.filter(project=project_id, skeleton__in=skeletons)
-
-        def getNearestTreenode(x, y, z, treenodes):
-            minDistance = -1
-            nearestTreenode = None
-            for tn in treenodes:
-                xdiff = x - tn.location_x
-                ydiff = y - tn.location_y
-                zdiff = z - tn.location_z
-                distanceSquared = xdiff ** 2 + ydiff ** 2 + zdiff ** 2
-                if distanceSquared < minDistance or minDistance < 0:
-                    nearestTreenode = tn
-                    minDistance = distanceSquared
-            return nearestTreenode
-
-        nearestTreenode = getNearestTreenode(
-            params['x'],
-            params['y'],
-            params['z'],
-            treenodes)
-        if nearestTreenode is None:
+        nearest = nodeindex.nearest_treenodes(project_id, skeletons,
+                [(params['x'], params['y'], params['z'])])
+        if not nearest:
             raise Exception('No treenodes were found for skeletons in %s' % skeletons)
 
+        treenode_id, x, y, z, skeleton_id = nearest[0]
         return HttpResponse(json.dumps({
-            'treenode_id': nearestTreenode.id,
-            'x': int(nearestTreenode.location_x),
-            'y': int(nearestTreenode.location_y),
-            'z': int(nearestTreenode.location_z),
-            'skeleton_id': nearestTreenode.skeleton_id}))
+            'treenode_id': treenode_id,
+            'x': int(x),
+            'y': int(y),
+            'z': int(z),
+            'skeleton_id': skeleton_id}))
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
 
-def _skeleton_as_graph(skeleton_id):
-    # Fetch all nodes of the skeleton
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT id, parent_id
-        FROM treenode
-        WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def node_nearest_batch(request, project_id=None):
+    ''' Find the nearest treenode of a skeleton or neuron for many points at
+    once. The points are expected as points[i][0] to points[i][2] (X, Y and Z),
+    the skeleton or neuron as skeleton_id or neuron_id. Returns a list with an
+    object for each point, in the order of the point indices, with the same
+    fields as node_nearest. '''
+    skeletons = _skeletons_for_nearest(project_id,
+            int(request.POST.get('skeleton_id', -1)),
+            int(request.POST.get('neuron_id', -1)))
+
+    pattern = re.compile('^points\[(\d+)\]\[([012])\]$')
+    points = defaultdict(lambda: [0.0, 0.0, 0.0])
+    for key, value in request.POST.iteritems():
+        match = pattern.match(key)
+        if match:
+            i, j = match.groups()
+            points[int(i)][int(j)] = float(value)
+    points = [points[i] for i in sorted(points)]
+
+    nearest = nodeindex.nearest_treenodes(project_id, skeletons, points)
+    if points and not nearest:
+        raise Exception('No treenodes were found for skeletons in %s' % skeletons)
+
+    return HttpResponse(json.dumps([{
+        'treenode_id': treenode_id,
+        'x': int(x),
+        'y': int(y),
+        'z': int(z),
+        'skeleton_id': skeleton_id} for treenode_id, x, y, z, skeleton_id in nearest]))
 
 
 def _fetch_location(location_id):
@@ -578,22 +886,30 @@ def _find_first_interesting_node(sequence):
     return sequence[-1]
 
 
+def _skeleton_arbor_of(project_id, treenode_id):
+    """ Returns the cached Arbor of the skeleton of a treenode and the index
+    of the treenode in it. """
+    skid = Treenode.objects.get(pk=treenode_id).skeleton_id
+    arbor = nodeindex.skeleton_arbor(project_id, skid)
+    return arbor, arbor.index(treenode_id)
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def find_previous_branchnode_or_root(request, project_id=None):
     try:
         tnid = int(request.POST['tnid'])
         alt = 1 == int(request.POST['alt'])
-        skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor, i = _skeleton_arbor_of(project_id, tnid)
         # Travel upstream until finding a parent node with more than one child
         # or reaching the root node
         seq = [] # Does not include the starting node tnid
         while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
+            parent = arbor.parents[i]
+            if parent != -1:
+                i = parent # Can ony have one parent
+                tnid = int(arbor.ids[i])
                 seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
+                if 1 != arbor.child_count(i):
                     break # Found a branch node
             else:
                 break # Found the root node
@@ -610,33 +926,28 @@ def find_previous_branchnode_or_root(request, project_id=None):
 def find_next_branchnode_or_end(request, project_id=None):
     try:
         tnid = int(request.POST['tnid'])
-        skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor, i = _skeleton_arbor_of(project_id, tnid)
 
-        children = graph.successors(tnid)
+        children = arbor.children(i)
         branches = []
-        for childNodeID in children:
+        for child in children:
             # Travel downstream until finding a child node with more than one
             # child or reaching an end node
+            childNodeID = int(arbor.ids[child])
             seq = [childNodeID] # Does not include the starting node tnid
-            branchEnd = childNodeID
-            while True:
-                branchChildren = graph.successors(branchEnd)
-                if 1 == len(branchChildren):
-                    branchEnd = branchChildren[0]
-                    seq.append(branchEnd)
-                else:
-                    break # Found an end node or a branch node
+            branchEnd = child
+            while 1 == arbor.child_count(branchEnd):
+                branchEnd = arbor.children(branchEnd)[0]
+                seq.append(int(arbor.ids[branchEnd]))
 
             branches.append([childNodeID,
                              _find_first_interesting_node(seq),
-                             branchEnd])
+                             int(arbor.ids[branchEnd])])
 
         # If more than one branch exists, sort based on downstream arbor size.
         if len(children) > 1:
-            branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
-                   reverse=True)
+            sizes = arbor.subtree_sizes()
+            branches.sort(key=lambda b: sizes[arbor.index(b[0])], reverse=True)
 
         # Leaf nodes will have no branches
         if len(children) > 0:
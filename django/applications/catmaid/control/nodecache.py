@@ -0,0 +1,182 @@
+""" A spatial cache for the results of node_list_tuples.
+
+The field of view of the tracing overlay is answered by merging the results of
+fixed grid cells. A cell is identified by its project, its section (the Z
+coordinate) and its position in a regular grid in the XY plane, whose cell
+size is configured with NODE_LIST_CACHE_CELL_SIZE. Cells only contain data
+that is independent of the requesting user. Write operations invalidate the
+cells that contain the changed nodes and their neighbors. Operations that
+change a lot of nodes at once (e.g. splitting or joining skeletons) invalidate
+all cells of a project by bumping a per-project version, which is part of
+every cell key.
+
+Invalidations happen while the changes are not committed yet, so that they
+can take the old locations of nodes into account. Other requests can still
+read the old data until the commit and store it in the cache again.
+Therefore, invalidations made within a transaction are repeated once the
+request is finished, which is after its transaction has been committed.
+
+Since invalidation needs to reach every worker process, a cache back-end
+shared between them (e.g. memcached) has to be configured if the cache is
+enabled with NODE_LIST_CACHE_ENABLED.
+"""
+
+import math
+import time
+
+from threading import local
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import connection
+from django.dispatch import receiver
+
+
+# The cell keys and project IDs invalidated within the transaction of the
+# current request of a thread
+_pending = local()
+
+
+def cache_enabled():
+    return settings.NODE_LIST_CACHE_ENABLED
+
+def _cell_size():
+    return float(settings.NODE_LIST_CACHE_CELL_SIZE)
+
+def _project_version(project_id):
+    """ Returns the current cache version of a project. If there is no version
+    stored yet (or it got evicted), a time based one is used. This makes sure
+    cells of an earlier version can't be used again.
+    """
+    key = 'catmaid.node-list-version-%s' % project_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+def _cell_key(project_id, version, z, i, j):
+    return 'catmaid.node-list-%s-%s-%r-%s-%s' % (project_id, version,
+            float(z), i, j)
+
+def cells_for_box(left, top, right, bottom):
+    """ Returns a list of (i, j, left, top, right, bottom) tuples, one for each
+    grid cell that intersects the given box. Cells are half-open, i.e. they
+    include their left and top border, but not their right and bottom border.
+    """
+    size = _cell_size()
+    cells = []
+    for i in xrange(int(math.floor(left / size)),
+                    int(math.floor(right / size)) + 1):
+        for j in xrange(int(math.floor(top / size)),
+                        int(math.floor(bottom / size)) + 1):
+            cells.append((i, j, i * size, j * size,
+                          (i + 1) * size, (j + 1) * size))
+    return cells
+
+def get_cells(project_id, z, cells, fetch):
+    """ Returns a list of the payloads of all passed in cells in the section z.
+    Cells not available in the cache are computed by calling fetch with the
+    cell's bounding box (left, top, right, bottom) and are stored afterwards.
+    """
+    version = _project_version(project_id)
+    keys = [_cell_key(project_id, version, z, c[0], c[1]) for c in cells]
+    cached = cache.get_many(keys)
+
+    payloads = []
+    for key, cell in zip(keys, cells):
+        payload = cached.get(key)
+        if payload is None:
+            payload = fetch(*cell[2:])
+            cache.set(key, payload, settings.NODE_LIST_CACHE_TIMEOUT)
+        payloads.append(payload)
+    return payloads
+
+def invalidate_cells(project_id, treenode_ids=(), connector_ids=()):
+    """ Removes all cells that could contain the passed in treenodes or
+    connectors. These are the cells of the nodes themselves, of the parents and
+    children of the treenodes and of all nodes linked to the connectors, as
+    well as the cells of all connectors linked to these treenodes. Since this
+    takes current locations into account, it has to be called before and after
+    nodes are moved or removed.
+    """
+    if not cache_enabled():
+        return
+    treenode_ids = [int(tid) for tid in treenode_ids]
+    connector_ids = [int(cid) for cid in connector_ids]
+    if not treenode_ids and not connector_ids:
+        return
+
+    cursor = connection.cursor()
+    cursor.execute('''
+    WITH changed AS (
+        SELECT unnest(%(treenode_ids)s::bigint[]) AS id
+        UNION
+        SELECT tc.treenode_id
+        FROM treenode_connector tc
+        WHERE tc.connector_id = ANY(%(connector_ids)s::bigint[])
+    )
+    SELECT DISTINCT location_x, location_y, location_z
+    FROM location
+    WHERE id IN (
+        SELECT id FROM changed
+        UNION
+        SELECT t.parent_id FROM treenode t JOIN changed c ON t.id = c.id
+        UNION
+        SELECT t.id FROM treenode t JOIN changed c ON t.parent_id = c.id
+        UNION
+        SELECT tc.connector_id
+        FROM treenode_connector tc JOIN changed c ON tc.treenode_id = c.id
+        UNION
+        SELECT unnest(%(connector_ids)s::bigint[])
+    )
+    ''', {'treenode_ids': treenode_ids, 'connector_ids': connector_ids})
+
+    version = _project_version(project_id)
+    size = _cell_size()
+    keys = set()
+    for x, y, z in cursor.fetchall():
+        keys.add(_cell_key(project_id, version, z,
+                int(math.floor(x / size)), int(math.floor(y / size))))
+    if keys:
+        cache.delete_many(list(keys))
+        _add_pending('keys', keys)
+
+def invalidate_project(project_id):
+    """ Makes all cached cells of a project unreachable by bumping its cache
+    version.
+    """
+    if not cache_enabled():
+        return
+    _bump_project_version(project_id)
+    _add_pending('project_ids', [project_id])
+
+def _bump_project_version(project_id):
+    key = 'catmaid.node-list-version-%s' % project_id
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The version is not available anymore, a new one is created lazily.
+        pass
+
+def _add_pending(name, values):
+    """ Remembers invalidated cell keys or project IDs to invalidate them again
+    after the current transaction, if there is one. """
+    if connection.in_atomic_block:
+        if not hasattr(_pending, name):
+            setattr(_pending, name, set())
+        getattr(_pending, name).update(values)
+
+@receiver(request_finished)
+def invalidate_pending(**kwargs):
+    """ Repeats the invalidations made within the transaction of the finished
+    request, which may have let other requests cache data that is outdated
+    now that the transaction has been committed. """
+    keys = getattr(_pending, 'keys', None)
+    project_ids = getattr(_pending, 'project_ids', None)
+    _pending.keys, _pending.project_ids = set(), set()
+    if keys:
+        cache.delete_many(list(keys))
+    for project_id in project_ids or ():
+        _bump_project_version(project_id)
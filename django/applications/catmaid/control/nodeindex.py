@@ -0,0 +1,147 @@
+""" Per-skeleton indices of treenodes, which are cached in the process.
+
+The treenode locations of a skeleton are kept in a KD-tree (or in a plain
+array, if scipy isn't available) for nearest node lookups, and its topology is
+kept in a compact Arbor for navigation. Before a cached index is used, it is
+validated against the edit version of the skeleton, which a database trigger
+sets in its skeleton_summary row to a new value of a sequence whenever one of
+its treenodes is added, removed or changed. Reading this fingerprint is a
+primary key lookup, independent of the size of the skeleton. Since a version
+is never handed out twice, every committed edit causes the index to be
+rebuilt, even if it was made by a transaction that started earlier.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from django.db import connection
+
+from catmaid.control.tree_util import Arbor
+
+try:
+    from scipy.spatial import cKDTree
+except:
+    cKDTree = None
+
+
+# The maximum number of skeleton indices kept in memory
+MAX_CACHED_SKELETONS = 50
+
+_indices = OrderedDict()
+_arbors = OrderedDict()
+
+
+class SkeletonIndex(object):
+    """ The treenode IDs and locations of a skeleton. """
+
+    def __init__(self, skeleton_id, fingerprint, rows):
+        self.skeleton_id = skeleton_id
+        self.fingerprint = fingerprint
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.locations = np.array([row[1:4] for row in rows],
+                dtype=np.float64).reshape((-1, 3))
+        self.tree = cKDTree(self.locations) \
+                if cKDTree is not None and len(rows) > 0 else None
+
+    def query(self, points):
+        """ Returns an array of squared distances and one of indices into ids
+        and locations of the nearest treenode for each of the passed in points.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+        if self.tree is not None:
+            distances, indices = self.tree.query(points)
+            return distances ** 2, indices
+        distances = np.empty(len(points))
+        indices = np.empty(len(points), dtype=np.int64)
+        for n, point in enumerate(points):
+            d = ((self.locations - point) ** 2).sum(axis=1)
+            indices[n] = d.argmin()
+            distances[n] = d[indices[n]]
+        return distances, indices
+
+
+def _fingerprints(cursor, project_id, skeleton_ids):
+    cursor.execute('''
+    SELECT skeleton_id, edit_version
+    FROM skeleton_summary
+    WHERE project_id = %s
+      AND skeleton_id = ANY(%s::bigint[])
+    ''', (project_id, list(skeleton_ids)))
+    return dict(cursor.fetchall())
+
+def skeleton_indices(project_id, skeleton_ids):
+    """ Returns a list of up to date SkeletonIndex objects for all of the
+    passed in skeletons that have treenodes.
+    """
+    cursor = connection.cursor()
+    fingerprints = _fingerprints(cursor, int(project_id),
+            set(int(skid) for skid in skeleton_ids))
+
+    def build(skeleton_id, fingerprint):
+        cursor.execute('''
+        SELECT id, location_x, location_y, location_z
+        FROM treenode
+        WHERE skeleton_id = %s
+        ''', (skeleton_id,))
+        return SkeletonIndex(skeleton_id, fingerprint, cursor.fetchall())
+
+    return [_get_cached(_indices, skeleton_id, fingerprint, build)
+            for skeleton_id, fingerprint in fingerprints.iteritems()]
+
+def skeleton_arbor(project_id, skeleton_id):
+    """ Returns an up to date Arbor of the passed in skeleton, or None if the
+    skeleton has no treenodes.
+    """
+    cursor = connection.cursor()
+    skeleton_id = int(skeleton_id)
+    fingerprint = _fingerprints(cursor, int(project_id), [skeleton_id]).get(skeleton_id)
+    if fingerprint is None:
+        return None
+
+    def build(skeleton_id, fingerprint):
+        cursor.execute('''
+        SELECT id, parent_id
+        FROM treenode
+        WHERE skeleton_id = %s
+        ''', (skeleton_id,))
+        rows = cursor.fetchall()
+        arbor = Arbor([row[0] for row in rows], [row[1] for row in rows])
+        arbor.fingerprint = fingerprint
+        return arbor
+
+    return _get_cached(_arbors, skeleton_id, fingerprint, build)
+
+def _get_cached(cache, skeleton_id, fingerprint, build):
+    """ Returns the entry of a skeleton from the passed in cache if its
+    fingerprint matches, otherwise a new one is built and stored.
+    """
+    entry = cache.pop(skeleton_id, None)
+    if entry is None or entry.fingerprint != fingerprint:
+        entry = build(skeleton_id, fingerprint)
+    # Move the entry to the end to discard the least recently used first
+    cache[skeleton_id] = entry
+    while len(cache) > MAX_CACHED_SKELETONS:
+        cache.popitem(last=False)
+    return entry
+
+def nearest_treenodes(project_id, skeleton_ids, points):
+    """ Returns for each of the passed in (x, y, z) points a tuple of treenode
+    ID, x, y, z and skeleton ID of the nearest treenode in any of the passed in
+    skeletons. If the skeletons have no treenodes, an empty list is returned.
+    """
+    indices = skeleton_indices(project_id, skeleton_ids)
+    if not indices or not len(points):
+        return []
+
+    best = None
+    for index in indices:
+        distances, nearest = index.query(points)
+        if best is None:
+            best = [(d, index, i) for d, i in zip(distances, nearest)]
+        else:
+            best = [b if b[0] <= d else (d, index, i)
+                    for b, d, i in zip(best, distances, nearest)]
+
+    return [(int(index.ids[i]),) + tuple(float(v) for v in index.locations[i]) +
+            (index.skeleton_id,) for d, index, i in best]
@@ -0,0 +1,78 @@
+""" A cache of the connectivity partners of skeletons.
+
+For every skeleton, the skeleton_partner_cache table stores the number of
+connector links it shares with each partner skeleton, per pair of link
+relations. The rows of a skeleton are computed with a single self-join of the
+treenode_connector table the first time they are requested, after which its
+summary is marked with partners_cached. A database trigger removes them again
+whenever a link to one of the connectors involved changes.
+"""
+
+from django.db import connection, transaction
+
+
+# The maximum number of skeletons whose partners are computed at once
+PARTNER_CACHE_FILL_BATCH_SIZE = 100
+
+def _fill(cursor, skeleton_ids):
+    """ Computes the partners of all passed in skeletons that aren't cached,
+    in batches of PARTNER_CACHE_FILL_BATCH_SIZE skeletons. """
+    cursor.execute('''
+    SELECT skeleton_id FROM skeleton_summary
+    WHERE skeleton_id = ANY(%s::bigint[])
+      AND NOT partners_cached
+    ORDER BY skeleton_id
+    ''', (skeleton_ids,))
+    missing = [row[0] for row in cursor.fetchall()]
+    for i in xrange(0, len(missing), PARTNER_CACHE_FILL_BATCH_SIZE):
+        _fill_batch(cursor, missing[i:i + PARTNER_CACHE_FILL_BATCH_SIZE])
+
+def _fill_batch(cursor, skeleton_ids):
+    """ The summary rows are locked first, so that concurrent link changes are
+    either included or invalidate the new rows afterwards. Unless this is
+    called within a transaction, the locks are released after each batch. """
+    with transaction.atomic():
+        cursor.execute('''
+        SELECT skeleton_id FROM skeleton_summary
+        WHERE skeleton_id = ANY(%s::bigint[])
+          AND NOT partners_cached
+        ORDER BY skeleton_id
+        FOR UPDATE
+        ''', (skeleton_ids,))
+        missing = [row[0] for row in cursor.fetchall()]
+        if not missing:
+            return
+
+        cursor.execute('''
+        INSERT INTO skeleton_partner_cache (skeleton_id, relation_id,
+            partner_id, partner_relation_id, num_links)
+        SELECT t1.skeleton_id, t1.relation_id, t2.skeleton_id, t2.relation_id,
+               count(*)
+        FROM treenode_connector t1,
+             treenode_connector t2
+        WHERE t1.skeleton_id = ANY(%s::bigint[])
+          AND t1.connector_id = t2.connector_id
+          AND t1.id <> t2.id
+        GROUP BY t1.skeleton_id, t1.relation_id, t2.skeleton_id, t2.relation_id
+        ''', (missing,))
+        cursor.execute('''
+        UPDATE skeleton_summary SET partners_cached = true
+        WHERE skeleton_id = ANY(%s::bigint[])
+        ''', (missing,))
+
+def partner_links(skeleton_ids, relation_id, partner_relation_id, cursor=None):
+    """ Returns a list of (skeleton ID, partner skeleton ID, number of links)
+    tuples for all of the passed in skeletons, which are linked with
+    relation_id to connectors that partners are linked to with
+    partner_relation_id. """
+    skeleton_ids = list(set(int(skid) for skid in skeleton_ids))
+    cursor = cursor or connection.cursor()
+    _fill(cursor, skeleton_ids)
+    cursor.execute('''
+    SELECT skeleton_id, partner_id, num_links
+    FROM skeleton_partner_cache
+    WHERE skeleton_id = ANY(%s::bigint[])
+      AND relation_id = %s
+      AND partner_relation_id = %s
+    ''', (skeleton_ids, int(relation_id), int(partner_relation_id)))
+    return cursor.fetchall()
@@ -8,6 +8,8 @@ from django.http import HttpResponse
 
 from catmaid.models import UserRole, Review, ReviewerWhitelist
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.skeletonsummary import skeleton_summaries, node_counts, \
+        review_counts
 
 
 def get_treenodes_to_reviews(treenode_ids=None, skeleton_ids=None,
@@ -61,20 +63,7 @@ def get_review_count(skeleton_ids):
     """ Returns a dictionary that maps skelton IDs to dictonaries that map
     user_ids to a review count for this particular skeleton.
     """
-    # Count nodes that have been reviewed by each user in each partner skeleton
-    cursor = connection.cursor()
-    cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM review
-    WHERE skeleton_id IN (%s)
-    GROUP BY reviewer_id, skeleton_id
-    ''' % ",".join(map(str, skeleton_ids)))
-    # Build dictionary
-    reviews = defaultdict(lambda: defaultdict(int))
-    for row in cursor.fetchall():
-        reviews[row[0]][row[1]] = row[2]
-
-    return reviews
+    return review_counts(skeleton_ids)
 
 def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
         user_ids=None, excluding_user_ids=None):
@@ -98,14 +87,17 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
     skeletons = defaultdict(Skeleton)
 
     # Count nodes of each skeleton
-    cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
-    ''' % ",".join(map(str, skeleton_ids)))
-    for row in cursor.fetchall():
-        skeletons[row[0]].num_nodes = row[1]
+    for skid, num_nodes in node_counts(skeleton_ids, cursor).iteritems():
+        skeletons[skid].num_nodes = num_nodes
+
+    # The union of all reviews is available from the skeleton summary. The
+    # review counts of single users can't be used instead of the query below,
+    # because they count reviews rather than reviewed nodes.
+    if not whitelist_id and not excluding_user_ids and not user_ids:
+        for skid, row in skeleton_summaries(skeleton_ids,
+                ('num_reviewed',), cursor).iteritems():
+            skeletons[skid].num_reviewed = row[0]
+        return _review_ratios(skeletons)
 
     query_joins = ""
     # Optionally, add a filter
@@ -143,6 +135,9 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
     for row in cursor.fetchall():
         skeletons[row[0]].num_reviewed = row[1]
 
+    return _review_ratios(skeletons)
+
+def _review_ratios(skeletons):
     status = {}
     for skid, s in skeletons.iteritems():
         ratio = int(100 * s.num_reviewed / s.num_nodes)
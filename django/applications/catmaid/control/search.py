@@ -1,5 +1,6 @@
 import json
 
+from django.db import connection
 from django.http import HttpResponse
 
 from catmaid.models import UserRole, ClassInstance, TreenodeClassInstance
@@ -7,6 +8,66 @@ from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
 
 
+def _escape_like(search_string):
+    """ Escapes the wildcards of LIKE patterns in the passed in string. """
+    return search_string.replace('\\', '\\\\').replace('%', '\\%') \
+            .replace('_', '\\_')
+
+def find_class_instances(project_id, search_string, prefix=False,
+        ranked=False, limit=None, class_names=None):
+    """ Returns a list of (id, name, class name) tuples of the class instances
+    in a project whose name contains the search string, ignoring case. With
+    prefix set, names have to start with the search string. Results are
+    ordered by class name and name or, if ranked, by how well they match:
+    exact matches come first, then names that start with the search string,
+    names with a word that starts with it and all other names, shorter names
+    first. Optionally, only the first limit results are returned and only
+    instances of the passed in classes are looked at.
+
+    Substring matches are answered by the trigram index on class instance
+    names (if the pg_trgm extension is available) and prefix matches by the
+    index on project and lower case name.
+    """
+    escaped = _escape_like(search_string.lower())
+    params = {
+        'project_id': project_id,
+        'lower': search_string.lower(),
+        'prefix': escaped + '%',
+        'word': '% ' + escaped + '%',
+        'substring': '%' + escaped + '%',
+        'class_names': list(class_names or []),
+        'limit': limit,
+    }
+    if prefix:
+        condition = 'lower(ci.name) LIKE %(prefix)s'
+    else:
+        condition = 'ci.name ILIKE %(substring)s'
+    if class_names is not None:
+        condition += ' AND c.class_name = ANY(%(class_names)s)'
+    if ranked:
+        order = '''
+        CASE WHEN lower(ci.name) = %(lower)s THEN 0
+             WHEN lower(ci.name) LIKE %(prefix)s THEN 1
+             WHEN ci.name ILIKE %(word)s THEN 2
+             ELSE 3
+        END, length(ci.name), ci.name, ci.id'''
+    else:
+        order = 'c.class_name, ci.name'
+
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT ci.id, ci.name, c.class_name
+    FROM class_instance ci
+    JOIN class c ON c.id = ci.class_id
+    WHERE ci.project_id = %%(project_id)s
+      AND %s
+    ORDER BY %s
+    %s
+    ''' % (condition, order, '' if limit is None else 'LIMIT %(limit)s'),
+            params)
+    return cursor.fetchall()
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def search(request, project_id=None):
     def format_node_data(node):
@@ -25,17 +86,17 @@ def search(request, project_id=None):
             'skid': node['treenode__skeleton']}
 
     search_string = request.GET.get('substring', "")
-
-    ids = set()
+    prefix = bool(int(request.GET.get('prefix', 0)))
+    ranked = bool(int(request.GET.get('rank', 0)))
+    max_results = request.GET.get('max_results')
+    limit = int(max_results) if max_results else None
 
     # 1. Query ClassInstance objects, where the name contains the search string.
     # This retrieves neurons, skeletons and groups by name.
-    row_query = ClassInstance.objects.values('id', 'name', 'class_column__class_name').filter(
-        name__icontains=search_string,
-        project=project_id).order_by('class_column__class_name', 'name')
-    rows = list(row_query)
-    for row in rows:
-        ids.add(row['id'])
+    rows = [{'id': row[0], 'name': row[1], 'class_name': row[2]}
+            for row in find_class_instances(int(project_id), search_string,
+                prefix, ranked, limit)]
+    ids = set(row['id'] for row in rows)
 
     # 2. Query skeletons and neurons by ID, if the search string is a number
     try:
@@ -46,6 +107,7 @@ def search(request, project_id=None):
                 ).values('id', 'name', 'class_column__class_name')
         for row in oid_query:
             if row['id'] not in ids:
+                row['class_name'] = row.pop('class_column__class_name')
                 rows.append(row)
     except ValueError:
         pass
@@ -53,21 +115,17 @@ def search(request, project_id=None):
     # 3. Query labels in treenodes. First get a list of matching labels,
     # and then find a list of treenodes for each label.
     relation_map = get_relation_to_id_map(project_id)
-    matching_labels = set()
     label_rows = {}
     for row in rows:
-        # Change key-name of class_column__class_name for json output
-        row['class_name'] = row.pop('class_column__class_name')
         # Prepare for retrieving nodes holding text labels
         if row['class_name'] == 'label':
-            matching_labels.add(row['name'])
             label_rows[row['id']] = row
 
     node_query = TreenodeClassInstance.objects.filter(
         project=project_id,
         treenode__project=project_id,
         relation=relation_map['labeled_as'],
-        class_instance__name__in=matching_labels)\
+        class_instance__in=label_rows.keys())\
     .order_by('-treenode__id')\
     .values('treenode',
         'treenode__location_x',
@@ -5,12 +5,11 @@ import re
 from operator import itemgetter
 from datetime import datetime, timedelta
 from collections import defaultdict
-from itertools import chain
 
 from django.core.serializers.json import DjangoJSONEncoder
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.db import connection
+from django.db import connection, transaction
 
 from catmaid.models import Project, UserRole, Class, ClassInstance, Review, \
         ClassInstanceClassInstance, Relation, Treenode, TreenodeConnector
@@ -25,6 +24,10 @@ from catmaid.control.neuron_annotations import create_annotation_query, \
 from catmaid.control.review import get_treenodes_to_reviews, get_review_status
 from catmaid.control.treenode import _create_interpolated_treenode
 from catmaid.control.tree_util import find_root, reroot, edge_count_to_root
+from catmaid.control.skeletonsummary import skeleton_summaries, node_counts, \
+        review_counts
+from catmaid.control.partnercache import partner_links
+from catmaid.control import nodecache
 
 
 def get_skeleton_permissions(request, project_id, skeleton_id):
@@ -113,15 +116,17 @@ def skeleton_statistics(request, project_id=None, skeleton_id=None):
     skel = Skeleton( skeleton_id = skeleton_id, project_id = project_id )
     const_time = skel.measure_construction_time()
     construction_time = '{0} minutes {1} seconds'.format( const_time / 60, const_time % 60)
+    num_nodes, num_reviewed, cable_length = skeleton_summaries([skeleton_id],
+            ('num_nodes', 'num_reviewed', 'cable_length')).get(int(skeleton_id), (0, 0, 0))
     return HttpResponse(json.dumps({
-        'node_count': skel.node_count(),
+        'node_count': num_nodes,
         'input_count': skel.input_count(),
         'output_count': skel.output_count(),
         'presynaptic_sites': skel.presynaptic_sites_count(),
         'postsynaptic_sites': skel.postsynaptic_sites_count(),
-        'cable_length': int(skel.cable_length()),
+        'cable_length': int(cable_length),
         'measure_construction_time': construction_time,
-        'percentage_reviewed': "%.2f" % skel.percentage_reviewed() }), content_type='text/json')
+        'percentage_reviewed': "%.2f" % (100.0 * num_reviewed / num_nodes if num_nodes else 0.0) }), content_type='text/json')
 
 # Will fail if skeleton_id does not exist
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -192,7 +197,7 @@ def node_count(request, project_id=None, skeleton_id=None, treenode_id=None):
     if not skeleton_id:
         skeleton_id = Treenode.objects.get(pk=treenode_id).skeleton_id
     return HttpResponse(json.dumps({
-        'count': Treenode.objects.filter(skeleton_id=skeleton_id).count(),
+        'count': node_counts([skeleton_id]).get(int(skeleton_id), 0),
         'skeleton_id': skeleton_id}), content_type='text/json')
 
 def _get_neuronname_from_skeletonid( project_id, skeleton_id ):
@@ -386,6 +391,9 @@ def split_skeleton(request, project_id=None):
     # refer to the new skeleton.
     Review.objects.filter(treenode_id__in=change_list).update(skeleton=new_skeleton)
 
+    # Cached node list cells of the whole skeleton refer to the old skeleton
+    nodecache.invalidate_project(project_id)
+
     # Update annotations of under skeleton
     _annotate_entities(project_id, [new_neuron.id], downstream_annotation_map)
 
@@ -492,20 +500,12 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
         return Partner()
     partners = defaultdict(newPartner)
 
-    # Obtain the synapses made by all skeleton_ids considering the desired direction of the synapse, as specified by relation_id_1 and relation_id_2:
-    cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t2.relation_id = %s
-    ''' % (','.join(map(str, skeleton_ids)), int(relation_id_1), int(relation_id_2)))
-
-    # Sum the number of synapses
-    for srcID, partnerID in cursor.fetchall():
-        partners[partnerID].skids[srcID] += 1
+    # Obtain the synapses made by all skeleton_ids considering the desired
+    # direction of the synapse, as specified by relation_id_1 and
+    # relation_id_2, from the partner cache.
+    for srcID, partnerID, count in partner_links(skeleton_ids, relation_id_1,
+            relation_id_2, cursor):
+        partners[partnerID].skids[srcID] += count
 
     # There may not be any synapses
     if not partners:
@@ -524,39 +524,17 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
     # Obtain a string with unique skeletons
     skids_string = ','.join(map(str, partners.iterkeys()))
 
-    # Count nodes of each partner skeleton
-    cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
-    ''' % skids_string) # no need to sanitize
-    for row in cursor.fetchall():
-        partners[row[0]].num_nodes = row[1]
+    # Count nodes and the total number of reviewed nodes of each partner
+    # skeleton
+    for skid, row in skeleton_summaries(partners.keys(),
+            ('num_nodes', 'num_reviewed'), cursor).iteritems():
+        partner = partners[skid]
+        partner.num_nodes = row[0]
+        partner.union_reviewed = row[1]
 
     # Count nodes that have been reviewed by each user in each partner skeleton
-    cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM review
-    WHERE skeleton_id IN (%s)
-    GROUP BY reviewer_id, skeleton_id
-    ''' % skids_string) # no need to sanitize
-    for row in cursor.fetchall():
-        partner = partners[row[0]]
-        partner.reviewed[row[1]] = row[2]
-
-    # Count total number of reviewed nodes per skeleton
-    cursor.execute('''
-    SELECT skeleton_id, count(*)
-    FROM (SELECT skeleton_id, treenode_id
-          FROM review
-          WHERE skeleton_id IN (%s)
-          GROUP BY skeleton_id, treenode_id) AS sub
-    GROUP BY skeleton_id
-    ''' % skids_string) # no need to sanitize
-    for row in cursor.fetchall():
-        partner = partners[row[0]]
-        partner.union_reviewed = row[1]
+    for skid, reviewers in review_counts(partners.keys(), cursor).iteritems():
+        partners[skid].reviewed.update(reviewers)
 
     # Obtain name of each skeleton's neuron
     cursor.execute('''
@@ -726,44 +704,50 @@ def _reroot_skeleton(treenode_id, project_id):
         # Obtain the treenode from the response
         response_on_error = 'An error occured while rerooting. No valid query result.'
         treenode = q_treenode[0]
-        first_parent = treenode.parent
 
         # If no parent found it is assumed this node is already root
-        if first_parent is None:
+        if treenode.parent_id is None:
             return False
 
-        # Traverse up the chain of parents, reversing the parent relationships so
-        # that the selected treenode (with ID treenode_id) becomes the root.
-        new_parent = treenode
-        new_confidence = treenode.confidence
-        node = first_parent
-
-        while True:
-            response_on_error = 'Failed to update treenode with id %s to have new parent %s' % (node.id, new_parent.id)
-
-            # Store current values to be used in next iteration
-            parent = node.parent
-            confidence = node.confidence
+        # Fetch the parent array of the whole skeleton at once and walk it in
+        # memory from the selected treenode up to the current root.
+        response_on_error = 'Failed to retrieve the treenodes of skeleton %s' % treenode.skeleton_id
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT id, parent_id, confidence
+            FROM treenode
+            WHERE skeleton_id = %s
+        ''', (treenode.skeleton_id,))
+        parents = {row[0]: row[1:] for row in cursor.fetchall()}
+
+        response_on_error = 'Failed to find the path to the root of treenode %s' % treenode.id
+        path = []
+        node_id = treenode.id
+        while node_id is not None:
+            parent_id, confidence = parents[node_id]
+            path.append((node_id, confidence))
+            node_id = parent_id
+
+        # Reverse the parent relationships along the path, so that the
+        # selected treenode becomes the root. Every node takes over the
+        # confidence of the edge to its former child.
+        values = [treenode.id, None, 5] # reset to maximum confidence, now it is root.
+        for child, parent in zip(path, path[1:]):
+            values.extend((parent[0], child[0], child[1]))
+
+        response_on_error = 'Failed to update the parents of the path to treenode %s' % treenode.id
+        cursor.execute('''
+            UPDATE treenode SET
+                parent_id = v.parent_id::bigint,
+                confidence = v.confidence
+            FROM (VALUES %s) AS v(id, parent_id, confidence)
+            WHERE treenode.id = v.id
+        ''' % ','.join(['(%s,%s,%s)'] * len(path)), values)
 
-            # Set new values
-            node.parent = new_parent
-            node.confidence = new_confidence
-            node.save()
-
-            if parent is None:
-                # Root has been reached
-                break
-            else:
-                # Prepare next iteration
-                new_parent = node
-                new_confidence = confidence
-                node = parent
-
-        # Finally make treenode root
-        response_on_error = 'Failed to set treenode with ID %s as root.' % treenode.id
         treenode.parent = None
-        treenode.confidence = 5 # reset to maximum confidence, now it is root.
-        treenode.save()
+        treenode.confidence = 5
+
+        nodecache.invalidate_project(project_id)
 
         return treenode
 
@@ -897,6 +881,7 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         # Update the parent of to_treenode.
         response_on_error = 'Could not update parent of treenode with ID %s' % to_treenode_id
         Treenode.objects.filter(id=to_treenode_id).update(parent=from_treenode_id, editor=user)
+        nodecache.invalidate_project(project_id)
 
         # Update linked annotations of neuron
         response_on_error = 'Could not update annotations of neuron ' \
@@ -956,6 +941,9 @@ def join_skeletons_interpolated(request, project_id=None):
     return HttpResponse(json.dumps({'treenode_id': params['to_id']}))
 
 
+# Number of treenodes inserted with a single statement by _import_skeleton
+IMPORT_BATCH_SIZE = 10000
+
 def _import_skeleton(request, project_id, arborescence, neuron_id=None, name=None):
     """Create a skeleton from a networkx directed tree.
 
@@ -1019,55 +1007,124 @@ def _import_skeleton(request, project_id, arborescence, neuron_id=None, name=Non
     if root is None:
         raise Exception('No root, provided graph is malformed!')
 
-    # Bulk create the required number of treenodes. This must be done in two
-    # steps because treenode IDs are not known.
+    # Order the treenodes so that every parent precedes its children. This
+    # allows inserting them in batches without violating the parent foreign
+    # key.
+    ordered = [root] + [child for parent, child in nx.bfs_edges(arborescence, root)]
+    if len(ordered) != arborescence.number_of_nodes():
+        raise Exception('Not all nodes are connected to the root, provided ' \
+                'graph is malformed!')
+
+    # Reserve the IDs of all new treenodes with a single query
     cursor = connection.cursor()
     cursor.execute("""
-        INSERT INTO treenode (project_id, location_x, location_y, location_z,
-            editor_id, user_id, skeleton_id)
-        SELECT t.project_id, t.x, t.x, t.x, t.user_id, t.user_id, t.skeleton_id
-        FROM (VALUES (%(project_id)s, 0, %(user_id)s, %(skeleton_id)s))
-            AS t (project_id, x, user_id, skeleton_id),
-            generate_series(1, %(num_treenodes)s)
-        RETURNING treenode.id;
-        """ % {
-            'project_id': project_id,
-            'user_id': request.user.id,
-            'skeleton_id': new_skeleton.id,
-            'num_treenodes': arborescence.number_of_nodes()})
-    treenode_ids = cursor.fetchall()
-    # Flatten IDs
-    treenode_ids = list(chain.from_iterable(treenode_ids))
-    nx.set_node_attributes(arborescence, 'id', dict(zip(arborescence.nodes(), treenode_ids)))
+        SELECT nextval('location_id_seq') FROM generate_series(1, %s)
+        """, (len(ordered),))
+    treenode_ids = [row[0] for row in cursor.fetchall()]
+    nx.set_node_attributes(arborescence, 'id', dict(zip(ordered, treenode_ids)))
 
     # Set parent node ID
     for n, nbrs in arborescence.adjacency_iter():
         for nbr in nbrs:
             arborescence.node[nbr]['parent_id'] = arborescence.node[n]['id']
-    arborescence.node[root]['parent_id'] = 'NULL'
+    arborescence.node[root]['parent_id'] = None
     new_location = tuple([arborescence.node[root][k] for k in ('x', 'y', 'z')])
 
-    treenode_values = \
-            '),('.join([','.join(map(str, [n[1][k] for k in ('id', 'x', 'y', 'z', 'parent_id')])) \
-            for n in arborescence.nodes_iter(data=True)])
-    cursor.execute("""
-        UPDATE treenode SET
-            location_x = v.x,
-            location_y = v.y,
-            location_z = v.z,
-            parent_id = v.parent_id
-        FROM (VALUES (%s)) AS v(id, x, y, z, parent_id)
-        WHERE treenode.id = v.id AND treenode.skeleton_id = %s
-        """ % (treenode_values, new_skeleton.id)) # Include skeleton ID for index performance.
+    # Insert the treenodes with multi-row INSERTs of IMPORT_BATCH_SIZE rows
+    for i in xrange(0, len(ordered), IMPORT_BATCH_SIZE):
+        values = []
+        for n in ordered[i:i + IMPORT_BATCH_SIZE]:
+            node = arborescence.node[n]
+            values.extend((node['id'], node['parent_id'], node['x'], node['y'],
+                    node['z'], node.get('radius', -1), node.get('confidence', 5)))
+        cursor.execute("""
+            INSERT INTO treenode (id, project_id, user_id, editor_id,
+                skeleton_id, parent_id, location_x, location_y, location_z,
+                radius, confidence)
+            SELECT v.id, %%s, %%s, %%s, %%s, v.parent_id::bigint, v.x, v.y, v.z,
+                v.radius, v.confidence
+            FROM (VALUES %s) AS v(id, parent_id, x, y, z, radius, confidence)
+            """ % ','.join(['(%s,%s,%s,%s,%s,%s,%s)'] * (len(values) / 7)),
+            [project_id, request.user.id, request.user.id, new_skeleton.id] + values)
+
+    nodecache.invalidate_project(project_id)
 
     # Log import.
     insert_into_log(project_id, request.user.id, 'create_neuron',
                     new_location, 'Create neuron %d and skeleton '
-                    '%d via import' % (new_neuron.id, new_skeleton.id))
+                    '%d via import' % (neuron_id, new_skeleton.id))
 
     return {'neuron_id': neuron_id, 'skeleton_id': new_skeleton.id, 'graph': arborescence}
 
 
+
+def _parse_swc(lines):
+    """ Returns a networkx directed tree of the nodes of an SWC file, which is
+    read from an iterable of lines. Nodes have the attributes x, y, z and
+    radius. """
+    g = nx.DiGraph()
+    edges = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) < 7:
+            raise ValueError('Line %s of the SWC file has less than seven '
+                    'fields' % number)
+        node_id, parent_id = int(fields[0]), int(fields[6])
+        x, y, z, radius = (float(v) for v in fields[2:6])
+        g.add_node(node_id, {'x': x, 'y': y, 'z': z, 'radius': radius})
+        if -1 != parent_id:
+            edges.append((parent_id, node_id))
+    for parent_id, node_id in edges:
+        if parent_id not in g:
+            raise ValueError('SWC node %s has the unknown parent %s' % \
+                    (node_id, parent_id))
+        g.add_edge(parent_id, node_id)
+    if 0 == g.number_of_nodes():
+        raise ValueError('The SWC file contains no nodes')
+    return g
+
+
+@requires_user_role(UserRole.Annotate)
+def import_skeletons(request, project_id=None):
+    """ Imports all SWC files uploaded with the request, each as a new
+    skeleton of a new neuron, which are named after the file. All files are
+    parsed before any skeleton is created. The response is streamed and has
+    one line of JSON per file as soon as its skeleton is imported, with the
+    number of imported files so far ("done"), the total number of files
+    ("total") and either the new "neuron_id" and "skeleton_id" or an "error".
+    Every skeleton is imported in its own transaction.
+    """
+    project_id = int(project_id)
+    files = [f for key in request.FILES for f in request.FILES.getlist(key)]
+    if not files:
+        raise Exception("Must provide at least one SWC file.")
+
+    skeletons = []
+    for f in files:
+        try:
+            skeletons.append((f.name, _parse_swc(f)))
+        except ValueError as e:
+            raise Exception('Could not parse %s: %s' % (f.name, e))
+
+    def stream():
+        for done, (name, arborescence) in enumerate(skeletons, 1):
+            result = {'name': name, 'done': done, 'total': len(skeletons)}
+            try:
+                with transaction.atomic():
+                    imported = _import_skeleton(request, project_id,
+                            arborescence, name=name)
+                result['neuron_id'] = imported['neuron_id']
+                result['skeleton_id'] = imported['skeleton_id']
+            except Exception as e:
+                result['error'] = str(e)
+            yield json.dumps(result) + '\n'
+
+    return StreamingHttpResponse(stream(), content_type='text/plain')
+
+
 @requires_user_role(UserRole.Annotate)
 def reset_own_reviewer_ids(request, project_id=None, skeleton_id=None):
     """ Remove all reviews done by the requsting user in the skeleten with ID
@@ -1260,13 +1317,20 @@ def _list_skeletons(project_id, created_by=None, reviewed_by=None, from_date=Non
             to_date = to_date + timedelta(days=1)
             params.append(to_date.isoformat())
             query += " AND r.review_time < %s"
-    else:
+    elif created_by:
         params = [project_id]
         query = '''
             SELECT DISTINCT skeleton_id
             FROM treenode t
             WHERE t.project_id=%s
         '''
+    else:
+        params = [project_id]
+        query = '''
+            SELECT skeleton_id
+            FROM skeleton_summary s
+            WHERE s.project_id=%s
+        '''
 
     if created_by:
         params.append(created_by)
@@ -1283,12 +1347,9 @@ def _list_skeletons(project_id, created_by=None, reviewed_by=None, from_date=Non
     if nodecount_gt > 0:
         params.append(nodecount_gt)
         query = '''
-            SELECT sub.skeleton_id
-            FROM (
-                SELECT t.skeleton_id AS skeleton_id, COUNT(*) AS count
-                FROM (%s) q JOIN treenode t ON q.skeleton_id = t.skeleton_id
-                GROUP BY t.skeleton_id
-            ) AS sub WHERE sub.count > %%s
+            SELECT q.skeleton_id
+            FROM (%s) q JOIN skeleton_summary ss ON q.skeleton_id = ss.skeleton_id
+            WHERE ss.num_nodes > %%s
         ''' % query
 
     cursor = connection.cursor()
@@ -1,14 +1,15 @@
 import json
-import networkx as nx
-from itertools import imap
+import numpy as np
+from itertools import imap, count, chain, groupby
+from operator import itemgetter
 from functools import partial
 from collections import defaultdict
-from math import sqrt
+from contextlib import contextmanager
 from datetime import datetime
 
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import connection
-from django.http import HttpResponse
+from django.db import connection, transaction
+from django.http import HttpResponse, StreamingHttpResponse
 
 from catmaid.models import UserRole, ClassInstance, Treenode, \
         TreenodeClassInstance, ConnectorClassInstance, Review
@@ -17,7 +18,7 @@ from catmaid.control.authentication import requires_user_role
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
 
-from tree_util import edge_count_to_root, partition
+from tree_util import Arbor
 try:
     from exportneuroml import neuroml_single_cell, neuroml_network
 except ImportError:
@@ -241,6 +242,317 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
     return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
 
 
+# Number of rows fetched at once by streaming exports
+STREAM_BATCH_SIZE = 5000
+
+_stream_cursor_ids = count()
+
+def _declare_cursor(cursor, query, params=None):
+    """ Declares a server-side cursor for the query and returns its name. This
+    has to happen in a transaction, which the cursor doesn't outlive. """
+    name = 'stream_%s' % _stream_cursor_ids.next()
+    cursor.execute('DECLARE %s NO SCROLL CURSOR FOR %s' % (name, query), params)
+    return name
+
+def _fetch_batches(cursor, name):
+    """ Yields lists of at most STREAM_BATCH_SIZE rows from a server-side
+    cursor. """
+    while True:
+        cursor.execute('FETCH %s FROM %s' % (STREAM_BATCH_SIZE, name))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        yield rows
+
+@contextmanager
+def _snapshot():
+    """ Opens a transaction for streamed queries and returns its cursor. Unless
+    it is nested in another transaction, it is read-only and all queries see
+    the same snapshot of the database. """
+    in_transaction = connection.in_atomic_block
+    with transaction.atomic():
+        cursor = connection.cursor()
+        if not in_transaction:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        yield cursor
+
+def _stream_snapshot(stream):
+    """ Yields the chunks of the generator function stream, which is called
+    with the cursor of a _snapshot transaction. """
+    with _snapshot() as cursor:
+        for chunk in stream(cursor):
+            yield chunk
+
+def _stream_query(cursor, query, params=None):
+    """ Yields the rows of a query in batches of at most STREAM_BATCH_SIZE
+    rows, which are fetched from a server-side cursor. This keeps memory
+    use independent of the size of the result. The cursor has to be used
+    within a transaction (see _snapshot), which it doesn't outlive. """
+    name = _declare_cursor(cursor, query, params)
+    for rows in _fetch_batches(cursor, name):
+        yield rows
+
+def _stream_json_list(cursor, query, params=None, transform=None):
+    """ Yields the rows of a query as the items of a compact JSON list. If
+    transform is given, it is called for every row and can return None to
+    skip a row. """
+    yield '['
+    first = True
+    for rows in _stream_query(cursor, query, params):
+        if transform:
+            rows = [r for r in imap(transform, rows) if r is not None]
+        if not rows:
+            continue
+        chunk = ','.join(json.dumps(r, separators=(',', ':')) for r in rows)
+        yield chunk if first else ',' + chunk
+        first = False
+    yield ']'
+
+def _stream_tags(cursor, skeleton_id, labeled_as):
+    """ Yields the tags of the nodes of a skeleton as a JSON object of tag
+    name vs list of node IDs. """
+    yield '{'
+    name = None
+    for rows in _stream_query(cursor, '''
+            SELECT c.name, tci.treenode_id
+            FROM treenode t,
+                 treenode_class_instance tci,
+                 class_instance c
+            WHERE t.skeleton_id = %s
+              AND t.id = tci.treenode_id
+              AND tci.relation_id = %s
+              AND c.id = tci.class_instance_id
+            ORDER BY c.name
+            ''', (skeleton_id, labeled_as)):
+        chunk = []
+        for row in rows:
+            if row[0] != name:
+                chunk.append('%s%s:[%s' % ('' if name is None else '],',
+                        json.dumps(row[0]), row[1]))
+                name = row[0]
+            else:
+                chunk.append(',%s' % row[1])
+        yield ''.join(chunk)
+    yield '}' if name is None else ']}'
+
+def _stream_compact_nodes(cursor, skeleton_id):
+    return _stream_json_list(cursor, '''
+            SELECT id, parent_id, user_id,
+                   location_x, location_y, location_z,
+                   radius, confidence
+            FROM treenode
+            WHERE skeleton_id = %s
+            ''', (skeleton_id,))
+
+def _check_skeleton_exists(project_id, skeleton_id):
+    # Streamed responses can't fail after the first row, check this up front
+    if not ClassInstance.objects.filter(pk=skeleton_id,
+            project_id=project_id).exists():
+        raise Exception("Skeleton #%s doesn't exist in project #%s" % (
+                skeleton_id, project_id))
+
+def _relations(project_id):
+    cursor = connection.cursor()
+    cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
+    return dict(cursor.fetchall())
+
+
+@requires_user_role(UserRole.Browse)
+def stream_compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors=None, with_tags=None):
+    """ Streaming variant of compact_skeleton, which sends the result while it
+    is read from the database. Memory use doesn't grow with the skeleton size.
+    """
+    project_id = int(project_id)
+    skeleton_id = int(skeleton_id)
+    with_connectors  = int(with_connectors)
+    with_tags = int(with_tags)
+
+    _check_skeleton_exists(project_id, skeleton_id)
+    relations = _relations(project_id) if with_connectors or with_tags else {}
+
+    def stream(cursor):
+        yield '['
+        for chunk in _stream_compact_nodes(cursor, skeleton_id):
+            yield chunk
+        yield ','
+        if 0 != with_connectors:
+            post = relations['postsynaptic_to']
+            for chunk in _stream_json_list(cursor, '''
+                    SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
+                           c.location_x, c.location_y, c.location_z
+                    FROM treenode_connector tc,
+                         connector c
+                    WHERE tc.skeleton_id = %s
+                      AND tc.connector_id = c.id
+                    ''', (skeleton_id,), lambda row: (row[0], row[1],
+                        1 if row[2] == post else 0, row[3], row[4], row[5])):
+                yield chunk
+        else:
+            yield '[]'
+        yield ','
+        if 0 != with_tags:
+            for chunk in _stream_tags(cursor, skeleton_id, relations['labeled_as']):
+                yield chunk
+        else:
+            yield '{}'
+        yield ']'
+
+    return StreamingHttpResponse(_stream_snapshot(stream))
+
+
+@requires_user_role(UserRole.Browse)
+def stream_compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, with_connectors=None, with_tags=None):
+    """ Streaming variant of compact_arbor, which sends the result while it is
+    read from the database. Memory use doesn't grow with the skeleton size.
+    """
+    project_id = int(project_id)
+    skeleton_id = int(skeleton_id)
+    with_nodes = int(with_nodes)
+    with_connectors  = int(with_connectors)
+    with_tags = int(with_tags)
+
+    _check_skeleton_exists(project_id, skeleton_id)
+    relations = _relations(project_id) if with_connectors or with_tags else {}
+
+    def stream(cursor):
+        yield '['
+        if 0 != with_nodes:
+            for chunk in _stream_compact_nodes(cursor, skeleton_id):
+                yield chunk
+        else:
+            yield '[]'
+        yield ','
+        if 0 != with_connectors:
+            pre = relations['presynaptic_to']
+            post = relations['postsynaptic_to']
+
+            def transform(row):
+                # Ignore all other kinds of relation pairs (there shouldn't be any)
+                if row[6] == pre and row[7] == post:
+                    return (row[0], row[1], row[2], row[3], row[4], row[5], 0, 1)
+                elif row[6] == post and row[7] == pre:
+                    return (row[0], row[1], row[2], row[3], row[4], row[5], 1, 0)
+
+            for chunk in _stream_json_list(cursor, '''
+                    SELECT tc1.treenode_id, tc1.confidence,
+                           tc1.connector_id,
+                           tc2.confidence, tc2.treenode_id, tc2.skeleton_id,
+                           tc1.relation_id, tc2.relation_id
+                    FROM treenode_connector tc1,
+                         treenode_connector tc2
+                    WHERE tc1.skeleton_id = %s
+                      AND tc1.id != tc2.id
+                      AND tc1.connector_id = tc2.connector_id
+                      AND (tc1.relation_id = %s OR tc1.relation_id = %s)
+                    ''', (skeleton_id, pre, post), transform):
+                yield chunk
+        else:
+            yield '[]'
+        yield ','
+        if 0 != with_tags:
+            for chunk in _stream_tags(cursor, skeleton_id, relations['labeled_as']):
+                yield chunk
+        else:
+            yield '{}'
+        yield ']'
+
+    return StreamingHttpResponse(_stream_snapshot(stream))
+
+
+@requires_user_role(UserRole.Browse)
+def compact_skeletons(request, project_id=None):
+    """ Returns the compact representation of many skeletons at once, as a JSON
+    object mapping each of the requested skeleton IDs (skeleton_ids[]) to a
+    list of [[nodes], [connectors], {tag: [nodeIDs]}], in the format of
+    compact_skeleton. Connectors and tags are only included if
+    with_connectors and with_tags are 1, respectively.
+    Instead of querying each skeleton separately, the treenode, connector and
+    tag tables are scanned once for all skeletons, sorted by skeleton. These
+    scans are read in parallel from server-side cursors, and the result is
+    sent skeleton by skeleton in a streamed response. Skeletons that don't
+    exist in the project are mapped to empty lists.
+    """
+    project_id = int(project_id)
+    skeleton_ids = sorted(set(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids[')))
+    with_connectors = int(request.POST.get('with_connectors', 0))
+    with_tags = int(request.POST.get('with_tags', 0))
+    if not skeleton_ids:
+        raise Exception("Must provide the ID of at least one skeleton.")
+
+    # Projects without these relations have no links or tags to send
+    relations = _relations(project_id)
+    post = relations.get('postsynaptic_to')
+    labeled_as = relations.get('labeled_as')
+
+    def skeleton_groups(cursor, query, params):
+        """ Returns an iterator over tuples of skeleton ID and the list of its
+        rows (without the skeleton ID) of a query ordered by skeleton ID. """
+        name = _declare_cursor(cursor, query, params)
+        rows = chain.from_iterable(_fetch_batches(cursor, name))
+        return ((skid, [row[1:] for row in group])
+                for skid, group in groupby(rows, itemgetter(0)))
+
+    def stream():
+        with _snapshot() as cursor:
+            scans = [skeleton_groups(cursor, '''
+                SELECT skeleton_id, id, parent_id, user_id,
+                       location_x, location_y, location_z,
+                       radius, confidence
+                FROM treenode
+                WHERE skeleton_id = ANY(%s::bigint[])
+                  AND project_id = %s
+                ORDER BY skeleton_id
+                ''', (skeleton_ids, project_id))]
+            if 0 != with_connectors:
+                scans.append(skeleton_groups(cursor, '''
+                    SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                           CASE WHEN tc.relation_id = %s THEN 1 ELSE 0 END,
+                           c.location_x, c.location_y, c.location_z
+                    FROM treenode_connector tc,
+                         connector c
+                    WHERE tc.skeleton_id = ANY(%s::bigint[])
+                      AND tc.project_id = %s
+                      AND tc.connector_id = c.id
+                    ORDER BY tc.skeleton_id
+                    ''', (post, skeleton_ids, project_id)))
+            if 0 != with_tags:
+                scans.append(skeleton_groups(cursor, '''
+                    SELECT t.skeleton_id, c.name, tci.treenode_id
+                    FROM treenode t,
+                         treenode_class_instance tci,
+                         class_instance c
+                    WHERE t.skeleton_id = ANY(%s::bigint[])
+                      AND t.project_id = %s
+                      AND t.id = tci.treenode_id
+                      AND tci.relation_id = %s
+                      AND c.id = tci.class_instance_id
+                    ORDER BY t.skeleton_id
+                    ''', (skeleton_ids, project_id, labeled_as)))
+
+            # Merge the scans, all of them are ordered by skeleton ID
+            current = [next(scan, (None, None)) for scan in scans]
+            yield '{'
+            for n, skid in enumerate(skeleton_ids):
+                parts = []
+                for i, scan in enumerate(scans):
+                    if current[i][0] == skid:
+                        parts.append(current[i][1])
+                        current[i] = next(scan, (None, None))
+                    else:
+                        parts.append([])
+                nodes = parts[0]
+                connectors = parts[1] if 0 != with_connectors else []
+                tags = defaultdict(list)
+                if 0 != with_tags:
+                    for row in parts[-1]:
+                        tags[row[0]].append(row[1])
+                yield '%s"%s":%s' % (',' if n else '', skid,
+                        json.dumps((nodes, connectors, tags), separators=(',', ':')))
+            yield '}'
+
+    return StreamingHttpResponse(stream())
+
+
 @requires_user_role([UserRole.Browse])
 def treenode_time_bins(request, project_id=None, skeleton_id=None):
     """ Return a map of time bins (minutes) vs. list of nodes. """
@@ -382,6 +694,11 @@ def skeleton_with_metadata(request, project_id=None, skeleton_id=None):
         with_connectors=True, lean=0, all_field=True), separators=(',', ':'), default=default))
 
 def _measure_skeletons(skeleton_ids):
+    """ Measure the cable of all passed in skeletons at once. All nodes of all
+    skeletons are processed together in flat NumPy arrays, using indices into
+    these arrays to refer to parent nodes. Slab nodes (nodes with exactly two
+    neighbors) are smoothed by moving them towards the distance weighted
+    average of their neighbors. """
     if not skeleton_ids:
         raise Exception("Must provide the ID of at least one skeleton.")
 
@@ -392,15 +709,13 @@ def _measure_skeletons(skeleton_ids):
     SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
     FROM treenode
     WHERE skeleton_id IN (%s)
+    ORDER BY id
     ''' % skids_string)
-
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
+    rows = cursor.fetchall()
 
     class Skeleton():
         def __init__(self):
-            self.nodes = {}
+            self.n_nodes = 0
             self.raw_cable = 0
             self.smooth_cable = 0
             self.principal_branch_cable = 0
@@ -409,90 +724,123 @@ def _measure_skeletons(skeleton_ids):
             self.n_pre = 0
             self.n_post = 0
 
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
+    skeletons = {}
+    if rows:
+        n = len(rows)
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        parent_ids = np.array([row[1] or -1 for row in rows], dtype=np.int64)
+        skids, skel = np.unique(np.array([row[2] for row in rows],
+                dtype=np.int64), return_inverse=True)
+        pos = np.array([row[3:6] for row in rows], dtype=np.float64)
+
+        # Index of the parent of each node, -1 for root nodes
+        is_root = parent_ids == -1
+        parents = np.searchsorted(ids, parent_ids)
+        parents[is_root] = -1
+        child = np.nonzero(~is_root)[0]
+        parent = parents[child]
+
+        def edge_lengths(p):
+            return np.sqrt(((p[child] - p[parent]) ** 2).sum(axis=1))
+
+        def per_skeleton(nodes, values):
+            return np.bincount(skel[nodes], weights=values,
+                    minlength=len(skids))
+
+        distances = edge_lengths(pos)
+        raw_cable = per_skeleton(child, distances)
+
+        # Count end nodes and branch nodes. A root with two children is in
+        # the middle of the skeleton and therefore a slab node.
+        n_children = np.bincount(parent, minlength=n)
+        is_end = np.where(is_root, n_children == 1, n_children == 0)
+        is_branch = np.where(is_root, n_children > 2, n_children > 1)
+        is_slab = ~(is_end | is_branch)
+
+        # Sum up the positions of all neighbors of each node, weighted by the
+        # distance to them.
+        sum_distances = np.bincount(child, weights=distances, minlength=n) + \
+                np.bincount(parent, weights=distances, minlength=n)
+        weighted = np.empty((n, 3))
+        for d in xrange(3):
+            weighted[:, d] = \
+                    np.bincount(child, weights=pos[parent, d] * distances, minlength=n) + \
+                    np.bincount(parent, weights=pos[child, d] * distances, minlength=n)
+        nonzero = sum_distances != 0
+        weighted[nonzero] /= sum_distances[nonzero][:, np.newaxis]
+        weighted[~nonzero] = 0
+        # Compute weighted position for slab nodes only
+        # (root, branch and end nodes do not move)
+        smooth = np.where(is_slab[:, np.newaxis], pos * 0.4 + weighted * 0.6, pos)
+        smooth_lengths = edge_lengths(smooth)
+        smooth_cable = per_skeleton(child, smooth_lengths)
+
+        # Compute the number of edges to the root of all nodes by pointer
+        # jumping: each step doubles the distance covered by 'ancestors'.
+        depth = (~is_root).astype(np.int64)
+        ancestors = parents.copy()
+        pending = np.nonzero(ancestors != -1)[0]
+        while len(pending):
+            depth[pending] += depth[ancestors[pending]]
+            ancestors[pending] = ancestors[ancestors[pending]]
+            pending = pending[ancestors[pending] != -1]
+
+        # Find the child of the root each node descends from
+        top = parents.copy()
+        top[depth <= 1] = np.nonzero(depth <= 1)[0]
+        while True:
+            next_top = top[top]
+            if (next_top == top).all():
+                break
+            top = next_top
+
+        def first_of_groups(nodes, *keys):
+            """ Sorts nodes by the passed in keys (the last one is the primary
+            key) and returns the first node of each group of nodes that share
+            all but the first key. """
+            nodes = nodes[np.lexsort([k[nodes] for k in keys])]
+            new_group = np.zeros(len(nodes), dtype=bool)
+            new_group[0] = True
+            for k in keys[1:]:
+                new_group[1:] |= k[nodes][1:] != k[nodes][:-1]
+            return nodes[new_group]
+
+        # The principal branch runs from the end node farthest away from the
+        # root to the root. Ties are resolved like tree_util.partition does
+        # when visiting end nodes in order of their ID: of the deepest end
+        # nodes, the one with the lowest ID in each subtree of the root is
+        # taken and of these the one with the highest ID.
+        leaves = np.nonzero(n_children == 0)[0]
+        deepest = first_of_groups(leaves, -depth, skel)
+        max_depth = np.zeros(len(skids), dtype=np.int64)
+        max_depth[skel[deepest]] = depth[deepest]
+        leaves = leaves[depth[leaves] == max_depth[skel[leaves]]]
+        leaves = first_of_groups(leaves, ids, top, skel)
+        principal_ends = first_of_groups(leaves, -ids, skel)
+
+        on_principal_branch = np.zeros(n, dtype=bool)
+        current = principal_ends
+        while len(current):
+            on_principal_branch[current] = True
+            current = parents[current]
+            current = current[current != -1]
+        principal = on_principal_branch[child]
+        principal_branch_cable = per_skeleton(child[principal],
+                smooth_lengths[principal])
+
+        n_nodes = np.bincount(skel, minlength=len(skids))
+        n_ends = np.bincount(skel[is_end], minlength=len(skids))
+        n_branch = np.bincount(skel[is_branch], minlength=len(skids))
+
+        for i, skid in enumerate(skids):
             skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in skeletons.itervalues():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.iteritems():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.itervalues())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.iteritems():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
+            skeleton.n_nodes = int(n_nodes[i])
+            skeleton.raw_cable = float(raw_cable[i])
+            skeleton.smooth_cable = float(smooth_cable[i])
+            skeleton.principal_branch_cable = float(principal_branch_cable[i])
+            skeleton.n_ends = int(n_ends[i])
+            skeleton.n_branch = int(n_branch[i])
+            skeletons[int(skid)] = skeleton
 
     # Count inputs
     cursor.execute('''
@@ -534,7 +882,7 @@ def _measure_skeletons(skeleton_ids):
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
     return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()]))
 
 
@@ -707,6 +1055,32 @@ def skeleton_swc(*args, **kwargs):
     return export_skeleton_response(*args, **kwargs)
 
 
+def stream_swc(cursor, project_id, skeleton_id):
+    """ Yields the SWC representation of a skeleton in chunks, in the same
+    format as get_swc_string. """
+    for rows in _stream_query(cursor, '''
+            SELECT id, location_x, location_y, location_z, radius, parent_id
+            FROM treenode
+            WHERE project_id = %s
+              AND skeleton_id = %s
+            ''', (project_id, skeleton_id)):
+        yield ''.join(" ".join(map(str, (row[0], 0, row[1], row[2], row[3],
+                max(row[4], 0), -1 if row[5] is None else row[5]))) + "\n"
+                for row in rows)
+
+
+@requires_user_role(UserRole.Browse)
+def stream_skeleton_swc(request, project_id=None, skeleton_id=None):
+    """ Streaming variant of skeleton_swc, which sends the SWC file while it
+    is read from the database. """
+    project_id = int(project_id)
+    skeleton_id = int(skeleton_id)
+    _check_skeleton_exists(project_id, skeleton_id)
+    return StreamingHttpResponse(_stream_snapshot(
+            partial(stream_swc, project_id=project_id, skeleton_id=skeleton_id)),
+            content_type='text/plain')
+
+
 def _export_review_skeleton(project_id=None, skeleton_id=None, format=None,
                             subarbor_node_id=None):
     """ Returns a list of segments for the requested skeleton. Each segment
@@ -720,60 +1094,33 @@ def _export_review_skeleton(project_id=None, skeleton_id=None, format=None,
     # Get all reviews for the requested skeleton
     reviews = get_treenodes_to_reviews_with_time(skeleton_ids=[skeleton_id])
 
-    # Add each treenode to a networkx graph and attach reviewer information to
-    # it.
-    g = nx.DiGraph()
-    reviewed = set()
-    for t in treenodes:
-        # While at it, send the reviewer IDs, which is useful to iterate fwd
-        # to the first unreviewed node in the segment.
-        g.add_node(t[0], {'id': t[0], 'x': t[2], 'y': t[3], 'z': t[4], 'rids': reviews[t[0]]})
-        if reviews[t[0]]:
-            reviewed.add(t[0])
-        if t[1]: # if parent
-            g.add_edge(t[1], t[0]) # edge from parent to child
-        else:
-            root_id = t[0]
+    # Build an Arbor of the skeleton and attach reviewer information to each
+    # node.
+    rows = tuple(treenodes)
+    arbor = Arbor([t[0] for t in rows], [t[1] for t in rows],
+            [t[2:5] for t in rows], {'rids': [reviews[t[0]] for t in rows]})
+    reviewed = set(t[0] for t in rows if reviews[t[0]])
 
-    if subarbor_node_id and subarbor_node_id != root_id:
+    if subarbor_node_id:
         # Make sure the subarbor node ID (if any) is part of this skeleton
-        if subarbor_node_id not in g:
+        try:
+            subarbor_node = arbor.index(subarbor_node_id)
+        except KeyError:
             raise ValueError("Supplied subarbor node ID (%s) is not part of "
                              "provided skeleton (%s)" % (subarbor_node_id, skeleton_id))
+        # Keep only the nodes downstream of the subarbor node
+        arbor = arbor.subtree(subarbor_node)
 
-        # Remove connection to parent
-        parent = g.predecessors(subarbor_node_id)[0]
-        g.remove_edge(parent, subarbor_node_id)
-        # Remove all nodes that are upstream from the subarbor node
-        to_delete = set()
-        to_lookat = [root_id]
-        while to_lookat:
-            n = to_lookat.pop()
-            to_lookat.extend(g.successors(n))
-            to_delete.add(n)
-        g.remove_nodes_from(to_delete)
-        # Replace root id with sub-arbor ID
-        root_id=subarbor_node_id
+    def node(i):
+        # While at it, send the reviewer IDs, which is useful to iterate fwd
+        # to the first unreviewed node in the segment.
+        node_id = int(arbor.ids[i])
+        x, y, z = arbor.locations[i]
+        return {'id': node_id, 'x': x, 'y': y, 'z': z,
+                'rids': arbor.properties['rids'][i]}
 
     # Create all sequences, as long as possible and always from end towards root
-    distances = edge_count_to_root(g, root_node=root_id) # distance in number of edges from root
-    seen = set()
-    sequences = []
-    # Iterate end nodes sorted from highest to lowest distance to root
-    endNodeIDs = (nID for nID in g.nodes() if 0 == len(g.successors(nID)))
-    for nodeID in sorted(endNodeIDs, key=distances.get, reverse=True):
-        sequence = [g.node[nodeID]]
-        parents = g.predecessors(nodeID)
-        while parents:
-            parentID = parents[0]
-            sequence.append(g.node[parentID])
-            if parentID in seen:
-                break
-            seen.add(parentID)
-            parents = g.predecessors(parentID)
-
-        if len(sequence) > 1:
-            sequences.append(sequence)
+    sequences = [map(node, sequence) for sequence in arbor.partition()]
 
     # Calculate status
 
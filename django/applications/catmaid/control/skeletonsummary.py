@@ -0,0 +1,110 @@
+""" Access to the per-skeleton summaries of the skeleton_summary and
+skeleton_review_summary tables.
+
+Both tables are kept up to date by database triggers on the treenode and
+review tables, which update node counts, roots, edition times and review
+counts incrementally with every change. Cable lengths and the number of
+reviewed nodes can't always be updated this way, e.g. when many nodes are
+moved at once. In this case the triggers set them to NULL and they are
+recomputed here once they are requested.
+"""
+
+from collections import defaultdict
+
+from django.db import connection, transaction
+
+
+# Queries that recompute the values of stale summary columns for a list of
+# skeletons. Skeletons without any result get a value of zero.
+_RECOMPUTE_QUERIES = {
+    'cable_length': '''
+        SELECT t.skeleton_id,
+               sum(sqrt((t.location_x - p.location_x)^2 +
+                        (t.location_y - p.location_y)^2 +
+                        (t.location_z - p.location_z)^2))
+        FROM treenode t,
+             treenode p
+        WHERE t.skeleton_id = ANY(%s::bigint[])
+          AND p.id = t.parent_id
+        GROUP BY t.skeleton_id
+        ''',
+    'num_reviewed': '''
+        SELECT skeleton_id, count(DISTINCT treenode_id)
+        FROM review
+        WHERE skeleton_id = ANY(%s::bigint[])
+        GROUP BY skeleton_id
+        ''',
+}
+
+def _recompute(cursor, column, skeleton_ids):
+    """ Recomputes a stale column of the summaries of the passed in skeletons.
+    The summary rows are locked first, so that concurrent edits are either
+    included in the new value or applied after it. """
+    with transaction.atomic():
+        cursor.execute('''
+        SELECT skeleton_id FROM skeleton_summary
+        WHERE skeleton_id = ANY(%%s::bigint[])
+          AND %s IS NULL
+        ORDER BY skeleton_id
+        FOR UPDATE
+        ''' % column, (skeleton_ids,))
+        stale = [row[0] for row in cursor.fetchall()]
+        if not stale:
+            return
+
+        cursor.execute(_RECOMPUTE_QUERIES[column], (stale,))
+        values = dict(cursor.fetchall())
+        params = []
+        for skid in stale:
+            params.extend((skid, values.get(skid, 0)))
+        cursor.execute('''
+        UPDATE skeleton_summary s
+        SET %s = v.value
+        FROM (VALUES %s) AS v(skeleton_id, value)
+        WHERE s.skeleton_id = v.skeleton_id
+        ''' % (column, ','.join(['(%s,%s)'] * len(stale))), params)
+
+def skeleton_summaries(skeleton_ids, columns, cursor=None):
+    """ Returns a dictionary of skeleton ID vs a tuple of the requested
+    summary columns. Stale values are recomputed. Skeletons without treenodes
+    have no summary and are not part of the result. """
+    skeleton_ids = list(set(int(skid) for skid in skeleton_ids))
+    cursor = cursor or connection.cursor()
+    query = '''
+        SELECT skeleton_id, %s FROM skeleton_summary
+        WHERE skeleton_id = ANY(%%s::bigint[])
+        ''' % ', '.join(columns)
+    cursor.execute(query, (skeleton_ids,))
+    rows = cursor.fetchall()
+
+    recomputed = False
+    for i, column in enumerate(columns, 1):
+        if column in _RECOMPUTE_QUERIES:
+            stale = [row[0] for row in rows if row[i] is None]
+            if stale:
+                _recompute(cursor, column, stale)
+                recomputed = True
+    if recomputed:
+        cursor.execute(query, (skeleton_ids,))
+        rows = cursor.fetchall()
+
+    return {row[0]: row[1:] for row in rows}
+
+def node_counts(skeleton_ids, cursor=None):
+    """ Returns a dictionary of skeleton ID vs its number of treenodes. """
+    return {skid: row[0] for skid, row in skeleton_summaries(skeleton_ids,
+            ('num_nodes',), cursor).iteritems()}
+
+def review_counts(skeleton_ids, cursor=None):
+    """ Returns a dictionary of skeleton ID vs a dictionary of reviewer ID vs
+    the number of reviews of this reviewer in the skeleton. """
+    cursor = cursor or connection.cursor()
+    cursor.execute('''
+    SELECT skeleton_id, reviewer_id, num_reviewed
+    FROM skeleton_review_summary
+    WHERE skeleton_id = ANY(%s::bigint[])
+    ''', (list(set(int(skid) for skid in skeleton_ids)),))
+    reviews = defaultdict(lambda: defaultdict(int))
+    for row in cursor.fetchall():
+        reviews[row[0]][row[1]] = row[2]
+    return reviews
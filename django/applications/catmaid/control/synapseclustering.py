@@ -7,10 +7,9 @@ from collections import namedtuple
 from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
 
 
-try:
-    from scipy.sparse.csgraph import dijkstra
-except:
-    pass
+# The maximum number of entries of the partial distance matrices computed at
+# once by densityFields (4M entries of 8 bytes each).
+MAX_DISTANCE_CHUNK_ENTRIES = 4 * 1024 * 1024
 
 def synapse_clustering( skeleton_id, h_list ):
 
@@ -28,14 +27,14 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
         The three lists are synchronized by index.
     """
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
-    
+    fields, id2index = densityFields( Gwud, synNodes, h_list )
+
     SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups = {}
 
     for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-    
+        field = fields[h]
+
         targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
         densityField = {}            # densityField stores the height of the hill to be climbed
         for startNode in synNodes:
@@ -44,8 +43,7 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
                 allOnPath = []
                 
                 if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
+                    densityField[startNode] = field[id2index[startNode]]
     
                 while True:
                     allOnPath.append(currNode)
@@ -57,8 +55,7 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
                     
                     for nn in Gwud.neighbors( currNode ): 
                         if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
+                            densityField[nn] = field[id2index[nn]]
                     
                     prevNode = currNode
                     for nn in Gwud.neighbors( currNode ):
@@ -88,18 +85,85 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
 
     return synapseGroups
 
-def distanceMatrix( G, synNodes ):
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat = {}
+def densityFields( G, synNodes, h_list ):
+    """ Given a nx graph of a tree (or a forest), compute for every node and
+    each bandwidth h in h_list the synapse density: the sum of exp(-d^2 / h^2)
+    over all synapse nodes, with d being the distance along the graph to the
+    synapse node.
+    Returns a dict of h vs an array of densities, and in 'id2index' the mapping
+    from a node id to the index in these arrays.
+    The path between two nodes of a tree is unique, so no shortest path search
+    is needed: with each node's distance to its root, the distance between two
+    nodes is depth[a] + depth[b] - 2 * depth[lowest common ancestor]. For a
+    batch of synapse nodes, the depth of the common ancestor with every node is
+    found in one top-down pass over the levels of the tree. Batches are small
+    enough to bound memory, and their distances are accumulated into the
+    density of every bandwidth. """
     nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
-
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
+    id2index = {node: i for i,node in enumerate(nodeList)}
+    n = len(nodeList)
+    fields = {h: np.zeros(n) for h in h_list}
 
-    return dmat, {node: i for i,node in enumerate(nodeList)}
+    synNodes = set(synNodes)
+    synIndices = np.array([i for i,node in enumerate(nodeList) if node in synNodes],
+            dtype=int)
+    if 0 == n or 0 == len(synIndices):
+        return fields, id2index
+
+    # Root each tree at an arbitrary node and find each node's parent, weighted
+    # distance to the root (depth) and level by breadth first search
+    parents = -np.ones(n, dtype=int)
+    depth = np.zeros(n)
+    level = np.zeros(n, dtype=int)
+    visited = np.zeros(n, dtype=bool)
+    for root in xrange(n):
+        if visited[root]:
+            continue
+        visited[root] = True
+        queue = [root]
+        for i in queue:
+            node = nodeList[i]
+            for nn, attributes in G[node].iteritems():
+                j = id2index[nn]
+                if not visited[j]:
+                    visited[j] = True
+                    parents[j] = i
+                    depth[j] = depth[i] + attributes.get('weight', 1)
+                    level[j] = level[i] + 1
+                    queue.append(j)
+
+    byLevel = np.argsort(level, kind='mergesort')
+    levelOffsets = np.searchsorted(level[byLevel], np.arange(level.max() + 2))
+
+    chunkSize = max(1, MAX_DISTANCE_CHUNK_ENTRIES / n)
+    for start in xrange(0, len(synIndices), chunkSize):
+        sources = synIndices[start:start + chunkSize]
+
+        # Mark the nodes on the path of each synapse node to its root
+        onPath = np.zeros((len(sources), n), dtype=bool)
+        rows = np.arange(len(sources))
+        current = sources
+        while len(current):
+            onPath[rows, current] = True
+            current = parents[current]
+            rows = rows[current != -1]
+            current = current[current != -1]
+
+        # The depth of the lowest common ancestor is the node's own depth if it
+        # is on the path and its parent's value otherwise. Nodes of other trees
+        # have no common ancestor and are infinitely far away.
+        ancestorDepth = np.empty((len(sources), n))
+        for l in xrange(len(levelOffsets) - 1):
+            nodes = byLevel[levelOffsets[l]:levelOffsets[l + 1]]
+            above = -np.inf if 0 == l else ancestorDepth[:, parents[nodes]]
+            ancestorDepth[:, nodes] = np.where(onPath[:, nodes], depth[nodes], above)
+
+        D = depth[sources][:, np.newaxis] + depth - 2 * ancestorDepth
+        D2 = np.multiply(D, D)
+        for h in h_list:
+            fields[h] += np.sum(np.exp(-1 * D2 / (h * h)), axis=0)
+
+    return fields, id2index
 
 def countTargets( skeleton_id ):
     nTargets = {}
@@ -18,6 +18,7 @@ from catmaid.control.authentication import requires_user_role, \
 from catmaid.control.common import get_class_to_id_map, \
         get_relation_to_id_map, insert_into_log
 from catmaid.control.tracing import check_tracing_setup_detailed
+from catmaid.control import nodecache
 
 @requires_user_role(UserRole.Annotate)
 def instance_operation(request, project_id=None):
@@ -81,6 +82,7 @@ def instance_operation(request, project_id=None):
               sum(row[1] for row in rows),
               ", ".join(a[0] + ' ' + a[1] for a in cursor.fetchall())))
 
+        nodecache.invalidate_project(project_id)
 
     def rename_node():
         can_edit_class_instance_or_fail(request.user, params['id'])
@@ -4,7 +4,8 @@ from operator import itemgetter
 from networkx import Graph, DiGraph
 from collections import defaultdict
 from math import sqrt
-from itertools import izip, islice
+from itertools import izip, islice, groupby
+import numpy as np
 from catmaid.models import Treenode
 
 def find_root(tree):
@@ -40,22 +41,34 @@ def find_common_ancestor(tree, nodes, ds=None, root_node=None):
     if 1 == len(nodes):
         return nodes[0], 0
     distances = ds if ds else edge_count_to_root(tree, root_node=root_node)
-    # Pick the pair with the shortest edge count to root
-    first, second = sorted({node: distances(node) for node in nodes}.iteritems(), key=itemgetter(1))[:2]
-    # Start from the second, and bring it to an edge count equal to the first
-    while second[1] < first[1]:
-        second = (tree.predecessors_iter(second[0]).next(), second[1] - 1)
-    # Walk parents up for both until finding the common ancestor
-    first = first[0]
-    second = second[0]
-    while first != second:
-        first = tree.predecessors_iter(first).next()
-        second = tree.predecessors_iter(second).next()
+    # Bring all nodes up to the edge count of the one nearest to root
+    target = min(distances[node] for node in nodes)
+    ancestors = set()
+    for node in nodes:
+        for _ in xrange(distances[node] - target):
+            node = tree.predecessors_iter(node).next()
+        ancestors.add(node)
+    # Walk parents up for all until finding the common ancestor
+    while len(ancestors) > 1:
+        ancestors = set(tree.predecessors_iter(node).next() for node in ancestors)
+    first = ancestors.pop()
     return first, distances[first]
 
-def find_common_ancestors(tree, node_groups):
-    distances = edge_count_to_root(tree)
-    return (find_common_ancestor(tree, nodes, ds=distances) for nodes in node_groups)
+def find_common_ancestors(tree, node_groups, arbor=None):
+    """ Return a list with a tuple of the nearest common ancestor of each group
+    of nodes and its distance to root (as in edge_count_to_root). As in
+    find_common_ancestor, a group of a single node yields that node and 0.
+    All groups are answered at once by the common ancestor index of an Arbor
+    of the tree. Pass in an Arbor that is kept around, like the ones of
+    nodeindex.skeleton_arbor, to build that index only once; otherwise one is
+    made from the tree on every call. """
+    if arbor is None:
+        arbor = to_arbor(tree)
+    node_groups = [list(nodes) for nodes in node_groups]
+    ancestors = arbor.find_common_ancestors(
+            [arbor.indices(nodes) for nodes in node_groups])
+    return [(nodes[0], 0) if 1 == len(nodes) else (arbor.ids[i].item(), count + 1)
+            for nodes, (i, count) in zip(node_groups, ancestors)]
 
 def reroot(tree, new_root):
     """ Reverse in place the direction of the edges from the new_root to root. """
@@ -223,3 +236,384 @@ def lazy_load_trees(skeleton_ids, node_properties):
     if tree:
         yield (skid, tree)
 
+
+class Arbor(object):
+    """ A compact, array-backed representation of one or more trees of nodes.
+    Nodes are addressed by their position (index) in the 'ids' array, which is
+    sorted by node ID. The parent of node i is 'parents[i]' (-1 for roots) and
+    its children are 'children_order[children_offsets[i]:children_offsets[i+1]]'
+    (the CSR layout of the child lists), ordered by node ID. Optionally, the
+    'locations' array holds the (x, y, z) location of each node and the
+    'properties' dictionary maps names to arrays of further node values.
+
+    Unlike the functions above, which work on networkx DiGraphs, all methods
+    take and return node indices rather than node IDs. """
+
+    def __init__(self, ids, parent_ids, locations=None, properties=None):
+        """ ids: a sequence of node IDs.
+        parent_ids: a sequence with the parent ID of each node, None for roots
+        (-1 if it is a numpy array).
+        locations: an optional sequence with the (x, y, z) of each node.
+        properties: an optional dictionary of name vs a sequence with a value
+        for each node. Numpy arrays are kept as they are, other sequences
+        become arrays of objects. """
+        ids = np.array(ids, dtype=np.int64)
+        if not isinstance(parent_ids, np.ndarray):
+            parent_ids = [-1 if p is None else p for p in parent_ids]
+        parent_ids = np.array(parent_ids, dtype=np.int64)
+        order = np.argsort(ids, kind='mergesort')
+        self.ids = ids[order]
+        parent_ids = parent_ids[order]
+
+        # Translate parent IDs into indices
+        self.parents = np.searchsorted(self.ids, parent_ids)
+        self.parents[parent_ids == -1] = -1
+
+        self.locations = None if locations is None else \
+                np.array(locations, dtype=np.float64).reshape((-1, 3))[order]
+        self.properties = {}
+        for name, values in (properties or {}).iteritems():
+            if isinstance(values, np.ndarray):
+                self.properties[name] = values[order]
+                continue
+            array = np.empty(len(order), dtype=object)
+            for i, value in enumerate(values):
+                array[i] = value
+            self.properties[name] = array[order]
+
+        self._index_children()
+
+    def _index_children(self):
+        # Group the children by parent, roots sort to the front
+        self.children_order = np.argsort(self.parents, kind='mergesort')
+        self.children_offsets = np.searchsorted(
+                self.parents[self.children_order], np.arange(len(self.ids) + 1))
+        self._subtree_sizes = None
+        self._edge_counts = None
+        self._ancestors = None
+
+    def _subarbor(self, mask, parents):
+        """ Returns a new Arbor of the nodes selected by mask. The parents
+        array holds the new parent (an index in this arbor) of each selected
+        node, which has to be selected as well, or -1. """
+        arbor = Arbor.__new__(Arbor)
+        new_index = np.cumsum(mask) - 1
+        arbor.ids = self.ids[mask]
+        parents = parents[mask]
+        arbor.parents = np.where(parents == -1, -1, new_index[parents])
+        arbor.locations = None if self.locations is None else \
+                self.locations[mask]
+        arbor.properties = {name: values[mask]
+                            for name, values in self.properties.iteritems()}
+        arbor._index_children()
+        return arbor
+
+    def copy(self):
+        return self._subarbor(np.ones(len(self.ids), dtype=bool), self.parents)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, node_id):
+        """ Returns the index of the node with the given ID, raises a KeyError
+        if there is no such node. """
+        i = np.searchsorted(self.ids, node_id)
+        if i == len(self.ids) or self.ids[i] != node_id:
+            raise KeyError(node_id)
+        return int(i)
+
+    def indices(self, node_ids):
+        """ Returns an array with the index of each of the passed in node IDs,
+        raises a KeyError if any of them isn't part of the arbor. """
+        node_ids = np.asarray(list(node_ids), dtype=np.int64)
+        indices = np.searchsorted(self.ids, node_ids)
+        found = indices < len(self.ids)
+        found[found] = self.ids[indices[found]] == node_ids[found]
+        if not found.all():
+            raise KeyError(node_ids[~found][0])
+        return indices
+
+    def children(self, i):
+        """ Returns an array with the indices of the children of node i. """
+        return self.children_order[
+                self.children_offsets[i]:self.children_offsets[i + 1]]
+
+    def child_count(self, i):
+        return int(self.children_offsets[i + 1] - self.children_offsets[i])
+
+    def _children_of(self, nodes):
+        """ Returns an array with the indices of the children of all of the
+        passed in nodes. """
+        starts = self.children_offsets[nodes]
+        counts = self.children_offsets[nodes + 1] - starts
+        total = counts.sum()
+        if not total:
+            return np.empty(0, dtype=np.int64)
+        shifts = starts - np.concatenate(([0], np.cumsum(counts)[:-1]))
+        return self.children_order[np.arange(total) + np.repeat(shifts, counts)]
+
+    def roots(self):
+        return np.flatnonzero(self.parents == -1)
+
+    def ends(self):
+        """ Returns an array with the indices of all nodes without children. """
+        return np.flatnonzero(self.children_offsets[1:] == self.children_offsets[:-1])
+
+    def levels(self):
+        """ Returns a list with an array of node indices for each number of
+        edges from the root, starting with the roots. """
+        levels = []
+        level = self.roots()
+        while len(level):
+            levels.append(level)
+            level = self._children_of(level)
+        return levels
+
+    def _subtree_sums(self, values):
+        """ Returns an array with the sum of the passed in values of all nodes
+        in the subtree of each node, including the node itself. """
+        sums = np.array(values)
+        # Accumulate from the deepest level upwards
+        for level in reversed(self.levels()[1:]):
+            sums += np.bincount(self.parents[level], weights=sums[level],
+                    minlength=len(sums)).astype(sums.dtype)
+        return sums
+
+    def subtree_sizes(self):
+        """ Returns an array with the number of nodes in the subtree of each
+        node, including the node itself. Computed only once. """
+        if self._subtree_sizes is None:
+            self._subtree_sizes = self._subtree_sums(
+                    np.ones(len(self.ids), dtype=np.int64))
+        return self._subtree_sizes
+
+    def edge_count_to_root(self):
+        """ Returns an array with the number of edges from each node to its
+        root. Computed only once. """
+        if self._edge_counts is None:
+            counts = np.empty(len(self.ids), dtype=np.int64)
+            for count, level in enumerate(self.levels()):
+                counts[level] = count
+            self._edge_counts = counts
+        return self._edge_counts
+
+    def _ancestor_table(self):
+        """ Returns a list with an array of the 2^k-th ancestor of each node at
+        position k, where roots are their own ancestors. Computed only once. """
+        if self._ancestors is None:
+            ancestors = np.where(self.parents == -1,
+                    np.arange(len(self.ids)), self.parents)
+            table = [ancestors]
+            max_count = self.edge_count_to_root().max() if len(self.ids) else 0
+            for _ in xrange(1, max(1, int(max_count).bit_length())):
+                table.append(table[-1][table[-1]])
+            self._ancestors = table
+        return self._ancestors
+
+    def common_ancestors(self, a, b):
+        """ Returns an array with the index of the nearest common ancestor of
+        each pair of node indices of the arrays a and b, or -1 if the nodes of
+        a pair are in different trees. All pairs are answered at once, with a
+        number of steps logarithmic in the depth of the arbor. """
+        a = np.array(a, dtype=np.int64)
+        b = np.array(b, dtype=np.int64)
+        counts = self.edge_count_to_root()
+        table = self._ancestor_table()
+        # Let a be the deeper node of each pair and lift it to the depth of b
+        swap = counts[a] < counts[b]
+        a[swap], b[swap] = b[swap], a[swap]
+        difference = counts[a] - counts[b]
+        for k, ancestors in enumerate(table):
+            lift = (difference >> k) & 1 == 1
+            a[lift] = ancestors[a[lift]]
+        # Lift both as far as their ancestors differ
+        for ancestors in reversed(table):
+            next_a, next_b = ancestors[a], ancestors[b]
+            differ = next_a != next_b
+            a[differ] = next_a[differ]
+            b[differ] = next_b[differ]
+        parents = table[0]
+        return np.where(a == b, a,
+                np.where(parents[a] == parents[b], parents[a], -1))
+
+    def find_common_ancestors(self, node_groups):
+        """ Returns a list with a tuple of the index of the nearest common
+        ancestor of each group of node indices and its number of edges to the
+        root. Raises a ValueError if a group is empty or spans several trees.
+        """
+        groups = [np.asarray(nodes, dtype=np.int64) for nodes in node_groups]
+        if not groups:
+            return []
+        lengths = np.array([len(nodes) for nodes in groups])
+        if (lengths == 0).any():
+            raise ValueError("No nodes given")
+        # Lay out the groups as rows, then fold in one column after the other
+        flat = np.concatenate(groups)
+        rows = np.repeat(np.arange(len(groups)), lengths)
+        columns = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        table = np.empty((len(groups), lengths.max()), dtype=np.int64)
+        table[rows, columns] = flat
+        ancestors = table[:, 0].copy()
+        for column in xrange(1, table.shape[1]):
+            rows = np.flatnonzero((lengths > column) & (ancestors != -1))
+            ancestors[rows] = self.common_ancestors(ancestors[rows],
+                    table[rows, column])
+        if (ancestors == -1).any():
+            raise ValueError("The nodes are not part of the same tree")
+        return zip(ancestors.tolist(),
+                   self.edge_count_to_root()[ancestors].tolist())
+
+    def find_common_ancestor(self, nodes):
+        """ Returns a tuple of the index of the nearest common ancestor of the
+        passed in node indices and its number of edges to the root. """
+        return self.find_common_ancestors([nodes])[0]
+
+    def reroot(self, new_root):
+        """ Reverse in place the direction of the edges from new_root to the
+        root. """
+        path = [new_root]
+        parent = self.parents[new_root]
+        while parent != -1:
+            path.append(parent)
+            parent = self.parents[parent]
+        if len(path) == 1:
+            # new_root is already the root
+            return
+        self.parents[path[1:]] = path[:-1]
+        self.parents[new_root] = -1
+        self._index_children()
+
+    def partition(self):
+        """ Partition the arbor as lists of node indices, with branch nodes
+        repeated as ends of all sequences except the longest one that
+        finishes at the root. Each sequence runs from an end node to either
+        the root or a branch node. End nodes are visited from the highest to
+        the lowest distance to the root, ties by node ID. """
+        counts = self.edge_count_to_root()
+        ends = self.ends()
+        ends = ends[np.argsort(-counts[ends], kind='mergesort')]
+        parents = self.parents.tolist()
+        seen = set()
+        for end in ends.tolist():
+            sequence = [end]
+            parent = parents[end]
+            while parent != -1:
+                sequence.append(parent)
+                if parent in seen:
+                    break
+                seen.add(parent)
+                parent = parents[parent]
+
+            if len(sequence) > 1:
+                yield sequence
+
+    def _rerooted_counts(self, nodes):
+        """ Returns a copy of the arbor, rerooted at the first of the passed in
+        node indices, and an array with the number of these nodes in the
+        subtree of each node of the copy. """
+        arbor = self.copy()
+        arbor.reroot(nodes[0])
+        marked = np.zeros(len(self.ids), dtype=np.int64)
+        marked[nodes] = 1
+        return arbor, arbor._subtree_sums(marked)
+
+    def simplify(self, keepers):
+        """ Returns a new Arbor with only the passed in node indices and the
+        branch nodes between them, which is rooted at the first keeper. Each
+        node is linked to its nearest preserved ancestor. """
+        keepers = list(keepers)
+        arbor, counts = self._rerooted_counts(keepers)
+        # Branch nodes between keepers have at least two children with
+        # keepers in their subtrees
+        children = np.flatnonzero((counts > 0) & (arbor.parents != -1))
+        branches = np.bincount(arbor.parents[children], minlength=len(counts))
+        keep = branches > 1
+        keep[keepers] = True
+        # Find the nearest preserved ancestor, from the root downwards
+        ancestors = np.empty(len(counts), dtype=np.int64)
+        ancestors.fill(-1)
+        for level in arbor.levels()[1:]:
+            parents = arbor.parents[level]
+            ancestors[level] = np.where(keep[parents], parents, ancestors[parents])
+        return arbor._subarbor(keep, ancestors)
+
+    def spanning_tree(self, preserve):
+        """ Returns a new Arbor with the smallest subtree that includes all
+        of the passed in node indices, rooted at the first of them. """
+        preserve = list(preserve)
+        arbor, counts = self._rerooted_counts(preserve)
+        return arbor._subarbor(counts > 0, arbor.parents)
+
+    def subtree(self, i):
+        """ Returns a new Arbor with node i and all of its descendants. """
+        mask = np.zeros(len(self.ids), dtype=bool)
+        level = np.array([i])
+        while len(level):
+            mask[level] = True
+            level = self._children_of(level)
+        parents = self.parents.copy()
+        parents[i] = -1
+        return self._subarbor(mask, parents)
+
+    def components(self, nodes):
+        """ Returns a list of arrays of node indices, one for each connected
+        component formed by the passed in node indices alone. """
+        nodes = np.unique(np.asarray(nodes, dtype=np.int64))
+        selected = np.zeros(len(self.ids), dtype=bool)
+        selected[nodes] = True
+        # Point every selected node to its parent if that is selected too,
+        # then jump pointers until all of them point to a component root
+        up = np.arange(len(self.ids))
+        linked = nodes[self.parents[nodes] != -1]
+        linked = linked[selected[self.parents[linked]]]
+        up[linked] = self.parents[linked]
+        while True:
+            jumped = up[up]
+            if (jumped == up).all():
+                break
+            up = jumped
+        roots = up[nodes]
+        order = np.argsort(roots, kind='mergesort')
+        splits = np.flatnonzero(np.diff(roots[order])) + 1
+        return np.split(nodes[order], splits)
+
+    def cable_length(self):
+        """ Returns the summed length of all edges, which requires locations.
+        """
+        children = np.flatnonzero(self.parents != -1)
+        return float(np.sqrt(((self.locations[children] -
+                self.locations[self.parents[children]]) ** 2).sum(axis=1)).sum())
+
+
+def to_arbor(tree, locations=None):
+    """ Return an Arbor of the nodes of a tree.
+    locations: an optional dictionary of nodeID vs (x, y, z) of each node. """
+    ids = tree.nodes()
+    return Arbor(ids, [next(tree.predecessors_iter(node), None) for node in ids],
+            None if locations is None else [locations[node] for node in ids])
+
+
+def lazy_load_arbors(skeleton_ids, node_properties):
+    """ Return a lazy collection of pairs of (long, Arbor)
+    representing (skeleton_id, arbor).
+    The node_properties is a list of strings, each being a name of a column
+    in the django model of the Treenode table that is not the treenode id, parent_id
+    or skeleton_id. They are available in the properties of each Arbor and
+    if all of location_x, location_y and location_z are included, these are
+    also available as its locations. """
+
+    values_list = ('id', 'parent_id', 'skeleton_id')
+    props = tuple(set(node_properties) - set(values_list))
+    values_list += props
+    xyz = tuple(values_list.index(c) for c in ('location_x', 'location_y', 'location_z')
+                if c in props)
+
+    ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
+            .order_by('skeleton') \
+            .values_list(*values_list)
+    for skid, rows in groupby(ts, itemgetter(2)):
+        rows = list(rows)
+        columns = zip(*rows)
+        yield (skid, Arbor(columns[0], columns[1],
+            [[row[i] for i in xyz] for row in rows] if 3 == len(xyz) else None,
+            {k: columns[i] for i, k in enumerate(props, 3)}))
@@ -14,6 +14,7 @@ from catmaid.control.authentication import requires_user_role, \
 from catmaid.control.common import get_relation_to_id_map, \
         get_class_to_id_map, insert_into_log
 from catmaid.control.neuron import _delete_if_empty
+from catmaid.control import nodecache
 
 
 def can_edit_treenode_or_fail(user, project_id, treenode_id):
@@ -94,6 +95,7 @@ def create_treenode(request, project_id=None):
         if parent_id:
             new_treenode.parent_id = parent_id
         new_treenode.save()
+        nodecache.invalidate_cells(project_id, [new_treenode.id])
         return new_treenode
 
     def relate_neuron_to_skeleton(neuron, skeleton):
@@ -253,6 +255,7 @@ def _create_interpolated_treenode(request, params, project_id, skip_last):
         # Loop the creation of treenodes in z resolution steps until target
         # section is reached
         parent_id = params['parent_id']
+        new_treenode_ids = []
         atn_slice_index = ((parent_z - params['stack_translation_z']) / params['resz']) \
             .quantize(decimal.Decimal('1'), rounding=decimal.ROUND_FLOOR)
         for i in range(1, steps + (0 if skip_last else 1)):
@@ -273,6 +276,9 @@ def _create_interpolated_treenode(request, params, project_id, skip_last):
             new_treenode.save()
 
             parent_id = new_treenode.id
+            new_treenode_ids.append(parent_id)
+
+        nodecache.invalidate_cells(project_id, new_treenode_ids)
 
         # parent_id contains the ID of the last added node
         return parent_id, parent_skeleton_id
@@ -293,8 +299,10 @@ def update_parent(request, project_id=None, treenode_id=None):
         raise Exception("Child node %s is in skeleton %s but parent node %s is in skeleton %s!", \
                         treenode_id, child.skeleton_id, parent_id, parent.skeleton_id)
 
+    nodecache.invalidate_cells(project_id, [treenode_id])
     child.parent_id = parent_id
     child.save()
+    nodecache.invalidate_cells(project_id, [treenode_id])
 
     return HttpResponse(json.dumps({'success': True}))
 
@@ -312,6 +320,7 @@ def update_radius(request, project_id=None, treenode_id=None):
         # Update radius only for the treenode
         Treenode.objects.filter(pk=treenode_id).update(editor=request.user,
                                                        radius=radius)
+        nodecache.invalidate_cells(project_id, [treenode_id])
         return HttpResponse(json.dumps({'success': True}))
 
     cursor.execute('''
@@ -335,6 +344,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        nodecache.invalidate_cells(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 2 == option:
@@ -353,6 +363,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        nodecache.invalidate_cells(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 3 == option:
@@ -370,6 +381,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        nodecache.invalidate_cells(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 4 == option:
@@ -384,6 +396,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        nodecache.invalidate_cells(project_id, include)
         return HttpResponse(json.dumps({'success': True}))
 
     if 5 == option:
@@ -393,6 +406,7 @@ def update_radius(request, project_id=None, treenode_id=None):
                 .filter(pk=treenode_id) \
                 .values('skeleton_id')) \
             .update(editor=request.user, radius=radius)
+        nodecache.invalidate_project(project_id)
         return HttpResponse(json.dumps({'success': True}))
 
 
@@ -412,6 +426,10 @@ def delete_treenode(request, project_id=None):
     treenode = Treenode.objects.get(pk=treenode_id)
     parent_id = treenode.parent_id
 
+    # Cells of the parent and the children stay invalid after the children
+    # are linked to the parent.
+    nodecache.invalidate_cells(project_id, [treenode_id])
+
     response_on_error = ''
     try:
         if not parent_id:
@@ -2,8 +2,7 @@ import json
 
 from datetime import datetime, timedelta
 from collections import defaultdict, namedtuple
-from itertools import imap
-from networkx import connected_components
+from itertools import imap, izip
 from functools import partial
 
 from django.db.models import Count
@@ -13,27 +12,20 @@ from catmaid.models import Treenode, Log, Relation, TreenodeConnector, \
         UserRole, Review
 from catmaid.control.review import get_review_status
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.tree_util import lazy_load_trees
+from catmaid.control.tree_util import lazy_load_arbors
 
 
-def _find_nearest(tree, nodes, loc1):
-    """ Returns a tuple of the closest node and the square of the distance. """
-    min_sqdist = float('inf')
-    for node in nodes:
-        loc2 = (tree.node[node]['location_x'],
-                tree.node[node]['location_y'],
-                tree.node[node]['location_z'])
-        dsq = pow(loc1[0] - loc2[0], 2) + pow(loc1[1] - loc2[1], 2) + pow(loc1[2] - loc2[2], 2)
-        if dsq < min_sqdist:
-            min_sqdist = dsq
-            closest = node
-
-    return node, min_sqdist
+def _find_nearest(arbor, nodes, loc1):
+    """ Returns a tuple of the index of the closest of the passed in node
+    indices and the square of the distance. """
+    dsq = ((arbor.locations[nodes] - loc1) ** 2).sum(axis=1)
+    closest = dsq.argmin()
+    return nodes[closest], dsq[closest]
 
 def _parse_location(loc):
     return map(float, loc[1:-1].split(','))
 
-def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
+def _evaluate_epochs(epochs, skeleton_id, arbor, reviews, relations):
     """ Evaluate each epoch:
     1. Detect merges done by the reviewer: one of the two nodes is edited by the reviewer within the review epoch (but not both: could be a reroot then), with a corresponding join_skeleton entry in the log table. Perhaps the latter is enough, if the x,y,z of the log corresponds to that of the node (plus/minus a tiny bit, may have moved).
     2. Detect additions by the reviewer (a kind of merge), where the reviewer's node is newer than the other node, and it was created within the review epoch. These nodes would have been created and reviewed by the reviewer within the review epoch.
@@ -56,6 +48,9 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
     # List of EpochOps, indexed like epochs
     epoch_ops = []
 
+    user_ids = arbor.properties['user_id']
+    creation_times = arbor.properties['creation_time']
+
     # Synapses on the arbor: keyed by treenode_id
     all_synapses = defaultdict(list)
     for s in TreenodeConnector.objects.filter(skeleton=skeleton_id):
@@ -64,6 +59,7 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
     for epoch in epochs:
 
         reviewer_id, nodes = epoch
+        rows = arbor.indices(nodes)
 
         # Range of the review epoch
         start_date = datetime.max
@@ -84,19 +80,18 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
         # Synapses, keyed by user and relation, created by a user other than the user who created the treenode, after the treeenode's creation time
         newer_synapses_count = defaultdict(partial(defaultdict, int))
 
-        for node in nodes:
-            props = tree.node[node]
+        for node, i in izip(nodes, rows):
             # Find out review date range for this epoch, based on most recent
             # reviews
             tr = reviews[node][0].review_time
             start_date = min(start_date, tr)
             end_date = max(end_date, tr)
             # Count nodes created by each user
-            user_id = props['user_id']
+            user_id = user_ids[i]
             user_node_counts[user_id] += 1
             # Find out date range for each user's created nodes
             u = user_ranges[user_id]
-            tc = props['creation_time']
+            tc = creation_times[i]
             u['start'] = min(u['start'], tc)
             u['end'] = max(u['end'], tc)
             # Synapses
@@ -126,12 +121,12 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
             if pre:
                 for s in pre:
                     if in_range(s.creation_time):
-                        reviewer_n_pre[tree.node[s.treenode_id]['user_id']] += 1
+                        reviewer_n_pre[user_ids[arbor.index(s.treenode_id)]] += 1
             post = reviewer_synapses.get(relations['postsynaptic_to'])
             if post:
                 for s in post:
                     if in_range(s.creation_time):
-                        reviewer_n_post[tree.node[s.treenode_id]['user_id']] += 1
+                        reviewer_n_post[user_ids[arbor.index(s.treenode_id)]] += 1
 
 
         date_range = [start_date, end_date]
@@ -166,40 +161,36 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
             # For merges, the sqdist should be very close to zero.
             # For splits, the x,y,z are if the splitted node, which may no longer be part of the arbor (but could have been joined again).
             # False positives could originate in splitted and re-joined nodes (invalid split and merge error), and in deleted and re-created nodes (potentially incorrect user attribution).
-            node, sqdist = _find_nearest(tree, nodes, _parse_location(location))
+            i, sqdist = _find_nearest(arbor, rows, _parse_location(location))
 
             if 'split_skeleton' == operation_type:
-                splits[tree.node[node]['user_id']] += 1
+                splits[user_ids[i]] += 1
 
             elif 'join_skeleton' == operation_type:
-                edges = tree[node]
-                if edges:
+                if -1 != arbor.parents[i]:
                     # Replace node with its parent
-                    node = edges.iterkeys().next()
-                merges[tree.node[node]['user_id']] += 1
+                    i = arbor.parents[i]
+                merges[user_ids[i]] += 1
 
         # Count nodes created by the reviewer, as well as
         # the number of connected arbors made by that nodes
         # which will add to the count of merges missed.
-        def newlyAdded(node):
-            props = tree.node[node]
-            return props['user_id'] == reviewer_id and in_range(props['creation_time'])
+        def newlyAdded(i):
+            return user_ids[i] == reviewer_id and in_range(creation_times[i])
 
-        owned = filter(newlyAdded, nodes)
+        owned = filter(newlyAdded, rows)
 
         if owned:
-            sub = tree.subgraph(owned)
-            additions = connected_components(sub.to_undirected())
+            additions = arbor.components(owned)
             for addition in additions:
                 # Find a node whose parent's creator is not the reviewer, if any
                 # (Could not find any if the reviewer had created that parent node
                 # outside of the review epoch, in which case it does not count
                 # as an error)
-                for node in addition:
-                    edges = tree[node]
-                    if edges:
-                        parent = edges.iterkeys().next()
-                        creator_id = tree.node[parent]['user_id']
+                for i in addition:
+                    parent = arbor.parents[i]
+                    if -1 != parent:
+                        creator_id = user_ids[parent]
                         if creator_id != reviewer_id:
                             appended[creator_id].append(len(addition))
                             break
@@ -207,7 +198,7 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
 
     return epoch_ops
 
-def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
+def _split_into_epochs(skeleton_id, arbor, reviews, max_gap):
     """ Split the arbor into one or more review epochs.
     An epoch is defined as a continuous range of time containing gaps
     of up to max_gap (e.g. 3 days) and fully reviewed by the same reviewer.
@@ -215,14 +206,12 @@ def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
     given that different subsets of the arbor may have been joined at a later time. """
 
     # Sort nodes by date of most recent review (first in list)
-    def get_review_time(e):
-        return reviews[e[0]][0].review_time
-    nodes = sorted(tree.nodes_iter(data=True), key=get_review_time)
+    def get_review_time(node):
+        return reviews[node][0].review_time
+    nodes = sorted(arbor.ids.tolist(), key=get_review_time)
 
     # Grab the oldest node
-    oldest = nodes[0]
-    last_id = oldest[0] # id of first node
-    last = oldest[1] # props of first node
+    last_id = nodes[0] # id of first node
 
     # First epoch contains the oldest node
     epoch = [last_id]
@@ -234,7 +223,7 @@ def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
     epochs = [(last_review.reviewer_id, epoch)]
 
     # Iterate from second-oldest node forward in time
-    for node, props in nodes:
+    for node in nodes:
         # Most recent review of current node
         node_review = reviews[node][0]
         # Add to current epoch if same reviewer and we are within max_gap
@@ -251,10 +240,10 @@ def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
     return epochs
 
 
-def _evaluate_arbor(user_id, skeleton_id, tree, reviews, relations, max_gap):
+def _evaluate_arbor(user_id, skeleton_id, arbor, reviews, relations, max_gap):
     """ Split the arbor into review epochs and then evaluate each independently. """
-    epochs = _split_into_epochs(skeleton_id, tree, reviews, max_gap)
-    epoch_ops = _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations)
+    epochs = _split_into_epochs(skeleton_id, arbor, reviews, max_gap)
+    epoch_ops = _evaluate_epochs(epochs, skeleton_id, arbor, reviews, relations)
     return epoch_ops
 
 
@@ -304,8 +293,8 @@ def _evaluate(project_id, user_id, start_date, end_date, max_gap, min_nodes):
     relations = dict(Relation.objects.filter(project_id=project_id, relation_name__in=['presynaptic_to', 'postsynaptic_to']).values_list('relation_name', 'id'))
 
     # 2. Load each fully reviewed skeleton one at a time
-    evaluations = {skid: _evaluate_arbor(user_id, skid, tree, reviews[skid], relations, max_gap) \
-        for skid, tree in lazy_load_trees(skeleton_ids, ('location_x', 'location_y', 'location_z', \
+    evaluations = {skid: _evaluate_arbor(user_id, skid, arbor, reviews[skid], relations, max_gap) \
+        for skid, arbor in lazy_load_arbors(skeleton_ids, ('location_x', 'location_y', 'location_z', \
                                                          'creation_time', 'user_id', 'editor_id', \
                                                          'edition_time'))}
 
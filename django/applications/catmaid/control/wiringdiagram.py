@@ -2,74 +2,47 @@ import json
 import networkx as nx
 from networkx.readwrite import json_graph
 
+from django.db import connection
 from django.http import HttpResponse
-from django.db.models import Count
 
-from catmaid.models import Treenode, TreenodeConnector, UserRole
+from catmaid.models import UserRole
+from catmaid.control.adjacency import project_adjacency
 from catmaid.control.authentication import requires_user_role
 
 
 def get_wiring_diagram(project_id=None, lower_treenode_number_limit=0):
-
-    # result dictionary: {connectorid: presyn_skeletonid}
-    tmp={}
-    result={}
-    # get the presynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'presynaptic_to'
-    )
-    for e in qs:
-        if not e.connector_id in tmp:
-            tmp[e.connector_id]=e.skeleton_id
-            result[e.skeleton_id]={}
-        else:
-            # connector with multiple presynaptic connections
-            pass
-
-    skeletons={}
-    qs = Treenode.objects.filter(project=project_id).values('skeleton').annotate(Count('skeleton'))
-    for e in qs:
-        skeletons[ e['skeleton'] ]=e['skeleton__count']
-
-    # get the postsynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'postsynaptic_to'
-    )
-    for e in qs:
-        if e.connector_id in tmp:
-
-            # limit the skeletons to include
-            if skeletons[ tmp[e.connector_id] ] < lower_treenode_number_limit or\
-               skeletons[ e.skeleton_id ] < lower_treenode_number_limit:
-                continue
-
-            # an existing connector, so we add a connection
-            if e.skeleton_id in result[tmp[e.connector_id]]:
-                result[tmp[e.connector_id]][e.skeleton_id] += 1
-            else:
-                result[tmp[e.connector_id]][e.skeleton_id] = 1
-        else:
-            # connector with only postsynaptic connections
-            pass
+    """ Returns the nodes and edges of the synaptic connections between all
+    skeletons of a project, which have at least the passed in number of
+    treenodes. Edges are read from the project's adjacency matrix. """
+    lower_treenode_number_limit = int(lower_treenode_number_limit)
+
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT skeleton_id, num_nodes
+    FROM skeleton_summary
+    WHERE project_id = %s
+    ''', (int(project_id),))
+    skeletons = dict(cursor.fetchall())
 
     nodes_tmp={}
     edges=[]
 
-    for k,v in result.iteritems():
+    for pre, post, count in project_adjacency(project_id, cursor).edges():
 
-        for kk,vv in v.iteritems():
+        # limit the skeletons to include
+        if skeletons.get(pre, 0) < lower_treenode_number_limit or\
+           skeletons.get(post, 0) < lower_treenode_number_limit:
+            continue
 
-            edges.append(
-                    {"id": str(k)+"_"+str(kk),
-                     "source": str(k),
-                     "target": str(kk),
-                     "number_of_connector": vv}
-            )
+        edges.append(
+                {"id": str(pre)+"_"+str(post),
+                 "source": str(pre),
+                 "target": str(post),
+                 "number_of_connector": count}
+        )
 
-            nodes_tmp[k]=None
-            nodes_tmp[kk]=None
+        nodes_tmp[pre]=None
+        nodes_tmp[post]=None
 
     nodes=[]
     for k,v in nodes_tmp.iteritems():
@@ -77,7 +50,7 @@ def get_wiring_diagram(project_id=None, lower_treenode_number_limit=0):
                 {
                 "id": str(k),
                 "label": "Skeleton "+str(k),
-                'node_count': skeletons[k]
+                'node_count': skeletons.get(k, 0)
             }
         )
 
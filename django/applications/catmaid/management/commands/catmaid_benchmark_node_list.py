@@ -0,0 +1,128 @@
+import random
+import time
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+from optparse import make_option
+
+from catmaid.models import *
+from catmaid.control.node import NODE_LIST_ENGINES
+from catmaid.control.tracing import setup_tracing
+
+
+class Rollback(Exception):
+    pass
+
+class Command(NoArgsCommand):
+    help = "Compare the node list engines on a synthetic dense volume. " \
+           "All created data is removed afterwards."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--user', dest='user_id', help='The ID of the user who will own the synthetic data'),
+        make_option('--skeletons', dest='skeletons', type='int', default=2000,
+            help='The number of skeletons to create'),
+        make_option('--nodes', dest='nodes', type='int', default=500,
+            help='The number of treenodes per skeleton'),
+        make_option('--size', dest='size', type='float', default=50000,
+            help='The width and height of the volume in nm'),
+        make_option('--sections', dest='sections', type='int', default=200,
+            help='The number of sections of the volume'),
+        make_option('--view', dest='view', type='float', default=10000,
+            help='The width and height of a field of view in nm'),
+        make_option('--repeat', dest='repeat', type='int', default=50,
+            help='The number of fields of view to query with each engine'),
+        )
+
+    def handle_noargs(self, **options):
+
+        if not options['user_id']:
+            raise CommandError("You must specify a user ID with --user")
+
+        user = User.objects.get(pk=options['user_id'])
+
+        try:
+            with transaction.atomic():
+                self.benchmark(user, options)
+                # Don't keep any of the synthetic data
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def benchmark(self, user, options):
+        zres = 50.0
+        size = options['size']
+        project = Project.objects.create(title='Node list benchmark')
+        setup_tracing(project.id, user)
+        skeleton_class = Class.objects.get(project=project, class_name='skeleton')
+
+        self.stdout.write('Creating %s skeletons with %s nodes each' % \
+                (options['skeletons'], options['nodes']))
+        cursor = connection.cursor()
+        for n in xrange(options['skeletons']):
+            skeleton = ClassInstance.objects.create(user=user,
+                    project=project, class_column=skeleton_class,
+                    name='skeleton %s' % n)
+            cursor.execute('''
+            SELECT nextval('location_id_seq') FROM generate_series(1, %s)
+            ''', (options['nodes'],))
+            ids = [row[0] for row in cursor.fetchall()]
+            # A random walk through the sections, which occasionally branches
+            # off an earlier node.
+            x, y = random.uniform(0, size), random.uniform(0, size)
+            z = random.randint(0, options['sections'] - 1)
+            treenodes = []
+            for i, tid in enumerate(ids):
+                parent = None
+                if i > 0:
+                    parent = treenodes[-1]
+                    if random.random() < 0.05:
+                        parent = random.choice(treenodes)
+                    x = parent.location_x + random.gauss(0, 100)
+                    y = parent.location_y + random.gauss(0, 100)
+                    z = (parent.location_z / zres +
+                            random.choice((-1, 1))) % options['sections']
+                    z = z * zres
+                treenodes.append(Treenode(id=tid, user=user, editor=user,
+                        project=project, skeleton=skeleton, parent=parent,
+                        location_x=x, location_y=y, location_z=z,
+                        radius=-1, confidence=5))
+            Treenode.objects.bulk_create(treenodes)
+        cursor.execute('ANALYZE treenode')
+
+        views = []
+        for n in xrange(options['repeat']):
+            left = random.uniform(0, size - options['view'])
+            top = random.uniform(0, size - options['view'])
+            views.append({
+                'project_id': project.id,
+                'z': random.randint(0, options['sections'] - 1) * zres,
+                'left': left,
+                'top': top,
+                'right': left + options['view'],
+                'bottom': top + options['view'],
+                'limit': 5000,
+                'lower': '>'})
+
+        results = {}
+        for name, fetch_pairs in sorted(NODE_LIST_ENGINES.iteritems()):
+            # Warm up caches, so that both engines have the same conditions
+            fetch_pairs(cursor, views[0])
+            timings = []
+            pairs = []
+            for params in views:
+                start = time.time()
+                pairs.append(set(fetch_pairs(cursor, params)))
+                timings.append(time.time() - start)
+            results[name] = pairs
+            timings.sort()
+            self.stdout.write('%s: mean %.1fms, median %.1fms, max %.1fms, '
+                    '%.0f pairs per view' % (name,
+                    1000 * sum(timings) / len(timings),
+                    1000 * timings[len(timings) / 2], 1000 * timings[-1],
+                    sum(len(p) for p in pairs) / float(len(pairs))))
+
+        reference = results.pop('join')
+        for name, pairs in results.iteritems():
+            if pairs != reference:
+                self.stderr.write('Engine %s returned different nodes than the '
+                        'join engine (this is expected if the limit was hit)' % name)
@@ -0,0 +1,99 @@
+import random
+import time
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+from optparse import make_option
+
+from catmaid.models import *
+from catmaid.control.skeleton import _reroot_skeleton
+from catmaid.control.tracing import setup_tracing
+
+
+class Rollback(Exception):
+    pass
+
+class Command(NoArgsCommand):
+    help = "Time rerooting synthetic skeletons of different sizes. " \
+           "All created data is removed afterwards."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--user', dest='user_id', help='The ID of the user who will own the synthetic data'),
+        make_option('--sizes', dest='sizes', default='10000,100000,1000000',
+            help='A comma separated list of skeleton sizes in treenodes'),
+        make_option('--branching', dest='branching', type='float', default=0.05,
+            help='The probability of a new treenode to branch off a random earlier node'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+            help='The number of reroots per skeleton'),
+        )
+
+    def handle_noargs(self, **options):
+
+        if not options['user_id']:
+            raise CommandError("You must specify a user ID with --user")
+
+        try:
+            sizes = [int(s) for s in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError("The sizes have to be a list of integers")
+
+        user = User.objects.get(pk=options['user_id'])
+
+        try:
+            with transaction.atomic():
+                self.benchmark(user, sizes, options)
+                # Don't keep any of the synthetic data
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def benchmark(self, user, sizes, options):
+        project = Project.objects.create(title='Reroot benchmark')
+        setup_tracing(project.id, user)
+        skeleton_class = Class.objects.get(project=project, class_name='skeleton')
+        cursor = connection.cursor()
+
+        for size in sizes:
+            skeleton = ClassInstance.objects.create(user=user,
+                    project=project, class_column=skeleton_class,
+                    name='skeleton %s' % size)
+            cursor.execute('''
+            SELECT nextval('location_id_seq') FROM generate_series(1, %s)
+            ''', (size,))
+            ids = [row[0] for row in cursor.fetchall()]
+            # A random walk, which occasionally branches off an earlier node.
+            treenodes = []
+            for i, tid in enumerate(ids):
+                parent = None
+                x, y, z = 0.0, 0.0, 0.0
+                if i > 0:
+                    parent = treenodes[-1]
+                    if random.random() < options['branching']:
+                        parent = random.choice(treenodes)
+                    x = parent.location_x + random.gauss(0, 100)
+                    y = parent.location_y + random.gauss(0, 100)
+                    z = parent.location_z + 50.0
+                treenodes.append(Treenode(id=tid, user=user, editor=user,
+                        project=project, skeleton=skeleton, parent=parent,
+                        location_x=x, location_y=y, location_z=z,
+                        radius=-1, confidence=random.randint(1, 5)))
+            Treenode.objects.bulk_create(treenodes, batch_size=10000)
+            cursor.execute('ANALYZE treenode')
+
+            # Reroot at leaves, which have the longest paths to the root
+            cursor.execute('''
+            SELECT t.id FROM treenode t
+            WHERE t.skeleton_id = %s
+              AND NOT EXISTS (SELECT 1 FROM treenode c WHERE c.parent_id = t.id)
+            ''', (skeleton.id,))
+            leaves = [row[0] for row in cursor.fetchall()]
+
+            timings = []
+            for n in xrange(options['repeat']):
+                start = time.time()
+                _reroot_skeleton(random.choice(leaves), project.id)
+                timings.append(time.time() - start)
+            timings.sort()
+            self.stdout.write('%s nodes: mean %.1fms, median %.1fms, max %.1fms' % (
+                    size, 1000 * sum(timings) / len(timings),
+                    1000 * timings[len(timings) / 2], 1000 * timings[-1]))
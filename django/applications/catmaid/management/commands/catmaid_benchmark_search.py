@@ -0,0 +1,105 @@
+import time
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+from optparse import make_option
+
+from catmaid.models import *
+from catmaid.control.search import find_class_instances
+from catmaid.control.tracing import setup_tracing
+
+
+# Words names of the synthetic corpus are made of
+WORDS = ('neuron', 'skeleton', 'fragment', 'left', 'right', 'dorsal',
+        'ventral', 'anterior', 'posterior', 'motor', 'sensory', 'inter',
+        'projection', 'local', 'descending', 'ascending', 'mushroom', 'body',
+        'lateral', 'horn', 'antennal', 'lobe', 'uncertain', 'end', 'TODO',
+        'soma', 'axon', 'dendrite', 'synapse', 'reviewed')
+
+class Rollback(Exception):
+    pass
+
+class Command(NoArgsCommand):
+    help = "Time name searches in a synthetic corpus of class instances. " \
+           "All created data is removed afterwards."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--user', dest='user_id', help='The ID of the user who will own the synthetic data'),
+        make_option('--names', dest='names', type='int', default=1000000,
+            help='The number of class instance names to generate'),
+        make_option('--terms', dest='terms', default='neu,mushroom body,left 12,xyz',
+            help='A comma separated list of search terms'),
+        make_option('--limit', dest='limit', type='int', default=100,
+            help='The maximum number of results of limited searches'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+            help='The number of searches per term and mode'),
+        )
+
+    def handle_noargs(self, **options):
+
+        if not options['user_id']:
+            raise CommandError("You must specify a user ID with --user")
+
+        if options['names'] < 1:
+            raise CommandError("The number of names has to be positive")
+
+        user = User.objects.get(pk=options['user_id'])
+        terms = [t for t in options['terms'].split(',') if t]
+
+        try:
+            with transaction.atomic():
+                self.benchmark(user, terms, options)
+                # Don't keep any of the synthetic data
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def benchmark(self, user, terms, options):
+        project = Project.objects.create(title='Search benchmark')
+        setup_tracing(project.id, user)
+        class_ids = list(Class.objects.filter(project=project,
+                class_name__in=('neuron', 'skeleton', 'annotation', 'label'))
+                .values_list('id', flat=True))
+        cursor = connection.cursor()
+
+        # Names of three random words and a number, spread evenly over the
+        # classes
+        cursor.execute('''
+        INSERT INTO class_instance (user_id, project_id, class_id, name)
+        SELECT %(user_id)s, %(project_id)s,
+               (%(class_ids)s::integer[])[1 + i %% %(n_classes)s],
+               w[1 + (random() * (%(n_words)s - 1))::integer] || ' ' ||
+               w[1 + (random() * (%(n_words)s - 1))::integer] || ' ' ||
+               w[1 + (random() * (%(n_words)s - 1))::integer] || ' ' ||
+               (random() * 10000)::integer
+        FROM generate_series(1, %(n_names)s) i,
+             (SELECT %(words)s::text[] AS w) words
+        ''', {
+            'user_id': user.id,
+            'project_id': project.id,
+            'class_ids': class_ids,
+            'n_classes': len(class_ids),
+            'words': list(WORDS),
+            'n_words': len(WORDS),
+            'n_names': options['names'],
+        })
+        cursor.execute('ANALYZE class_instance')
+
+        modes = (
+            ('substring', {}),
+            ('substring, ranked, limited', {'ranked': True, 'limit': options['limit']}),
+            ('prefix', {'prefix': True}),
+            ('prefix, ranked, limited', {'prefix': True, 'ranked': True, 'limit': options['limit']}),
+        )
+        for term in terms:
+            for mode, kwargs in modes:
+                timings = []
+                for n in xrange(options['repeat']):
+                    start = time.time()
+                    results = find_class_instances(project.id, term, **kwargs)
+                    timings.append(time.time() - start)
+                timings.sort()
+                self.stdout.write('"%s" (%s), %s results: mean %.1fms, median %.1fms, max %.1fms' % (
+                        term, mode, len(results),
+                        1000 * sum(timings) / len(timings),
+                        1000 * timings[len(timings) / 2], 1000 * timings[-1]))
@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import NoArgsCommand, CommandError
+from optparse import make_option
+
+from catmaid.models import Project
+from catmaid.control.columnarexport import export_columnar, load_columnar, \
+        COLUMNAR_CHUNK_SIZE, TABLE_NAMES
+
+
+class Command(NoArgsCommand):
+    """ Call e.g. like
+        ./manage.py catmaid_export_columnar --project 1 --tables treenode,connector
+    """
+    help = "Export the tracing data of a project into a columnar HDF5 file, " \
+           "which can be read with catmaid.control.columnarexport.load_columnar"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--project', dest='project_id',
+            help='The ID of the exported project'),
+        make_option('--output', dest='output', default=None,
+            help='The name of the written file, export_pid_<project ID>.h5 by default'),
+        make_option('--tables', dest='tables', default=','.join(TABLE_NAMES),
+            help='A comma separated list of the exported tables'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=COLUMNAR_CHUNK_SIZE, help='The number of rows per chunk'),
+        make_option('--check', dest='check', default=False, action='store_true',
+            help='Load the written file again and report the time it took'),
+        )
+
+    def handle_noargs(self, **options):
+
+        if not options['project_id']:
+            raise CommandError("You must specify a project ID with --project")
+
+        if options['chunk_size'] < 1:
+            raise CommandError("The chunk size has to be positive")
+
+        project = Project.objects.get(pk=options['project_id'])
+        tables = [t for t in options['tables'].split(',') if t]
+        unknown = set(tables) - set(TABLE_NAMES)
+        if unknown:
+            raise CommandError("Unknown tables: %s, choose from: %s" % (
+                    ", ".join(sorted(unknown)), ", ".join(TABLE_NAMES)))
+        output = options['output'] or 'export_pid_%s.h5' % project.id
+
+        start = time.time()
+        counts = export_columnar(project.id, output, tables,
+                options['chunk_size'])
+        self.stdout.write('Exported %s to %s in %.1fs' % (", ".join(
+                '%s %s rows' % (t, counts[t]) for t in tables), output,
+                time.time() - start))
+
+        if options['check']:
+            start = time.time()
+            data = load_columnar(output)
+            for t in tables:
+                rows = set(len(column) for column in data[t].itervalues())
+                if rows != set([counts[t]]):
+                    raise CommandError("Table %s was not read back completely" % t)
+            self.stdout.write('Loaded all tables in %.1fs' % (time.time() - start))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import NoArgsCommand, CommandError
+from optparse import make_option
+
+from catmaid.models import Project
+from catmaid.control.adjacency import project_adjacency
+
+
+class Command(NoArgsCommand):
+    """ Call e.g. like
+        ./manage.py catmaid_update_adjacency --project 1
+    """
+    help = "Fill the partner cache of all skeletons of a project and bring " \
+           "its stored adjacency matrix up to date, so that requests don't " \
+           "have to build it"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--project', dest='project_id',
+            help='The ID of the project to update, all projects by default'),
+        )
+
+    def handle_noargs(self, **options):
+
+        if options['project_id']:
+            projects = Project.objects.filter(pk=options['project_id'])
+            if not projects:
+                raise CommandError("Project #%s doesn't exist" % options['project_id'])
+        else:
+            projects = Project.objects.all()
+
+        for project in projects:
+            start = time.time()
+            adjacency = project_adjacency(project.id)
+            self.stdout.write('Updated the adjacency matrix of project #%s '
+                    'with %s skeletons in %.1fs' % (project.id,
+                        len(adjacency.skeleton_ids), time.time() - start))
@@ -505,6 +505,68 @@ class ReviewerWhitelist(models.Model):
     reviewer = models.ForeignKey(User, related_name='+')
     accept_after = models.DateTimeField(default=datetime.min)
 
+class SkeletonSummary(models.Model):
+    """ This model keeps aggregate numbers about the treenodes and reviews of
+    a skeleton. It is maintained by database triggers on the treenode and
+    review tables and must not be changed directly. A cable length or union
+    review count of NULL means it has to be recomputed, which is done by the
+    functions in catmaid.control.skeletonsummary. The partners_version gets a
+    new value from a sequence whenever a link to one of the skeleton's
+    connectors changes, the edit_version whenever one of its treenodes does.
+    """
+    class Meta:
+        db_table = "skeleton_summary"
+    skeleton = models.OneToOneField(ClassInstance, primary_key=True)
+    project = models.ForeignKey(Project)
+    num_nodes = models.IntegerField(default=0)
+    num_reviewed = models.IntegerField(null=True)
+    cable_length = models.FloatField(null=True)
+    root_id = models.BigIntegerField(null=True)
+    last_edition_time = models.DateTimeField(default=datetime.now)
+    partners_cached = models.BooleanField(default=False)
+    partners_version = models.BigIntegerField()
+    edit_version = models.BigIntegerField()
+
+class SkeletonReviewSummary(models.Model):
+    """ The number of reviews of a particular reviewer in a skeleton. Like
+    SkeletonSummary, this is maintained by database triggers.
+    """
+    class Meta:
+        db_table = "skeleton_review_summary"
+        unique_together = ('skeleton', 'reviewer')
+    skeleton = models.ForeignKey(ClassInstance)
+    reviewer = models.ForeignKey(User)
+    num_reviewed = models.IntegerField(default=0)
+
+class SkeletonPartnerCache(models.Model):
+    """ The number of links of a skeleton with a particular relation to
+    connectors, which are linked to a partner skeleton with a particular
+    relation. These rows are filled on demand by
+    catmaid.control.partnercache for skeletons whose summary isn't marked
+    with partners_cached. A database trigger removes them when a link to one
+    of the connectors involved changes.
+    """
+    class Meta:
+        db_table = "skeleton_partner_cache"
+    skeleton = models.ForeignKey(SkeletonSummary, related_name='partners')
+    relation = models.ForeignKey(Relation, related_name='+')
+    partner = models.ForeignKey(ClassInstance, related_name='+')
+    partner_relation = models.ForeignKey(Relation, related_name='+')
+    num_links = models.IntegerField()
+
+class AnnotationHierarchyVersion(models.Model):
+    """ A number that gets a new value from a sequence whenever an
+    annotated_with link of an annotation in the project changes, i.e. whenever
+    annotations are annotated with other annotations or these links are
+    removed. It is maintained by a database trigger on the
+    class_instance_class_instance table and tells
+    catmaid.control.annotationhierarchy when to rebuild its cached hierarchy.
+    """
+    class Meta:
+        db_table = "annotation_hierarchy_version"
+    project = models.OneToOneField(Project, primary_key=True)
+    version = models.BigIntegerField()
+
 class RegionOfInterest(UserFocusedModel):
     class Meta:
         db_table = "region_of_interest"
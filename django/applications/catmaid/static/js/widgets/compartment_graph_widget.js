@@ -1518,6 +1518,7 @@ GroupGraph.prototype.growPaths = function() {
 
   var new_skids = {},
       errors = [],
+      truncated = false,
       min = Math.max(s.min_upstream, s.min_downstream);
 
 
@@ -1532,12 +1533,16 @@ GroupGraph.prototype.growPaths = function() {
            if (200 !== status) return;
            var json = $.parseJSON(text);
            if (json.error) errors.push(json.error);
-           else process(json);
+           else {
+             if (json.truncated) truncated = true;
+             process(json.paths);
+           }
            continuation();
          });
   };
 
   var end = (function() {
+    if (truncated) growlAlert("Warning", "Too many paths, not all of them were searched.");
     var skids = Object.keys(new_skids);
     if (0 === skids.length) return growlAlert("Information", "No paths found.");
     skids = skids.filter(function(skid) { return !this.hasSkeleton(skid); }, this);
@@ -35,6 +35,10 @@ var NeuronAnnotations = function()
   this.display_length = 50;
   this.display_start = 0;
   this.total_n_results = 0;
+  // The ID of the last entity of the previous page, if known, and those of
+  // the pages before it.
+  this.display_after = undefined;
+  this.previous_display_after = [];
 };
 
 NeuronAnnotations.prototype = {};
@@ -371,6 +375,8 @@ NeuronAnnotations.prototype.query = function(initialize)
   if (initialize) {
     this.display_start = 0;
     this.total_n_results = 0;
+    this.display_after = undefined;
+    this.previous_display_after = [];
     // Reset "select all" check box
     $('#neuron_annotations_toggle_neuron_selections_checkbox' + this.widgetID)
         .prop('checked', false);
@@ -423,6 +429,9 @@ NeuronAnnotations.prototype.query = function(initialize)
   // Augment form data with offset and limit information
   form_data.display_start = this.display_start;
   form_data.display_length = this.display_length;
+  if (undefined !== this.display_after) {
+    form_data.display_after = this.display_after;
+  }
 
   // Here, $.proxy is used to bind 'this' to the anonymous function
   requestQueue.register(django_url + this.pid + '/neuron/query-by-annotations',
@@ -880,6 +889,7 @@ NeuronAnnotations.prototype.prev_page = function()
         .prop('checked', false);
     // Go one page back
     this.display_start -= this.display_length;
+    this.display_after = this.previous_display_after.pop();
     this.query(false);
   }
 };
@@ -894,7 +904,11 @@ NeuronAnnotations.prototype.next_page = function()
     // Reset "select all" check box
     $('#neuron_annotations_toggle_neuron_selections_checkbox' + this.widgetID)
         .prop('checked', false);
-    // Go one page forward
+    // Go one page forward, starting after the last entity shown
+    var entities = this.queryResults[0];
+    this.previous_display_after.push(this.display_after);
+    this.display_after = entities.length > 0 ?
+        entities[entities.length - 1].id : undefined;
     this.display_start = new_display_start;
     this.query(false);
   }
@@ -896,6 +896,16 @@ NeuronNavigator.Node.prototype.add_neuron_list_table = function($container,
   // Add table to DOM
   $container.append(content);
 
+  // The name and ID of the last neuron displayed, which lets the next page be
+  // requested without skipping all neurons before it. It is only used if
+  // nothing but the offset of the page changed.
+  var lastNeuron = null;
+  var pageSignature = function(aoData) {
+    return JSON.stringify(aoData.filter(function(d) {
+      return d.name !== 'iDisplayStart' && d.name !== 'sEcho';
+    }));
+  };
+
   // Fill neuron table
   var datatable = $(table).dataTable({
     // http://www.datatables.net/usage/options
@@ -924,6 +934,16 @@ NeuronNavigator.Node.prototype.add_neuron_list_table = function($container,
               'value': filters.user_id
           });
         }
+        // Continue after the last neuron, if the next page is requested
+        var displayStart = aoData.reduce(function(start, d) {
+          return d.name === 'iDisplayStart' ? parseInt(d.value) : start;
+        }, 0);
+        var signature = pageSignature(aoData);
+        if (lastNeuron && lastNeuron.next_start === displayStart &&
+            lastNeuron.signature === signature) {
+          aoData.push({'name': 'display_after_name', 'value': lastNeuron.name});
+          aoData.push({'name': 'display_after_id', 'value': lastNeuron.id});
+        }
         $.ajax({
             "dataType": 'json',
             "cache": false,
@@ -931,6 +951,13 @@ NeuronNavigator.Node.prototype.add_neuron_list_table = function($container,
             "url": sSource,
             "data": aoData,
             "success": function(result) {
+                var rows = result.aaData;
+                lastNeuron = rows.length === 0 ? null : {
+                  'next_start': displayStart + rows.length,
+                  'signature': signature,
+                  'name': rows[rows.length - 1][0],
+                  'id': rows[rows.length - 1][3]
+                };
                 fnCallback(result);
                 if (callback) {
                   callback(result);
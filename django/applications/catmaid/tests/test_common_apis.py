@@ -1,24 +1,46 @@
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Group, Permission
 from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test.utils import override_settings
 from django.http import HttpResponse
 from django.db import connection, transaction
 from django.shortcuts import get_object_or_404
 from guardian.shortcuts import assign_perm
 import os
 import re
+import csv
+import gzip
+import shutil
+import tempfile
 import urllib
 import json
 import datetime
+import numpy
+import networkx
 
 from catmaid.models import Project, Stack, ProjectStack
 from catmaid.models import ClassInstance, Log, Message, TextlabelLocation
 from catmaid.models import Treenode, Connector, TreenodeConnector, User, Review, ReviewerWhitelist
 from catmaid.models import Textlabel, TreenodeClassInstance, ClassInstanceClassInstance
+from catmaid.models import SkeletonSummary, SkeletonPartnerCache
 from catmaid.fields import Double3D, Integer3D
+from catmaid.control import analytics, circles, columnarexport, \
+        connectomeexport, nodecache, partnercache, synapseclustering
+from catmaid.control.adjacency import project_adjacency, skeleton_edges, \
+        synapse_partners
+from catmaid.control.annotationhierarchy import project_hierarchy
+from catmaid.control.authentication import user_can_edit, user_domain, \
+        invalidate_user_domains, _cached_user_domain
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
-from catmaid.control.neuron_annotations import _annotate_entities, create_annotation_query
+from catmaid.control.neuron_annotations import _annotate_entities, \
+        create_annotation_query, get_sub_annotation_ids
+from catmaid.control.skeletonsummary import skeleton_summaries
+from catmaid.control.tree_util import lazy_load_arbors, \
+        find_common_ancestor, find_common_ancestors
+from scipy.sparse.csgraph import dijkstra
 
 
 class TransactionTests(TransactionTestCase):
@@ -78,6 +100,48 @@ class TransactionTests(TransactionTestCase):
 
         self.assertEqual(log_count + 1, count_logs())
 
+    def test_analyze_skeletons_in_pool(self):
+        """ The analysis view doesn't run in a request transaction, so that it
+        can read from its own snapshot and fork its process pool. Therefore,
+        this has to be part of a TransactionTest. """
+        self.fake_authentication()
+
+        def analyze(skeleton_ids):
+            params = {'skeleton_ids[%s]' % i: skid
+                      for i, skid in enumerate(skeleton_ids)}
+            params['adjacents'] = 2
+            response = self.client.post(
+                    '/%d/skeleton/analytics' % self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content)
+            return {skid: sorted(issues)
+                    for skid, issues in parsed_response['issues']}
+
+        issues = analyze((235, 373))
+        self.assertIsNone(analytics._pool)
+
+        # Parallel analysis must find the same issues as serial analysis
+        processes = analytics.ANALYSIS_PROCESSES
+        min_skeletons = analytics.PARALLEL_ANALYSIS_MIN_SKELETONS
+        analytics.ANALYSIS_PROCESSES = 2
+        analytics.PARALLEL_ANALYSIS_MIN_SKELETONS = 1
+        try:
+            with transaction.atomic():
+                # No pool is forked from within a transaction
+                self.assertIsNone(analytics._analysis_pool())
+            self.assertEqual(issues, analyze((235, 373)))
+            self.assertIsNotNone(analytics._pool)
+            # The pool is reused by later requests
+            pool = analytics._pool
+            self.assertEqual(issues, analyze((235, 373)))
+            self.assertIs(pool, analytics._pool)
+        finally:
+            if analytics._pool is not None:
+                analytics._pool.terminate()
+                analytics._pool = None
+            analytics.ANALYSIS_PROCESSES = processes
+            analytics.PARALLEL_ANALYSIS_MIN_SKELETONS = min_skeletons
+
 
 class InsertionTest(TestCase):
     """ This test case insers various model objects and tests if this is done as
@@ -291,6 +355,110 @@ class ViewPageTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.compare_swc_data(response.content, swc_output_for_skeleton_235)
 
+    def test_swc_file_stream(self):
+        self.fake_authentication()
+        url = '/%d/skeleton/235/swc/stream' % (self.test_project_id,)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.compare_swc_data(''.join(response.streaming_content),
+                swc_output_for_skeleton_235)
+
+        # Unknown skeletons and those of other projects are errors
+        other_project = Project.objects.create(title='Other project')
+        assign_perm('can_browse', User.objects.get(username='test2'),
+                other_project)
+        for url in ('/%d/skeleton/999999/swc/stream' % self.test_project_id,
+                '/%d/skeleton/235/swc/stream' % other_project.id):
+            response = self.client.get(url)
+            self.assertFalse(response.streaming)
+            self.assertIn('error', json.loads(response.content))
+
+    def test_compact_skeleton_stream(self):
+        self.fake_authentication()
+        def fetch(url):
+            response = self.client.get(url % self.test_project_id)
+            self.assertEqual(response.status_code, 200)
+            content = ''.join(response.streaming_content) \
+                    if response.streaming else response.content
+            return [sorted(r) if isinstance(r, list) else
+                    {k: sorted(v) for k, v in r.iteritems()}
+                    for r in json.loads(content)]
+
+        for flags in ('0/0', '1/0', '0/1', '1/1'):
+            self.assertEqual(fetch('/%d/235/' + flags + '/compact-skeleton'),
+                    fetch('/%d/235/' + flags + '/compact-skeleton/stream'))
+        for flags in ('0/0/0', '1/0/0', '1/1/0', '1/1/1', '0/1/1'):
+            self.assertEqual(fetch('/%d/373/' + flags + '/compact-arbor'),
+                    fetch('/%d/373/' + flags + '/compact-arbor/stream'))
+
+    def test_compact_skeletons(self):
+        self.fake_authentication()
+        skeleton_ids = (235, 361, 373)
+        params = {'skeleton_ids[%s]' % i: skid
+                  for i, skid in enumerate(skeleton_ids)}
+        params.update(with_connectors=1, with_tags=1)
+        response = self.client.post(
+                '/%d/skeletons/compact' % self.test_project_id, params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(''.join(response.streaming_content))
+        self.assertEqual(set(map(str, skeleton_ids)), set(parsed_response))
+
+        def normalize(skeleton):
+            return [sorted(skeleton[0]), sorted(skeleton[1]),
+                    {k: sorted(v) for k, v in skeleton[2].iteritems()}]
+
+        for skid in skeleton_ids:
+            response = self.client.get('/%d/%d/1/1/compact-skeleton' % (
+                    self.test_project_id, skid))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(normalize(json.loads(response.content)),
+                    normalize(parsed_response[str(skid)]))
+
+        # Skeletons of other projects aren't sent
+        other_project = Project.objects.create(title='Other project')
+        assign_perm('can_browse', User.objects.get(username='test2'),
+                other_project)
+        response = self.client.post(
+                '/%d/skeletons/compact' % other_project.id, params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(''.join(response.streaming_content))
+        self.assertEqual({str(skid): [[], [], {}] for skid in skeleton_ids},
+                parsed_response)
+
+    def test_import_skeletons(self):
+        self.fake_authentication()
+
+        files = [SimpleUploadedFile(name, swc_output_for_skeleton_235)
+                 for name in ('first.swc', 'second.swc')]
+        response = self.client.post(
+                '/%d/skeletons/import' % self.test_project_id,
+                {'file': files})
+        self.assertEqual(response.status_code, 200)
+        results = [json.loads(line) for line in
+                ''.join(response.streaming_content).splitlines()]
+        self.assertEqual(2, len(results))
+
+        def parents_by_location(swc):
+            """ Map every node location to the location of its parent. """
+            rows = swc_string_to_sorted_matrix(swc)
+            locations = {row[0]: tuple(map(float, row[2:5])) for row in rows}
+            return {locations[row[0]]: locations.get(row[6]) for row in rows}
+
+        expected_parents = parents_by_location(swc_output_for_skeleton_235)
+        for n, (result, name) in enumerate(zip(results, ('first.swc', 'second.swc')), 1):
+            self.assertEqual(name, result['name'])
+            self.assertEqual(n, result['done'])
+            self.assertEqual(2, result['total'])
+            self.assertFalse('error' in result)
+            skeleton = ClassInstance.objects.get(pk=result['skeleton_id'])
+            self.assertEqual(name, skeleton.name)
+
+            response = self.client.get('/%d/skeleton/%d/swc' % (
+                    self.test_project_id, result['skeleton_id']))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(expected_parents,
+                    parents_by_location(response.content))
+
     def test_labels(self):
         self.fake_authentication()
         response = self.client.get('/%d/labels-all' % (self.test_project_id,))
@@ -1769,6 +1937,37 @@ class ViewPageTests(TestCase):
                 {"id":362, "name":"downstream-B", "class_name":"neuron"}]
         self.assertEqual(expected_result, parsed_response)
 
+    def test_search_ranked_and_prefix(self):
+        self.fake_authentication()
+
+        def search(**params):
+            response = self.client.get('/%d/search' % self.test_project_id,
+                    params)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)
+
+        # Exact matches come first, then names that start with the term and
+        # names with a word that does
+        ranked = search(substring='skeleton 235', rank=1)
+        self.assertEqual([235], [r['id'] for r in ranked])
+        ranked = search(substring='skeleton', rank=1)
+        names = [r['name'] for r in ranked]
+        self.assertEqual('dull skeleton', names[-1])
+        self.assertTrue(all(n.lower().startswith('skeleton') for n in names[:-1]))
+
+        # Prefix matches are a subset of substring matches
+        substring = search(substring='skeleton 23')
+        prefix = search(substring='skeleton 23', prefix=1)
+        self.assertEqual(sorted(r['id'] for r in substring
+                if r['name'].lower().startswith('skeleton 23')),
+                sorted(r['id'] for r in prefix))
+        self.assertEqual([], search(substring='keleton', prefix=1))
+
+        # Wildcards are matched literally and results can be limited
+        self.assertEqual([], search(substring='skeleton_2'))
+        self.assertEqual(ranked[:2], search(substring='skeleton', rank=1,
+                max_results=2))
+
     def test_search_with_no_results(self):
         self.fake_authentication()
 
@@ -1977,6 +2176,185 @@ class ViewPageTests(TestCase):
 
         self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=2405).skeleton_id)
 
+    def test_skeleton_summary(self):
+        self.fake_authentication()
+
+        def assertSummariesAreCurrent():
+            cursor = connection.cursor()
+            cursor.execute('''
+                SELECT t.skeleton_id, count(*),
+                       min(CASE WHEN t.parent_id IS NULL THEN t.id END),
+                       coalesce(sum(sqrt((t.location_x - p.location_x)^2 +
+                                         (t.location_y - p.location_y)^2 +
+                                         (t.location_z - p.location_z)^2)), 0)
+                FROM treenode t
+                LEFT JOIN treenode p ON p.id = t.parent_id
+                WHERE t.project_id = %s
+                GROUP BY t.skeleton_id
+                ''', (self.test_project_id,))
+            expected = {row[0]: row[1:] for row in cursor.fetchall()}
+            cursor.execute('''
+                SELECT skeleton_id, count(DISTINCT treenode_id)
+                FROM review GROUP BY skeleton_id
+                ''')
+            reviewed = dict(cursor.fetchall())
+
+            summaries = skeleton_summaries(expected.keys(), ('num_nodes',
+                    'root_id', 'cable_length', 'num_reviewed'))
+            self.assertEqual(set(expected), set(summaries))
+            self.assertEqual(len(expected), SkeletonSummary.objects.filter(
+                    project=self.test_project_id).count())
+            for skid, (num_nodes, root_id, cable_length) in expected.iteritems():
+                summary = summaries[skid]
+                self.assertEqual(num_nodes, summary[0])
+                self.assertEqual(root_id, summary[1])
+                self.assertAlmostEqual(cable_length, summary[2], places=3)
+                self.assertEqual(reviewed.get(skid, 0), summary[3])
+
+        assertSummariesAreCurrent()
+
+        response = self.client.post('/%d/treenode/create' % self.test_project_id, {
+            'x': 5, 'y': 10, 'z': 15, 'confidence': 5, 'parent_id': 237,
+            'radius': 2})
+        self.assertEqual(response.status_code, 200)
+        assertSummariesAreCurrent()
+
+        response = self.client.post('/%d/node/update' % self.test_project_id, {
+            't': json.dumps([[289, 5690, 3340, 0], [285, 5200, 3010, 9]])})
+        self.assertEqual(response.status_code, 200)
+        assertSummariesAreCurrent()
+
+        response = self.client.post('/%d/node/%d/reviewed' % (
+                self.test_project_id, 289))
+        self.assertEqual(response.status_code, 200)
+        assertSummariesAreCurrent()
+
+        response = self.client.post('/%d/skeleton/reroot' % self.test_project_id,
+                {'treenode_id': 2394})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/%d/skeleton/join' % self.test_project_id, {
+            'from_id': 2415, 'to_id': 2394, 'annotation_set': '{}'})
+        self.assertEqual(response.status_code, 200)
+        assertSummariesAreCurrent()
+
+        response = self.client.post('/%d/treenode/delete' % self.test_project_id,
+                {'treenode_id': 2394})
+        self.assertEqual(response.status_code, 200)
+        assertSummariesAreCurrent()
+
+        Review.objects.filter(treenode_id=289).delete()
+        assertSummariesAreCurrent()
+
+    def test_connectome_export(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'all')
+            # Within the test's transaction, no worker processes are used
+            changed = connectomeexport.export(self.test_project_id, filename,
+                    n_shards=4)
+            self.assertEqual([0, 1, 2, 3], changed)
+
+            def read_csv(name):
+                with gzip.open('%s.%s.%s.csv.gz' % (filename,
+                        self.test_project_id, name)) as f:
+                    return list(csv.reader(f))[1:]
+
+            cursor = connection.cursor()
+            cursor.execute('''
+                SELECT t.skeleton_id, t.id, t.parent_id
+                FROM treenode t
+                WHERE t.project_id = %s
+                  AND t.skeleton_id IN (SELECT skeleton_id FROM treenode
+                                        GROUP BY skeleton_id
+                                        HAVING count(*) > 1)
+                ''', (self.test_project_id,))
+            expected = sorted(cursor.fetchall())
+            rows = read_csv('skeletons')
+            self.assertEqual(expected, sorted((int(r[0]), int(r[1]),
+                    int(r[2]) if r[2] else None) for r in rows))
+            self.assertTrue(all(len(r) == 6 for r in rows))
+            self.assertTrue(len(read_csv('synapses')) > 0)
+
+            # Nothing changed, nothing is written again
+            self.assertEqual([], connectomeexport.export(self.test_project_id,
+                    filename, n_shards=4, processes=1))
+            self.assertEqual(sorted(rows), sorted(read_csv('skeletons')))
+
+            # Only the shard of an edited skeleton is written again, even if
+            # the edit doesn't change the skeleton's last edition time, like
+            # one of a transaction that started earlier
+            cursor.execute('''
+            UPDATE treenode SET location_x = 1, location_y = 2, location_z = 3,
+                edition_time = edition_time - interval '1 day'
+            WHERE id = 2394
+            ''')
+            treenode = Treenode.objects.get(id=2394)
+            self.assertEqual([treenode.skeleton_id % 4],
+                    connectomeexport.export(self.test_project_id, filename,
+                        n_shards=4, processes=1))
+            self.assertIn(['2394', '1.0', '2.0', '3.0'],
+                    [r[1:2] + ['%.1f' % float(v) for v in r[3:]]
+                        for r in read_csv('skeletons')])
+
+            # A GraphML export is a single valid document
+            connectomeexport.export(self.test_project_id, filename + '.graphml',
+                    'graphml', n_shards=4, processes=1)
+            with gzip.open(filename + '.graphml.gz') as f:
+                graph = f.read()
+            self.assertTrue(graph.endswith('</graph>\n</graphml>'))
+            self.assertEqual(len(expected), graph.count('<node '))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_columnar_export(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'export.h5')
+            counts = columnarexport.export_columnar(self.test_project_id, path,
+                    chunk_size=4)
+            data = columnarexport.load_columnar(path)
+            self.assertEqual(self.test_project_id, data['project_id'])
+            self.assertEqual(get_relation_to_id_map(self.test_project_id),
+                    data['relations'])
+
+            treenodes = Treenode.objects.filter(project=self.test_project_id)
+            self.assertEqual(treenodes.count(), counts['treenode'])
+            self.assertEqual(Connector.objects.filter(
+                    project=self.test_project_id).count(), counts['connector'])
+            self.assertEqual(TreenodeConnector.objects.filter(
+                    project=self.test_project_id).count(),
+                    counts['treenode_connector'])
+            for name, count in counts.iteritems():
+                for column in data[name].itervalues():
+                    self.assertEqual(count, len(column))
+
+            expected = sorted(treenodes.values_list('id', 'parent_id',
+                    'skeleton_id', 'location_x'))
+            t = data['treenode']
+            self.assertEqual(expected, [(i, None if p == -1 else p, s, x)
+                    for i, p, s, x in zip(t['id'].tolist(),
+                        t['parent_id'].tolist(), t['skeleton_id'].tolist(),
+                        t['location_x'].tolist())])
+            self.assertEqual(set(TreenodeClassInstance.objects.filter(
+                    project=self.test_project_id,
+                    relation__relation_name='labeled_as').values_list(
+                        'treenode_id', 'class_instance__name')),
+                    set(zip(data['tag']['treenode_id'].tolist(),
+                        [data['label']['name'][data['label']['id'] == l][0]
+                            for l in data['tag']['label_id']])))
+
+            arbor = columnarexport.treenode_arbor(data)
+            self.assertEqual(len(expected), len(arbor.ids))
+            self.assertEqual(len(set(t['skeleton_id'])), len(arbor.roots()))
+
+            # Only some tables
+            columnarexport.export_columnar(self.test_project_id, path,
+                    ('review',))
+            self.assertEqual(['project_id', 'relations', 'review'],
+                    sorted(columnarexport.load_columnar(path)))
+        finally:
+            shutil.rmtree(directory)
+
     def test_treenode_info_nonexisting_treenode_failure(self):
         self.fake_authentication()
         treenode_id = 55555
@@ -2309,6 +2687,36 @@ class ViewPageTests(TestCase):
         expected_result.pop(0)
         self.assertEqual(parsed_response, expected_result)
 
+    def test_skeleton_measurements(self):
+        self.fake_authentication()
+        skeleton_ids = (1, 235, 361, 373, 2364, 2388, 2411, 2433, 2440, 2451)
+        response = self.client.post(
+                '/%d/skeletons/measure' % self.test_project_id,
+                {'skeleton_ids[%s]' % i: skid
+                 for i, skid in enumerate(skeleton_ids)})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = {row[0]: row for row in json.loads(response.content)}
+        # Reference values of the previous, node by node implementation:
+        # skeleton ID, raw cable, smooth cable, number of nodes, number of
+        # branch nodes, number of end nodes and principal branch cable.
+        expected_result = [
+                (1, 848, 468, 29, 0, 2, 468.694964184580),
+                (235, 11243, 10640, 28, 2, 4, 7391.129118055569),
+                (361, 4575, 4005, 9, 0, 2, 2142.009799879039),
+                (373, 2345, 2324, 5, 0, 2, 1705.858546221254),
+                (2364, 4057, 2879, 6, 0, 2, 2879.578084397372),
+                (2388, 1513, 1411, 3, 0, 2, 1411.892200626255),
+                (2411, 1480, 1344, 4, 0, 2, 947.579416043180),
+                (2433, 0, 0, 1, 0, 0, 0),
+                (2440, 1980, 1000, 3, 0, 2, 354.316188652673),
+                (2451, 0, 0, 1, 0, 0, 0)]
+        self.assertEqual(len(expected_result), len(parsed_response))
+        for expected in expected_result:
+            row = parsed_response[expected[0]]
+            self.assertEqual(expected[:3], tuple(row[:3]))
+            self.assertEqual(expected[3:6], tuple(row[5:8]))
+            self.assertAlmostEqual(expected[6], row[8], places=6)
+
     def test_skeleton_ancestry(self):
         skeleton_id = 361
 
@@ -2390,6 +2798,320 @@ class ViewPageTests(TestCase):
         expected_result = {'message': 'success'}
         self.assertEqual(expected_result, parsed_response)
 
+    def test_skeleton_connectivity_cache(self):
+        self.fake_authentication()
+        skeleton_ids = (235, 373)
+        relations = get_relation_to_id_map(self.test_project_id)
+
+        def expected_partners(relation_1, relation_2):
+            """ Compute partners with the self-join the cache replaces. """
+            cursor = connection.cursor()
+            cursor.execute('''
+                SELECT t1.skeleton_id, t2.skeleton_id, count(*)
+                FROM treenode_connector t1, treenode_connector t2
+                WHERE t1.skeleton_id = ANY(%s::bigint[])
+                  AND t1.relation_id = %s
+                  AND t1.connector_id = t2.connector_id
+                  AND t2.relation_id = %s
+                GROUP BY t1.skeleton_id, t2.skeleton_id
+                ''', (list(skeleton_ids), relations[relation_1],
+                      relations[relation_2]))
+            partners = {}
+            for skid, partner_id, count in cursor.fetchall():
+                partners.setdefault(str(partner_id), {})[str(skid)] = count
+            return partners
+
+        def assertConnectivity():
+            params = {'source[%s]' % i: skid
+                      for i, skid in enumerate(skeleton_ids)}
+            params['boolean_op'] = 'logic-OR'
+            response = self.client.post(
+                    '/%d/skeleton/connectivity' % self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content)
+            for direction, relation_1, relation_2 in (
+                    ('incoming', 'postsynaptic_to', 'presynaptic_to'),
+                    ('outgoing', 'presynaptic_to', 'postsynaptic_to')):
+                self.assertEqual(expected_partners(relation_1, relation_2),
+                        {partner_id: partner['skids'] for partner_id, partner
+                         in parsed_response[direction].iteritems()})
+
+        assertConnectivity()
+        self.assertTrue(SkeletonPartnerCache.objects.filter(
+                skeleton__in=skeleton_ids).exists())
+
+        # Changing a link must be reflected in the cached partners
+        response = self.client.post('/%d/link/create' % self.test_project_id, {
+            'from_id': 2394, 'to_id': 356, 'link_type': 'postsynaptic_to'})
+        self.assertEqual(response.status_code, 200)
+        assertConnectivity()
+
+        response = self.client.post('/%d/link/delete' % self.test_project_id, {
+            'connector_id': 356, 'treenode_id': 377})
+        self.assertEqual(response.status_code, 200)
+        assertConnectivity()
+
+    def test_project_adjacency(self):
+        self.fake_authentication()
+        relations = get_relation_to_id_map(self.test_project_id)
+
+        def assertAdjacency():
+            """ Compare the matrix with a self-join of all project links. """
+            cursor = connection.cursor()
+            cursor.execute('''
+                SELECT t1.skeleton_id, t2.skeleton_id, count(*)
+                FROM treenode_connector t1, treenode_connector t2
+                WHERE t1.project_id = %s
+                  AND t1.relation_id = %s
+                  AND t1.connector_id = t2.connector_id
+                  AND t2.relation_id = %s
+                GROUP BY t1.skeleton_id, t2.skeleton_id
+                ''', (self.test_project_id, relations['presynaptic_to'],
+                      relations['postsynaptic_to']))
+            expected = sorted(cursor.fetchall())
+            adjacency = project_adjacency(self.test_project_id)
+            self.assertEqual(expected, sorted(adjacency.edges()))
+            self.assertEqual(dict(((pre, post), count)
+                    for pre, post, count in expected if pre == 235),
+                    dict(((235, post), count) for post, count
+                         in adjacency.downstream(235).iteritems()))
+            return expected
+
+        # Questions about a few skeletons only need the partners of these
+        edges = sorted(skeleton_edges(self.test_project_id, (235, 373)))
+        partners = synapse_partners(self.test_project_id, [235], upstream=False)
+        cursor = connection.cursor()
+        cursor.execute('SELECT skeleton_id FROM skeleton_summary WHERE partners_cached')
+        self.assertEqual(set([235, 373]), set(row[0] for row in cursor.fetchall()))
+
+        # The partners of all other skeletons are computed in batches
+        batch_size = partnercache.PARTNER_CACHE_FILL_BATCH_SIZE
+        partnercache.PARTNER_CACHE_FILL_BATCH_SIZE = 2
+        try:
+            expected = assertAdjacency()
+        finally:
+            partnercache.PARTNER_CACHE_FILL_BATCH_SIZE = batch_size
+        self.assertTrue(len(expected) > 0)
+        self.assertEqual([e for e in expected if e[0] in (235, 373)
+                          and e[1] in (235, 373)],
+                sorted(project_adjacency(self.test_project_id).edges((235, 373))))
+        self.assertEqual([e for e in expected if e[0] in (235, 373)
+                          and e[1] in (235, 373)], edges)
+        self.assertEqual(set(post for pre, post, count in expected if pre == 235),
+                partners)
+
+        # Link changes must be reflected in the matrix
+        response = self.client.post('/%d/link/create' % self.test_project_id, {
+            'from_id': 2394, 'to_id': 356, 'link_type': 'postsynaptic_to'})
+        self.assertEqual(response.status_code, 200)
+        assertAdjacency()
+
+        response = self.client.post('/%d/link/delete' % self.test_project_id, {
+            'connector_id': 356, 'treenode_id': 377})
+        self.assertEqual(response.status_code, 200)
+        assertAdjacency()
+
+    def test_graph_search(self):
+        self.fake_authentication()
+        relations = get_relation_to_id_map(self.test_project_id)
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT DISTINCT t1.skeleton_id, t2.skeleton_id
+            FROM treenode_connector t1, treenode_connector t2
+            WHERE t1.project_id = %s
+              AND t1.relation_id = %s
+              AND t1.connector_id = t2.connector_id
+              AND t2.relation_id = %s
+            ''', (self.test_project_id, relations['presynaptic_to'],
+                  relations['postsynaptic_to']))
+        edges = set(cursor.fetchall())
+
+        response = self.client.post(
+                '/%d/graph/circlesofhell' % self.test_project_id, {
+                    'skeleton_ids[0]': 235, 'n_circles': 1,
+                    'min_pre': 1, 'min_post': 1})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        expected = set(post for pre, post in edges if pre == 235) | \
+                set(pre for pre, post in edges if post == 235)
+        expected.discard(235)
+        self.assertEqual(sorted(expected), sorted(parsed_response[0]))
+
+        sources = (235, 373)
+        response = self.client.post(
+                '/%d/graph/directedpaths' % self.test_project_id, {
+                    'skeleton_ids[0]': sources[0],
+                    'skeleton_ids[1]': sources[1], 'n_circles': 2,
+                    'min_pre': 1, 'min_post': 1})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(''.join(response.streaming_content))
+        self.assertFalse(parsed_response['truncated'])
+        paths = parsed_response['paths']
+        for path in paths:
+            self.assertEqual(set(sources), set((path[0], path[-1])))
+            self.assertTrue(len(path) <= 4)
+            self.assertEqual(len(path), len(set(path)))
+            for pre, post in zip(path[:-1], path[1:]):
+                self.assertTrue((pre, post) in edges)
+        for pre, post in edges:
+            if pre in sources and post in sources and pre != post:
+                self.assertTrue([pre, post] in paths)
+
+        # Searches that are cut short say so
+        def directed_paths(max_paths):
+            response = self.client.post(
+                    '/%d/graph/directedpaths' % self.test_project_id, {
+                        'skeleton_ids[0]': sources[0],
+                        'skeleton_ids[1]': sources[1], 'n_circles': 2,
+                        'min_pre': 1, 'min_post': 1, 'max_paths': max_paths})
+            self.assertEqual(response.status_code, 200)
+            return json.loads(''.join(response.streaming_content))
+
+        self.assertTrue(len(paths) > 0)
+        complete = directed_paths(len(paths))
+        self.assertEqual(paths, complete['paths'])
+        self.assertFalse(complete['truncated'])
+        truncated = directed_paths(len(paths) - 1)
+        self.assertEqual(paths[:-1], truncated['paths'])
+        self.assertTrue(truncated['truncated'])
+
+        deadline = circles.PATH_SEARCH_TIME_BUDGET
+        circles.PATH_SEARCH_TIME_BUDGET = -1
+        try:
+            timed_out = directed_paths(len(paths))
+        finally:
+            circles.PATH_SEARCH_TIME_BUDGET = deadline
+        self.assertEqual([], timed_out['paths'])
+        self.assertTrue(timed_out['truncated'])
+
+    def test_analyze_skeletons(self):
+        self.fake_authentication()
+
+        def analyze(skeleton_ids):
+            params = {'skeleton_ids[%s]' % i: skid
+                      for i, skid in enumerate(skeleton_ids)}
+            params['adjacents'] = 2
+            response = self.client.post(
+                    '/%d/skeleton/analytics' % self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content)
+            return {skid: sorted(issues)
+                    for skid, issues in parsed_response['issues']}
+
+        issues = analyze((235, 373))
+        self.assertEqual(set((235, 373)), set(issues.keys()))
+        self.assertTrue(any(issues.values()))
+        # Batches must find the same issues as single skeletons
+        for skid in (235, 373):
+            self.assertEqual(issues[skid], analyze((skid,))[skid])
+
+
+    def test_synapse_clustering(self):
+        # Densities along a random forest must match those of the exact
+        # distances computed with Dijkstra, whatever the batch size.
+        random = numpy.random.RandomState(42)
+        G = networkx.Graph()
+        for node in xrange(1, 300):
+            G.add_edge(int(random.randint(0, node)), node,
+                    weight=random.uniform(0.1, 5))
+        for node in xrange(301, 320):
+            G.add_edge(node - 1, node, weight=random.uniform(0.1, 5))
+        synNodes = [int(n) for n in random.permutation(G.nodes())[:40]]
+        connector_ids = range(len(synNodes))
+        relations = [i % 2 for i in connector_ids]
+        h_list = [1.0, 5.0, 20.0]
+
+        def denseFields(G, synNodes, h_list):
+            nodeList = tuple(G.nodes())
+            synNodes = set(synNodes)
+            D = dijkstra(networkx.to_scipy_sparse_matrix(G, nodeList),
+                    directed=False, indices=[i for i, node in
+                        enumerate(nodeList) if node in synNodes])
+            return {h: numpy.sum(numpy.exp(-1 * D * D / (h * h)), axis=0)
+                    for h in h_list}, {node: i for i, node in enumerate(nodeList)}
+
+        original = synapseclustering.densityFields, \
+                synapseclustering.MAX_DISTANCE_CHUNK_ENTRIES
+        try:
+            synapseclustering.densityFields = denseFields
+            expected = synapseclustering.tree_max_density(G, synNodes,
+                    connector_ids, relations, h_list)
+            synapseclustering.densityFields = original[0]
+            for batch_size in (1, 7, len(synNodes)):
+                synapseclustering.MAX_DISTANCE_CHUNK_ENTRIES = \
+                        batch_size * len(G)
+                fields, id2index = synapseclustering.densityFields(G,
+                        synNodes, h_list)
+                dense, _ = denseFields(G, synNodes, h_list)
+                for h in h_list:
+                    self.assertTrue(numpy.allclose(dense[h], fields[h]))
+                groups = synapseclustering.tree_max_density(G, synNodes,
+                        connector_ids, relations, h_list)
+                for h in h_list:
+                    self.assertEqual(sorted(expected[h].values()),
+                            sorted(groups[h].values()))
+        finally:
+            synapseclustering.densityFields, \
+                    synapseclustering.MAX_DISTANCE_CHUNK_ENTRIES = original
+
+    def test_arbor(self):
+        skeleton_id, arbor = next(lazy_load_arbors([235],
+                ('location_x', 'location_y', 'location_z')))
+        self.assertEqual(235, skeleton_id)
+        self.assertEqual(Treenode.objects.filter(skeleton_id=235).count(),
+                len(arbor))
+        root = arbor.roots()
+        self.assertEqual(1, len(root))
+        self.assertEqual(len(arbor), arbor.subtree_sizes()[root[0]])
+
+        # Every node but the root is the first node of exactly one sequence
+        # or a branch node ending further sequences
+        sequences = list(arbor.partition())
+        self.assertEqual(len(arbor) - 1, sum(len(seq) - 1 for seq in sequences))
+        self.assertEqual(sorted(arbor.ends().tolist()),
+                sorted(seq[0] for seq in sequences))
+
+        # The spanning tree of the root and all end nodes is the whole arbor
+        spanning = arbor.spanning_tree(numpy.append(arbor.ends(), root))
+        self.assertEqual(len(arbor), len(spanning))
+        self.assertAlmostEqual(arbor.cable_length(), spanning.cable_length())
+
+        # Rerooting keeps the edges and the cable
+        cable = arbor.cable_length()
+        end = arbor.ends()[0]
+        arbor.reroot(end)
+        self.assertEqual([end], arbor.roots().tolist())
+        self.assertAlmostEqual(cable, arbor.cable_length())
+        self.assertEqual(0, arbor.edge_count_to_root()[end])
+
+        # Common ancestors match those found by walking up parents
+        def ancestors(i):
+            path = [i]
+            while arbor.parents[path[-1]] != -1:
+                path.append(arbor.parents[path[-1]])
+            return path
+        ends = arbor.ends().tolist()
+        groups = [ends, ends[:2], [ends[-1]], [root[0], ends[0]]]
+        counts = arbor.edge_count_to_root()
+        for group, (ancestor, count) in zip(groups,
+                arbor.find_common_ancestors(groups)):
+            common = reduce(set.intersection,
+                    (set(ancestors(i)) for i in group))
+            expected = max(common, key=lambda i: counts[i])
+            self.assertEqual((expected, counts[expected]), (ancestor, count))
+
+        # The networkx based functions agree with each other, whether an Arbor
+        # is passed in or not, and single nodes are their own ancestor at 0
+        tree = networkx.DiGraph()
+        tree.add_nodes_from(arbor.ids.tolist())
+        tree.add_edges_from((arbor.ids[p].item(), arbor.ids[i].item())
+                for i, p in enumerate(arbor.parents) if p != -1)
+        groups = [[arbor.ids[i].item() for i in group] for group in groups]
+        expected = [find_common_ancestor(tree, group) for group in groups]
+        self.assertEqual((groups[2][0], 0), expected[2])
+        self.assertEqual(expected, find_common_ancestors(tree, groups))
+        self.assertEqual(expected, find_common_ancestors(None, groups, arbor))
+
     def test_node_nearest_for_skeleton(self):
         self.fake_authentication()
         response = self.client.post(
@@ -2430,6 +3152,44 @@ class ViewPageTests(TestCase):
                 "skeleton_id": 361}
         self.assertEqual(expected_result, parsed_response)
 
+    def test_node_nearest_batch(self):
+        self.fake_authentication()
+        url = '/%d/node/nearest/batch' % self.test_project_id
+        params = {
+                'points[0][0]': 5115, 'points[0][1]': 3835, 'points[0][2]': 0,
+                'points[1][0]': 7030, 'points[1][1]': 1980, 'points[1][2]': 9,
+                'neuron_id': 362}
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        expected_result = [
+                {"treenode_id": 367, "x": 7030, "y": 1980, "z": 0,
+                 "skeleton_id": 361},
+                {"treenode_id": 367, "x": 7030, "y": 1980, "z": 0,
+                 "skeleton_id": 361}]
+        self.assertEqual(expected_result, json.loads(response.content))
+
+        # Moving a node has to update the cached index
+        response = self.client.post('/%d/node/update' % self.test_project_id, {
+                't[0][0]': 367, 't[0][1]': 5115, 't[0][2]': 3835, 't[0][3]': 0})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual({"treenode_id": 367, "x": 5115, "y": 3835, "z": 0,
+                "skeleton_id": 361}, parsed_response[0])
+
+        # Also if the edit doesn't change the last edition time of the
+        # skeleton, like one of a transaction that started earlier
+        cursor = connection.cursor()
+        cursor.execute('''
+        UPDATE treenode SET location_x = 7030, location_y = 1980,
+            edition_time = edition_time - interval '1 day'
+        WHERE id = 367
+        ''')
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(expected_result, json.loads(response.content))
+
     def test_node_find_end_of_linear_branch(self):
         self.fake_authentication()
         treenode_id = 391
@@ -2464,6 +3224,25 @@ class ViewPageTests(TestCase):
                             [261, 2820.0, 1345.0, 0.0]]]
         self.assertEqual(expected_result, parsed_response)
 
+    def test_node_find_next_branch_after_edit(self):
+        self.fake_authentication()
+        url = '/%d/node/next_branch_or_end' % self.test_project_id
+        response = self.client.post(url, {'tnid': 253})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(2, len(json.loads(response.content)))
+
+        # Moving the smaller branch to the end of the larger one has to be
+        # reflected by the cached skeleton.
+        response = self.client.post(
+                '/%d/treenode/255/parent' % self.test_project_id,
+                {'parent_id': 265})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(url, {'tnid': 253})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual(1, len(parsed_response))
+        self.assertEqual(263, parsed_response[0][0][0])
+
     def test_node_update_single_treenode(self):
         self.fake_authentication()
         treenode_id = 289
@@ -2486,6 +3265,23 @@ class ViewPageTests(TestCase):
         self.assertEqual(y, treenode.location_y)
         self.assertEqual(z, treenode.location_z)
 
+    def test_node_update_json(self):
+        self.fake_authentication()
+        treenodes = [[289, 5690, 3340, 0], [285, 5200, 3010, 9]]
+        connectors = [[421, 6500, 3500, 0]]
+        response = self.client.post(
+                '/%d/node/update' % self.test_project_id, {
+                    't': json.dumps(treenodes),
+                    'c': json.dumps(connectors)})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual({'updated': 3}, parsed_response)
+        for Kind, nodes in ((Treenode, treenodes), (Connector, connectors)):
+            for node_id, x, y, z in nodes:
+                node = Kind.objects.get(id=node_id)
+                self.assertEqual([x, y, z], [node.location_x,
+                        node.location_y, node.location_z])
+
     def test_node_update_invalid_location(self):
         self.fake_authentication()
         treenode_id = 289
@@ -2667,6 +3463,196 @@ class ViewPageTests(TestCase):
         for row in expected_c_result:
             self.assertTrue(row in parsed_response[1])
 
+    @override_settings(NODE_LIST_CACHE_ENABLED=True,
+            NODE_LIST_CACHE_CELL_SIZE=1000, NODE_LIST_CACHE_MAX_CELLS=100)
+    def test_node_list_cached(self):
+        self.fake_authentication()
+        cache.clear()
+        params = {
+                'sid': 3,
+                'z': 0,
+                'top': 2280,
+                'left': 4430,
+                'width': 8000,
+                'height': 3450,
+                'zres': 9,
+                'atnid': 2372,
+                'labels': 'true'}
+        url = '/%d/node/list' % (self.test_project_id,)
+
+        def node_list():
+            response = self.client.post(url, params)
+            self.assertEqual(response.status_code, 200)
+            treenodes, connectors, labels, limit_reached = \
+                    json.loads(response.content)
+            return sorted(treenodes), sorted(connectors), labels, limit_reached
+
+        with self.settings(NODE_LIST_CACHE_ENABLED=False):
+            expected_result = node_list()
+        # The first request fills the cache, the second one is answered by it
+        self.assertEqual(expected_result, node_list())
+        self.assertEqual(expected_result, node_list())
+
+        # Moving a node has to invalidate the cells of its old and new location
+        response = self.client.post('/%d/node/update' % self.test_project_id, {
+                't[0][0]': 409, 't[0][1]': 6640, 't[0][2]': 4340, 't[0][3]': 0})
+        self.assertEqual(response.status_code, 200)
+        with self.settings(NODE_LIST_CACHE_ENABLED=False):
+            expected_result = node_list()
+        self.assertTrue([409, 407, 6640, 4340, 0, 5, -1, 373, True] in
+                expected_result[0])
+        self.assertEqual(expected_result, node_list())
+
+        # Cells that other requests filled before the transaction of an
+        # invalidation was committed are removed again once it is finished
+        nodecache.invalidate_cells(self.test_project_id, [409])
+        stale = {key: 'stale' for key in nodecache._pending.keys}
+        self.assertTrue(stale)
+        cache.set_many(stale)
+        nodecache.invalidate_pending()
+        self.assertEqual({}, cache.get_many(stale.keys()))
+        self.assertEqual(expected_result, node_list())
+
+    def test_node_list_engines(self):
+        self.fake_authentication()
+        def node_list(engine, **kwargs):
+            params = {
+                    'sid': 3, 'z': 0, 'top': 2280, 'left': 4430,
+                    'width': 8000, 'height': 3450, 'zres': 9, 'as': 373,
+                    'labels': 'true'}
+            params.update(kwargs)
+            with self.settings(NODE_LIST_ENGINE=engine):
+                response = self.client.post(
+                        '/%d/node/list' % self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            treenodes, connectors, labels, limit_reached = \
+                    json.loads(response.content)
+            return sorted(treenodes), sorted(connectors), labels, limit_reached
+
+        for z in (0, 9, 36, 45):
+            self.assertEqual(node_list('join', z=z),
+                    node_list('twophase', z=z))
+
+    def test_node_list_binary(self):
+        self.fake_authentication()
+        params = {
+                'sid': 3,
+                'z': 0,
+                'top': 2280,
+                'left': 4430,
+                'width': 8000,
+                'height': 3450,
+                'zres': 9,
+                'as': 373,
+                'labels': False}
+        url = '/%d/node/list' % (self.test_project_id,)
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        treenodes, connectors, labels, limit_reached = \
+                json.loads(response.content)
+
+        params['format'] = 'binary'
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('application/octet-stream', response['Content-Type'])
+        data = response.content
+
+        offset = [0]
+        def read(dtype, count):
+            values = numpy.frombuffer(data, dtype, count, offset[0])
+            offset[0] += values.nbytes + (-values.nbytes % 8)
+            return values.tolist()
+
+        n_t, n_c, n_pre, n_post, n_labels, flags = read('<u4', 6)
+        self.assertEqual(len(treenodes), n_t)
+        self.assertEqual(len(connectors), n_c)
+        self.assertEqual(limit_reached, bool(flags & 1))
+
+        columns = [read('<f8', n_t), read('<f8', n_t), read('<f4', n_t),
+                read('<f4', n_t), read('<f4', n_t), read('<u1', n_t),
+                read('<f4', n_t), read('<f8', n_t), read('<u1', n_t)]
+        expected_treenodes = [[t[0], -1 if t[1] is None else t[1], t[2], t[3],
+                t[4], t[5], t[6], t[7], int(bool(t[8]))] for t in treenodes]
+        self.assertEqual(expected_treenodes, map(list, zip(*columns)))
+
+        columns = [read('<f8', n_c), read('<f4', n_c), read('<f4', n_c),
+                read('<f4', n_c), read('<u1', n_c), read('<u1', n_c)]
+        pre = [read('<u4', n_c + 1), read('<f8', n_pre), read('<u1', n_pre)]
+        post = [read('<u4', n_c + 1), read('<f8', n_post), read('<u1', n_post)]
+        for i, c in enumerate(connectors):
+            self.assertEqual([c[0], c[1], c[2], c[3], c[4], int(c[7])],
+                    [col[i] for col in columns])
+            for links, expected_links in ((pre, c[5]), (post, c[6])):
+                start, end = links[0][i], links[0][i + 1]
+                self.assertEqual(expected_links, map(list,
+                        zip(links[1][start:end], links[2][start:end])))
+
+        self.assertEqual(labels, json.loads(data[offset[0]:]))
+        self.assertEqual(n_labels, len(data) - offset[0])
+
+        # Partners of connectors outside of the field of view are added with
+        # their own edit permission, in both formats.
+        test0 = User.objects.get(username='test0')
+        classes = get_class_to_id_map(self.test_project_id)
+        relations = get_relation_to_id_map(self.test_project_id)
+        skeleton = ClassInstance.objects.create(user=test0,
+                project_id=self.test_project_id,
+                class_column_id=classes['skeleton'], name='outside')
+        outside = Treenode.objects.create(user=test0, editor=test0,
+                project_id=self.test_project_id, location_x=5000,
+                location_y=3000, location_z=9000, radius=-1, confidence=5,
+                skeleton=skeleton)
+        TreenodeConnector.objects.create(user=test0,
+                project_id=self.test_project_id, treenode=outside,
+                connector_id=connectors[0][0], skeleton=skeleton,
+                relation_id=relations['postsynaptic_to'])
+
+        del params['format']
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        treenodes = json.loads(response.content)[0]
+        self.assertEqual([outside.id, None, 5000, 3000, 9000, 5, -1,
+                skeleton.id, False], [t for t in treenodes
+                    if t[0] == outside.id][0])
+        self.assertEqual(1, len([t for t in treenodes if t[0] == outside.id]))
+
+        params['format'] = 'binary'
+        response = self.client.post(url, params)
+        data = response.content
+        offset = [0]
+        n_t = read('<u4', 6)[0]
+        self.assertEqual(len(treenodes), n_t)
+        columns = [read('<f8', n_t), read('<f8', n_t), read('<f4', n_t),
+                read('<f4', n_t), read('<f4', n_t), read('<u1', n_t),
+                read('<f4', n_t), read('<f8', n_t), read('<u1', n_t)]
+        self.assertEqual([0], [can_edit for node_id, can_edit
+                in zip(columns[0], columns[8]) if node_id == outside.id])
+
+    def test_user_domain_cache(self):
+        test0 = User.objects.get(username='test0')
+        test2 = User.objects.get(username='test2')
+        cursor = connection.cursor()
+        self.assertEqual(set([test2.id]), user_domain(cursor, test2.id))
+        self.assertFalse(user_can_edit(cursor, test2.id, test0.id))
+
+        # Changing group memberships has to be reflected immediately
+        group = Group.objects.create(name='test0')
+        test2.groups.add(group)
+        self.assertEqual(set([test2.id, test0.id]),
+                user_domain(cursor, test2.id))
+        self.assertTrue(user_can_edit(cursor, test2.id, test0.id))
+
+        group.user_set.remove(test2)
+        self.assertEqual(set([test2.id]), user_domain(cursor, test2.id))
+        self.assertFalse(user_can_edit(cursor, test2.id, test0.id))
+
+        # Edit checks fill the cache for the following ones
+        with override_settings(USER_DOMAIN_CACHE_TIMEOUT=60):
+            invalidate_user_domains([test2.id])
+            self.assertIsNone(_cached_user_domain(test2.id))
+            self.assertFalse(user_can_edit(cursor, test2.id, test0.id))
+            self.assertEqual(set([test2.id]), _cached_user_domain(test2.id))
+
     def test_textlabels_empty(self):
         self.fake_authentication()
         expected_result = {}
@@ -2788,6 +3774,79 @@ class ViewPageTests(TestCase):
         self.assertEqual(aq[0].name, 'myannotation')
         self.assertEqual(aq[1].name, 'pattern 10 test-2-annotation')
 
+    def test_annotation_hierarchy(self):
+        self.fake_authentication()
+
+        def annotate(entity_id, name):
+            annotations = _annotate_entities(self.test_project_id, [entity_id],
+                    {name: self.test_user_id})
+            return annotations.keys()[0].id
+
+        # Build the hierarchy neuron <- A <- B <- C, where the arrows point
+        # from an annotation to the entity annotated with it
+        a = annotate(2365, 'A')
+        b = annotate(a, 'B')
+        c = annotate(b, 'C')
+        sub_annotations = get_sub_annotation_ids(self.test_project_id, [a, b, c])
+        self.assertEqual({a: [], b: [a], c: sorted([a, b])},
+                {k: sorted(v) for k, v in sub_annotations.iteritems()})
+
+        # Removing a link is seen by the next lookup
+        ClassInstanceClassInstance.objects.filter(class_instance_a=a,
+                class_instance_b=b).delete()
+        hierarchy = project_hierarchy(self.test_project_id)
+        self.assertEqual(frozenset([b]), hierarchy.sub_annotation_ids(c))
+        self.assertEqual(frozenset(), hierarchy.sub_annotation_ids(b))
+
+        # Cycles don't keep the lookup from ending
+        annotate(c, 'B')
+        hierarchy = project_hierarchy(self.test_project_id)
+        self.assertEqual(frozenset([b, c]), hierarchy.sub_annotation_ids(c))
+
+    def test_neuron_search_pages(self):
+        self.fake_authentication()
+        neuron_ids = [2365, 2381]
+        annotations = _annotate_entities(self.test_project_id, neuron_ids,
+                {'pager': self.test_user_id})
+        annotation_id = annotations.keys()[0].id
+
+        def search(**params):
+            params['neuron_query_by_annotation'] = annotation_id
+            response = self.client.post('/%d/neuron/query-by-annotations' %
+                    self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)
+
+        parsed_response = search()
+        self.assertEqual(neuron_ids,
+                [e['id'] for e in parsed_response['entities']])
+        self.assertEqual(2, parsed_response['total_n_records'])
+        first_page = search(display_length=1)
+        self.assertEqual([2365], [e['id'] for e in first_page['entities']])
+        self.assertEqual(2, first_page['total_n_records'])
+        second_page = search(display_start=1, display_length=1,
+                display_after=2365)
+        self.assertEqual([2381], [e['id'] for e in second_page['entities']])
+        self.assertEqual(2, second_page['total_n_records'])
+
+        def table(**params):
+            params.update({'neuron_query_by_annotation': annotation_id,
+                    'iDisplayLength': 1, 'iSortCol_0': 0, 'sSortDir_0': 'asc'})
+            response = self.client.post('/%d/neuron/table/query-by-annotations' %
+                    self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)
+
+        first_page = table(iDisplayStart=0)
+        self.assertEqual(2, first_page['iTotalRecords'])
+        last = first_page['aaData'][0]
+        offset_page = table(iDisplayStart=1)
+        keyset_page = table(iDisplayStart=1, display_after_name=last[0],
+                display_after_id=last[3])
+        self.assertEqual(1, len(keyset_page['aaData']))
+        self.assertEqual(offset_page['aaData'], keyset_page['aaData'])
+        self.assertNotEqual(last[3], keyset_page['aaData'][0][3])
+
     def test_review_status(self):
         self.fake_authentication()
 
@@ -2813,6 +3872,18 @@ class ViewPageTests(TestCase):
         expected_result = {'2388': 66}
         self.assertJSONEqual(response.content, expected_result)
 
+        # Repeated reviews of a node by the same user count once
+        Review.objects.create(project_id=self.test_project_id, reviewer_id=3,
+            review_time=review_time, skeleton_id=skeleton_id, treenode_id=2396)
+        response = self.client.post(url, {'skeleton_ids[0]': skeleton_id,
+                'user_ids[0]': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertJSONEqual(response.content, {'2388': 66})
+        response = self.client.post(url, {'skeleton_ids[0]': skeleton_id,
+                'user_ids[0]': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertJSONEqual(response.content, {'2388': 33})
+
         # Use empty whitelist
         response = self.client.post(url,
                 {'skeleton_ids[0]': skeleton_id, 'whitelist': 'true'})
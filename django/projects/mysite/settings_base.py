@@ -147,6 +147,7 @@ MEDIA_HDF5_SUBDIRECTORY = 'hdf5'
 MEDIA_CROPPING_SUBDIRECTORY = 'cropping'
 MEDIA_ROI_SUBDIRECTORY = 'roi'
 MEDIA_TREENODE_SUBDIRECTORY = 'treenode_archives'
+MEDIA_ADJACENCY_SUBDIRECTORY = 'adjacency'
 
 # The maximum allowed size in Bytes for generated files. The cropping tool, for
 # instance, uses this to cancel a request if the generated file grows larger
@@ -159,6 +160,36 @@ USER_REGISTRATION_ALLOWED = False
 # A new user's defaul groups
 NEW_USER_DEFAULT_GROUPS = []
 
+# The tracing overlay's node list can be answered from a spatial cache of fixed
+# grid cells, which are invalidated by tracing operations. Since cells have to
+# be invalidated in all worker processes, a shared cache back-end (e.g.
+# memcached) has to be configured in CACHES, if this is enabled. The cell size
+# is given in calibrated units (usually nm), the timeout in seconds. Field of
+# views that span more than NODE_LIST_CACHE_MAX_CELLS cells are queried
+# directly.
+NODE_LIST_CACHE_ENABLED = False
+NODE_LIST_CACHE_CELL_SIZE = 4096
+NODE_LIST_CACHE_TIMEOUT = 600
+NODE_LIST_CACHE_MAX_CELLS = 16
+
+# The strategy used to find the treenodes of a field of view together with
+# their parents and children: 'twophase' queries the nodes in the field of view
+# first and looks up their neighbors by ID afterwards, 'join' uses a single
+# self-join of the treenode table, which becomes slow on large projects.
+NODE_LIST_ENGINE = 'twophase'
+
+# Edit permissions are derived from the groups a user is member of. Each worker
+# process caches these user domains for the given number of seconds, changes
+# made through another process become visible after this time. A value of 0
+# disables the cache.
+USER_DOMAIN_CACHE_TIMEOUT = 60
+
+# Neuron searches that return more than one page of results are counted only
+# once. The count is kept in the cache for the given number of seconds and is
+# used for all further pages of the same search. A value of 0 counts the
+# results of every page.
+NEURON_SEARCH_COUNT_CACHE_TIMEOUT = 60
+
 # A sequence of modules that contain Celery tasks which we want Celery to know
 # about automatically.
 CELERY_IMPORTS = (